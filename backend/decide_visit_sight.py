@@ -1,26 +1,99 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
 from openai import OpenAI
 from dotenv import load_dotenv
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Optional
 import googlemaps
 import os
 import sys
 import json
-from datetime import datetime
-from collections import defaultdict
+import logging
+import threading
+import time
 from fastapi.middleware.cors import CORSMiddleware
-import random
+from starlette.routing import Match
+from fastapi.responses import (
+    FileResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+import asyncio
+import numpy as np
 
 # from google.cloud import storage
-import requests
-from urllib.parse import urlencode
+import re
+from urllib.parse import quote, urlencode
+
+from tool.batch import (
+    BATCH_CONCURRENCY,
+    BATCH_MAX_ITEMS,
+    BatchContext,
+    current_batch,
+    run_batch,
+    to_ndjson,
+)
+from tool.cache import CACHE_DIR, TieredCache, normalize_text
+from tool.deadline import (
+    DEADLINE_CATEGORIZATION_RESERVE_MS,
+    DEADLINE_FINAL_RESERVE_MS,
+    Deadline,
+    DeadlineExceeded,
+)
+from tool.compact import compact_route, compact_stores, dumps, encode_body
+from tool.categorizer import CATEGORY_PROMPT, StoreCategorizer
+from tool.directions_cache import DirectionsCache
+from tool.executor import BlockingExecutor
+from tool.history_store import create_history_store
+from tool.json_stream import IncrementalJsonParser
+from tool.http_client import PooledHttpClient
+from tool.metrics import (
+    critical_path_stages,
+    external_call,
+    http_request_duration,
+    http_requests,
+    http_requests_in_flight,
+    observe_cache,
+    observe_prompt_cache,
+    observe_scheduler,
+    observe_singleflight,
+    registry,
+)
+from tool.photo_cache import (
+    PHOTO_MAX_AGE,
+    PhotoCache,
+    PhotoNotFound,
+    etag_matches,
+)
+from tool.poi_index import PoiIndex
+from tool.prompt_cache import PromptCache, history_key
+from tool.replay import EXTERNAL_API_MODE, create_offline_clients, wrap_for_recording
+from tool.route_optimizer import TravelTimeMatrix, merge_directions, solve_order
+from tool.route_sampling import sample_search_points
+from tool.scheduler import (
+    GOOGLE_QPS,
+    PRIORITY_ENRICHMENT,
+    RateLimited,
+    RateLimiter,
+    SchedulerOverloaded,
+)
+from tool.singleflight import SingleFlight
+from tool.stage_graph import StageGraph
+from tool.spatial_index import SearchCoverage
+from tool.store_selection import select_stores
+from tool.tracing import current_trace, server_timing, stage, start_trace
 
 # 標準出力をUTF-8に設定
 sys.stdout.reconfigure(encoding="utf-8")
 # .envファイルを読み込む
 load_dotenv()
 
+# ログ出力 (APIの応答などの詳細はLOG_LEVEL=DEBUGの場合のみ出力する)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.getLogger("decide_visit_sight")
+# 全てのレスポンスにServer-Timingヘッダーを付けるか (X-Timingヘッダー付きのリクエストには常に付ける)
+TIMING_HEADER = os.getenv("TIMING_HEADER", "0") == "1"
+
 # FastAPIインスタンス
 app = FastAPI()
 
@@ -32,15 +105,110 @@ app.add_middleware(
     allow_headers=["*"],  # すべてのヘッダーを許可
 )
 
-# OpenAIのAPIキーを設定
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
 # Google Maps APIキーを設定
 GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
-gmaps = googlemaps.Client(key=GOOGLE_MAPS_API_KEY)
 
-# 対話履歴を保持する辞書 (スレッドIDをキーとする)
-thread_histories: Dict[str, List[Dict[str, str]]] = defaultdict(list)
+if EXTERNAL_API_MODE in ("replay", "synthetic"):
+    # 記録済みのフィクスチャ、または合成データで外部APIを置き換える (APIキー不要)
+    client, gmaps, http_client = create_offline_clients(EXTERNAL_API_MODE)
+else:
+    # OpenAIのAPIキーを設定
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    # Google APIへのリクエストは全て同じ接続プールを使い、タイムアウトと再試行を行う
+    http_client = PooledHttpClient()
+    gmaps = googlemaps.Client(
+        key=GOOGLE_MAPS_API_KEY, **http_client.google_maps_options()
+    )
+    if EXTERNAL_API_MODE == "record":
+        # 応答をフィクスチャとして保存する
+        client, gmaps, http_client = wrap_for_recording(client, gmaps, http_client)
+
+# Google APIのブロッキング呼び出しを並列実行するエグゼキュータ
+# (空きを待つ呼び出しはルートの計算に必要なものを優先し、待ち行列が上限を超えたら受け付けない)
+places_executor = BlockingExecutor()
+# Google APIごとのレート制限
+# (合成データ・フィクスチャを使う場合は実際のAPIを呼ばないため制限しない)
+rate_limiter = RateLimiter(
+    rate=None if EXTERNAL_API_MODE in ("replay", "synthetic") else GOOGLE_QPS
+)
+# 過負荷で503を返すときに、再試行までの目安として返す秒数
+RETRY_AFTER_SECONDS = os.getenv("RETRY_AFTER_SECONDS", "2")
+
+# 同じキーの外部API呼び出しをまとめる (同じホストのワーカー間でも共有する)
+singleflight = SingleFlight()
+
+# Places API (find_place / place details) の結果キャッシュ
+places_cache = TieredCache(
+    os.path.join(CACHE_DIR, "places.sqlite3"),
+    max_entries=int(os.getenv("PLACES_CACHE_MAX_ENTRIES", "4096")),
+    ttls={
+        "find_place": int(os.getenv("FIND_PLACE_CACHE_TTL", str(7 * 24 * 3600))),
+        "place": int(os.getenv("PLACE_DETAILS_CACHE_TTL", str(24 * 3600))),
+    },
+    flight=singleflight,
+)
+
+# Directions APIの結果キャッシュ
+directions_cache = DirectionsCache(
+    TieredCache(
+        os.path.join(CACHE_DIR, "directions.sqlite3"),
+        max_entries=int(os.getenv("DIRECTIONS_CACHE_MAX_ENTRIES", "512")),
+    )
+)
+
+# オフラインで収集したお店の索引 (python -m tool.poi_index で作る。なければNone)
+poi_index = PoiIndex.open() if os.getenv("POI_INDEX", "1") == "1" else None
+
+# プロンプトごとの提案のキャッシュ (ほぼ同じプロンプトには生成AIを呼ばずに同じ提案を返す)
+prompt_cache = PromptCache()
+# 生成した旅程全体もキャッシュするか (ルートは出発時刻に依存するため既定では提案のみ)
+PROMPT_CACHE_ITINERARY = os.getenv("PROMPT_CACHE_ITINERARY", "0") == "1"
+# 旅程を保持する時間 (秒)
+PROMPT_CACHE_ITINERARY_TTL = int(os.getenv("PROMPT_CACHE_ITINERARY_TTL", "600"))
+
+# お店の写真を /photo/{photo_reference} 経由で配信するか
+# (0の場合はPlace Photo APIのURLをそのまま返す。APIキーがフロントエンドに渡る)
+PHOTO_PROXY = os.getenv("PHOTO_PROXY", "1") == "1"
+# 写真のURLの前に付けるオリジン (空の場合はフロントエンドと同じオリジンの相対パス)
+PHOTO_BASE_URL = os.getenv("PHOTO_BASE_URL", "").rstrip("/")
+# photo_referenceとして受け付ける文字列
+PHOTO_REFERENCE_PATTERN = re.compile(r"[A-Za-z0-9_\-]{1,1024}")
+# 取得した写真と縮小版のキャッシュ
+photo_cache = PhotoCache()
+
+# お店を検索する半径 (m)・地点の間隔 (m)・地点数の上限
+STORE_SEARCH_RADIUS = int(os.getenv("STORE_SEARCH_RADIUS", "100"))
+STORE_SEARCH_SPACING = int(os.getenv("STORE_SEARCH_SPACING", "150"))
+STORE_SEARCH_MAX_POINTS = int(os.getenv("STORE_SEARCH_MAX_POINTS", "60"))
+# 既に検索した円とこの割合以上重なる地点は検索しない
+STORE_SEARCH_MAX_OVERLAP = float(os.getenv("STORE_SEARCH_MAX_OVERLAP", "0.5"))
+# 検索結果をリクエストをまたいで使い回す時間 (秒)。0の場合は共有しない
+SHARED_SEARCH_COVERAGE_TTL = int(os.getenv("SHARED_SEARCH_COVERAGE_TTL", "0"))
+
+# リクエストをまたいで共有する検索済みの範囲
+shared_coverage = (
+    SearchCoverage(
+        STORE_SEARCH_RADIUS, STORE_SEARCH_MAX_OVERLAP, ttl=SHARED_SEARCH_COVERAGE_TTL
+    )
+    if SHARED_SEARCH_COVERAGE_TTL > 0
+    else None
+)
+
+# 訪問順を決めるための移動時間の取得方法
+# estimate: 直線距離から見積もる (既定) / distance_matrix: Distance Matrix APIで取得する
+ROUTE_MATRIX_SOURCE = os.getenv("ROUTE_MATRIX_SOURCE", "estimate")
+# Directions APIの1回の呼び出しで指定できる経由地の数
+DIRECTIONS_MAX_WAYPOINTS = 25
+
+# お店の選択に使う乱数のシード (指定すると同じ候補からは常に同じお店を選ぶ)
+STORE_SELECTION_SEED = (
+    int(os.environ["STORE_SELECTION_SEED"])
+    if os.getenv("STORE_SELECTION_SEED")
+    else None
+)
+
+# 対話履歴を保持するストア (スレッドIDをキーとする)
+history_store = create_history_store()
 
 
 # リクエストモデル
@@ -48,6 +216,21 @@ class RouteRequest(BaseModel):
     prompt: str  # generate_responseで使用するプロンプト
 
 
+# バッチ処理の1件分 (thread_idを省略した場合は件ごとに新しいスレッドになる)
+class BatchItem(BaseModel):
+    prompt: str
+    thread_id: Optional[str] = None
+
+
+# バッチ処理のリクエスト (promptsとitemsのどちらか、または両方を指定する)
+class BatchRequest(BaseModel):
+    prompts: List[str] = []
+    items: List[BatchItem] = []
+    concurrency: Optional[int] = None
+    deadline_ms: Optional[int] = None
+    compact: bool = False
+
+
 # レスポンスモデル
 class RouteResponse(BaseModel):
     total_distance: str
@@ -56,11 +239,49 @@ class RouteResponse(BaseModel):
     detailed_routes: List[dict]  # 各ルートの詳細
 
 
+def call_google(api, func, *args, **kwargs):
+    """
+    レート制限に従ってGoogle APIを呼び出す
+    OVER_QUERY_LIMITが返された場合は、そのAPIの呼び出しを一時的に止めてから1回だけ再試行する
+    """
+    for attempt in range(2):
+        rate_limiter.acquire(api)
+        try:
+            with external_call(api):
+                return func(*args, **kwargs)
+        except googlemaps.exceptions.ApiError as e:
+            if e.status != "OVER_QUERY_LIMIT":
+                raise
+            rate_limiter.over_query_limit(api)
+            if attempt:
+                raise RateLimited(f"{api}: OVER_QUERY_LIMIT") from e
+
+
+def api_error(e, detail):
+    """
+    パイプラインの例外をHTTPExceptionに変換する
+    レート制限・過負荷の場合は、時間をおいて再試行できるよう503を返す
+    締め切りまでに必須のステージが終わらなかった場合は504を返す
+    """
+    if isinstance(e, DeadlineExceeded):
+        return HTTPException(status_code=504, detail=f"{detail}: {str(e)}")
+    if isinstance(e, SchedulerOverloaded) or (
+        isinstance(e, HTTPException) and e.status_code == 503
+    ):
+        return HTTPException(
+            status_code=503,
+            detail=f"{detail}: {str(e)}",
+            headers={"Retry-After": RETRY_AFTER_SECONDS},
+        )
+    return HTTPException(status_code=500, detail=f"{detail}: {str(e)}")
+
+
 def get_directions_api_response(
-    api_key, origin, destination, waypoints, departure_time
+    api_key, origin, destination, waypoints, departure_time, optimize=True
 ):
     """
     Google Maps Directions APIを直接たたく関数
+    optimize=False の場合は経由地を指定した順番で訪問する
     """
     base_url = "https://maps.googleapis.com/maps/api/directions/json"
 
@@ -71,7 +292,7 @@ def get_directions_api_response(
         "waypoints": "|".join(waypoints) if waypoints else None,  # 経由地をパイプで連結
         "mode": "driving",
         "departure_time": departure_time,
-        "optimizeWaypoints": "true",
+        "optimizeWaypoints": "true" if optimize else None,
         "key": api_key,
     }
 
@@ -82,17 +303,151 @@ def get_directions_api_response(
     url = f"{base_url}?{query_string}"
 
     # APIリクエストを送信
-    response = requests.get(url)
+    response = call_google("directions", http_client.get, url)
 
     # ステータスコードをチェック
     if response.status_code != 200:
         raise Exception(
             f"Google Maps API request failed with status code {response.status_code}: {response.text}"
         )
-    print(url)
-    # print(response.json())
+    logger.debug("Directions API request: %s", base_url)
     # 結果をJSONで返す
-    return response.json()
+    result = response.json()
+    if result.get("status") == "OVER_QUERY_LIMIT":
+        # HTTPクライアントの再試行でも解消しなかった
+        rate_limiter.over_query_limit("directions")
+        raise RateLimited("directions: OVER_QUERY_LIMIT")
+    return result
+
+
+def get_directions_cached(
+    origin, destination, waypoints, departure_time, optimize=True
+):
+    """
+    キャッシュを経由してDirections APIを呼び出す
+    optimize=True の場合、経由地の集合が同じであれば並び順が違っても同じ結果を使い回す
+    """
+    result = directions_cache.get(
+        origin,
+        destination,
+        waypoints,
+        departure_time=departure_time,
+        optimize=optimize,
+    )
+    if result is not None:
+        return result
+
+    def load():
+        result = get_directions_api_response(
+            api_key=GOOGLE_MAPS_API_KEY,
+            origin=origin,
+            destination=destination,
+            waypoints=waypoints,
+            departure_time=departure_time,
+            optimize=optimize,
+        )
+        directions_cache.set(
+            origin,
+            destination,
+            waypoints,
+            result,
+            departure_time=departure_time,
+            optimize=optimize,
+        )
+        return result
+
+    def recheck():
+        result = directions_cache.get(
+            origin,
+            destination,
+            waypoints,
+            departure_time=departure_time,
+            optimize=optimize,
+        )
+        return result is not None, result
+
+    # 実行中の呼び出しの結果は経由地の並びが同じ場合だけ共有する
+    key = directions_cache.key(
+        origin, destination, waypoints, "driving", departure_time, optimize
+    )
+    return singleflight.do(
+        ("directions", key, tuple(waypoints or [])), load, recheck=recheck
+    )
+
+
+def get_ordered_directions(origin, destination, waypoints, departure_time):
+    """
+    訪問順を決めた経由地のルートを取得する
+    経由地がDirections APIの上限を超える場合は区間に分けて取得し、1つのルートにまとめる
+    """
+    if len(waypoints) <= DIRECTIONS_MAX_WAYPOINTS:
+        return get_directions_cached(
+            origin, destination, waypoints, departure_time, optimize=False
+        )
+    stops = [origin, *waypoints, destination]
+    results = []
+    start = 0
+    while start < len(stops) - 1:
+        end = min(start + DIRECTIONS_MAX_WAYPOINTS + 1, len(stops) - 1)
+        results.append(
+            get_directions_cached(
+                stops[start],
+                stops[end],
+                stops[start + 1 : end],
+                departure_time,
+                optimize=False,
+            )
+        )
+        start = end
+    return merge_directions(results)
+
+
+def fetch_travel_times(origins, destinations):
+    """
+    Distance Matrix APIで出発地×目的地の移動時間 (秒) を取得する
+    """
+    result = call_google(
+        "distance_matrix",
+        gmaps.distance_matrix,
+        origins=origins,
+        destinations=destinations,
+        mode="driving",
+    )
+    return [
+        [
+            element["duration"]["value"] if element.get("status") == "OK" else None
+            for element in row.get("elements", [])
+        ]
+        for row in result.get("rows", [])
+    ]
+
+
+# 地点間の移動時間の行列 (Distance Matrix APIの結果はplaces_cacheに保存)
+travel_times = TravelTimeMatrix(
+    places_cache,
+    fetch=fetch_travel_times if ROUTE_MATRIX_SOURCE == "distance_matrix" else None,
+)
+
+
+def coordinates(location):
+    """
+    {"lat": .., "lng": ..} を (lat, lng) に変換する。座標がなければNone
+    """
+    if not location or "lat" not in location or "lng" not in location:
+        return None
+    return location["lat"], location["lng"]
+
+
+def order_waypoints(origin_location, stops):
+    """
+    出発地に戻る巡回路として、stops ((名前, 座標) のリスト) の訪問順を決める
+    座標が不明な地点がある場合はNoneを返す
+    """
+    coords = [coordinates(origin_location)] + [coordinates(loc) for _, loc in stops]
+    if any(c is None for c in coords):
+        return None
+    order = solve_order(travel_times.build(coords))
+    return [stops[i] for i in order]
 
 
 # def generate_signed_url(bucket_name, object_name, expiration=3600):
@@ -201,7 +556,9 @@ def get_nearest_station(lat, lng):
     """
     try:
         # 最寄り駅を検索
-        places_result = gmaps.places_nearby(
+        places_result = call_google(
+            "places_nearby",
+            gmaps.places_nearby,
             location=(lat, lng),
             radius=5000,  # 半径2km以内を検索
             type="train_station",  # 駅を指定
@@ -219,64 +576,614 @@ def get_nearest_station(lat, lng):
                 status_code=404, detail="最寄り駅が見つかりませんでした。"
             )
     except Exception as e:
-        raise HTTPException(
-            status_code=500, detail=f"Error fetching nearest station: {str(e)}"
+        raise api_error(e, "Error fetching nearest station")
+
+
+def build_photo_url(photo_reference):
+    """
+    写真のリファレンスからPlace Photo APIのURLを生成する
+    """
+    if not photo_reference:
+        return None
+    if PHOTO_PROXY:
+        return f"{PHOTO_BASE_URL}/photo/{quote(photo_reference, safe='')}"
+    return (
+        f"https://maps.googleapis.com/maps/api/place/photo"
+        f"?maxwidth=400&photoreference={photo_reference}&key={GOOGLE_MAPS_API_KEY}"
+    )
+
+
+def fetch_photo(photo_reference):
+    """
+    写真をキャッシュから探し、なければPlace Photo APIから取得して保存する
+    保存した画像のハッシュを返す
+    """
+    digest = photo_cache.lookup(photo_reference)
+    if digest is not None:
+        return digest
+
+    def recheck():
+        digest = photo_cache.lookup(photo_reference)
+        return digest is not None, digest
+
+    def load():
+        params = {
+            "maxwidth": photo_cache.fetch_width,
+            "photoreference": photo_reference,
+            "key": GOOGLE_MAPS_API_KEY,
+        }
+        url = f"https://maps.googleapis.com/maps/api/place/photo?{urlencode(params)}"
+        response = call_google("place_photo", http_client.get, url)
+        if response.status_code != 200:
+            raise PhotoNotFound(f"Place Photo API returned {response.status_code}")
+        return photo_cache.store(photo_reference, response.content)
+
+    return singleflight.do(("photo", photo_reference), load, recheck=recheck)
+
+
+def find_place_cached(name, fields):
+    """
+    キャッシュを経由してfind_placeを呼び出す
+    キーは正規化したクエリ文字列と取得フィールドの組み合わせ
+    """
+    key = f"{normalize_text(name)}|{','.join(sorted(fields))}"
+
+    def load():
+        return call_google(
+            "find_place",
+            gmaps.find_place,
+            input=name,
+            input_type="textquery",
+            fields=fields,
         )
 
+    return places_cache.get_or_load("find_place", key, load)
 
-# 条件を満たすお店を選択
-def pick_stores(stores, store_list):
+
+def place_details_cached(place_id):
     """
-    条件を満たすお店を選択し、picked_stores_listに情報を格納
-    stores: [(お店の名前, カテゴリ番号), ...]
-    store_list: お店の詳細情報リスト
+    キャッシュを経由してplace details を呼び出す (キーはplace_id)
     """
-    # カテゴリ1のお店を抽出
-    category_1_stores = [store for store in stores if store[1] == "1"]
 
-    picked_stores = []
-    picked_stores_list = []
-    used_categories = set()
-    used_names = set()
+    def load():
+        return call_google("place_details", gmaps.place, place_id=place_id)
+
+    return places_cache.get_or_load("place", place_id, load)
 
-    # カテゴリ1のお店を1つ追加
-    if category_1_stores:
-        store = random.choice(category_1_stores)
-        picked_stores.append(store[0])  # 名前を追加
-        store_index = stores.index(store)
-        picked_stores_list.append(
-            store_list[store_index]
-        )  # store_listから詳細情報を追加
-        used_categories.add(store[1])  # カテゴリを記録
-        used_names.add(store[0])  # 名前を記録
 
-    # 残りの3つを選択
-    for i, store in enumerate(stores):
-        if len(picked_stores) == 4:  # 4つ選択完了したら終了
+async def find_location(name):
+    """
+    Google Places APIで場所の詳細情報を取得し、locationsの要素を作成する
+    """
+    place_results = await places_executor.run(
+        find_place_cached, name, ["geometry", "formatted_address", "photos"]
+    )
+    if not place_results.get("candidates"):
+        # 場所が見つからなかった場合のデフォルト値
+        return {
+            "name": name,
+            "address": "住所不明",
+            "location": {},
+            "photo": None,
+        }
+
+    location_data = place_results["candidates"][0]
+
+    # 写真のリファレンスを取得
+    photo_reference = None
+    photos = location_data.get("photos", [])
+    if photos:
+        photo_reference = photos[0].get("photo_reference")
+
+    return {
+        "name": name,
+        "address": location_data.get("formatted_address", "住所不明"),
+        "location": location_data.get("geometry", {}).get("location", {}),
+        "photo": build_photo_url(photo_reference),
+    }
+
+
+def build_store(place_details):
+    """
+    Place Details APIの結果から、ECサイトを持つお店の情報を作成する
+    条件を満たさない場合はNoneを返す
+    """
+    result = place_details.get("result", {})
+    website = result.get("website")
+    if not website:
+        return None
+    if "convenience_store" in result.get("types", "不明"):
+        return None
+
+    # お店の画像URLを取得
+    photo_reference = None
+    photos = result.get("photos", [])
+    if photos:
+        photo_reference = photos[0].get("photo_reference")
+
+    return {
+        "place_id": result.get("place_id"),
+        "name": result.get("name", "不明な店舗"),
+        "website": website,
+        "address": result.get("formatted_address", "住所不明"),
+        "rating": result.get("rating", "評価なし"),
+        "user_ratings_total": result.get("user_ratings_total", 0),
+        "location": result.get("geometry", {}).get("location", {}),
+        "photo": build_photo_url(photo_reference),
+        "types": result.get("types", "不明"),
+    }
+
+
+def indexed_store(record):
+    """
+    索引のお店を、build_storeと同じ形にする
+    """
+    return {
+        "place_id": record["place_id"],
+        "name": record["name"],
+        "website": record["website"],
+        "address": record["address"],
+        "rating": record["rating"] if record["rating"] is not None else "評価なし",
+        "user_ratings_total": record["user_ratings_total"],
+        "location": record["location"],
+        "photo": build_photo_url(record["photo_reference"]),
+        "types": record["types"] or "不明",
+    }
+
+
+def indexed_store_groups(search_points):
+    """
+    索引で収集済みの範囲にある地点の周辺店舗を、ローカルの索引から探す
+    地点と同じ順番で、収集済みなら {"location", "stores", "categories"}、範囲外ならNoneを返す
+    """
+    points = [(item["lat"], item["lng"]) for item in search_points]
+    if poi_index is None or not points:
+        return [None] * len(points)
+    groups = []
+    for point, rows in zip(points, poi_index.search(points, STORE_SEARCH_RADIUS)):
+        if rows is None:
+            groups.append(None)
+            continue
+        records = [poi_index.record(row) for row in rows]
+        groups.append(
+            {
+                "location": point,
+                "stores": [indexed_store(record) for record in records],
+                # 索引を作った時点で分かっていたカテゴリ
+                "categories": {
+                    record["place_id"]: record["category"]
+                    for record in records
+                    if record["category"] is not None
+                },
+            }
+        )
+    return groups
+
+
+def search_nearby_stores(location, radius):
+    """
+    Places APIで指定地点の周辺店舗を検索する
+    同じ地点の検索が実行中であれば、その結果を使う
+    """
+
+    def search():
+        return call_google(
+            "places_nearby",
+            gmaps.places_nearby,
+            location=location,
+            radius=radius,
+            type="store",  # 店舗タイプを指定
+        )
+
+    return singleflight.do(("places_nearby", tuple(location), radius), search)
+
+
+def shared_search_coverage():
+    """
+    リクエストをまたいで共有する検索済みの範囲 (バッチ処理ではバッチ内で共有する)
+    """
+    batch = current_batch()
+    if batch is not None and batch.coverage is not None:
+        return batch.coverage
+    return shared_coverage
+
+
+async def search_stores(item, coverage, fetch_details):
+    """
+    指定地点の周辺店舗を検索し、各店舗の詳細を並列に取得する
+    coverage: このリクエストで検索済みの範囲
+    fetch_details: place_idごとに詳細取得のタスクを共有する関数
+    """
+    location = (item["lat"], item["lng"])  # location=(latitude, longitude)
+
+    # 検索済みの円と大きく重なる場合は検索しない
+    if coverage.covering(*location):
+        return {"location": location, "stores": []}
+    coverage.add(*location)
+    logger.debug("Searching nearby stores for location: %s", location)
+
+    shared_search = shared_search_coverage()
+    shared = shared_search.covering(*location) if shared_search is not None else None
+    if shared:
+        # 他のリクエストで検索済みの結果を使い回す
+        place_ids = shared["place_ids"]
+    else:
+        # Google Places APIを使って周辺の店舗を検索
+        # 過負荷の場合はこの地点の検索を諦め、旅程の生成を優先する
+        try:
+            places_result = await places_executor.submit(
+                PRIORITY_ENRICHMENT, search_nearby_stores, location, STORE_SEARCH_RADIUS
+            )
+        except SchedulerOverloaded:
+            logger.info("Store search shed at %s", location)
+            return {"location": location, "stores": []}
+        place_ids = [place["place_id"] for place in places_result.get("results", [])]
+        if shared_search is not None:
+            shared_search.add(*location, place_ids=place_ids)
+
+    details_list = await asyncio.gather(
+        *(fetch_details(place_id) for place_id in place_ids),
+        return_exceptions=True,
+    )
+
+    # ECサイトを持つ店舗をフィルタリング
+    stores_with_websites = []
+    for place_details in details_list:
+        # 過負荷で詳細の取得を見送った店舗は除く
+        if isinstance(place_details, SchedulerOverloaded):
+            continue
+        # 詳細取得に失敗した場合は、それ以降の店舗を打ち切る (従来の挙動)
+        if isinstance(place_details, Exception):
+            break
+        try:
+            store = build_store(place_details)
+        except Exception:
             break
-        if store[1] not in used_categories and store[0] not in used_names:
-            picked_stores.append(store[0])  # 名前を追加
-            picked_stores_list.append(store_list[i])  # store_listから詳細情報を追加
-            used_categories.add(store[1])  # カテゴリを記録
-            used_names.add(store[0])  # 名前を記録
+        if store:
+            stores_with_websites.append(store)
 
-    return picked_stores, picked_stores_list
+    return {"location": location, "stores": stores_with_websites}
 
 
-@app.post("/generate_response")
-async def generate_response(prompt: str, thread_id: str = Query(default="default")):
+async def scan_stores(search_points, on_store_group=None):
     """
-    ユーザーからのプロンプトに対して、GPT-4を用いて回答を生成し、過去の対話履歴を保持
+    各検索地点の周辺店舗を並列に取得する
+    索引で収集済みの地点はローカルの索引から探し、それ以外の地点だけPlaces APIで検索する
+    同じplace_idの詳細は1回だけ取得し、複数の地点で見つかった店舗は最初の地点にだけ残す
+    on_store_group: 地点ごとの検索が終わるたびに、その結果を受け取る関数
     """
+    indexed = await asyncio.to_thread(indexed_store_groups, search_points)
+    coverage = SearchCoverage(STORE_SEARCH_RADIUS, STORE_SEARCH_MAX_OVERLAP)
+    details_tasks = {}
+
+    def fetch_details(place_id):
+        task = details_tasks.get(place_id)
+        if task is None:
+            task = asyncio.ensure_future(
+                places_executor.submit(
+                    PRIORITY_ENRICHMENT, place_details_cached, place_id
+                )
+            )
+            details_tasks[place_id] = task
+        return task
+
+    async def search(item):
+        item, store_group = item
+        if store_group is None:
+            store_group = await search_stores(item, coverage, fetch_details)
+        if on_store_group is not None:
+            on_store_group(store_group)
+        return store_group
+
     try:
-        # スレッドIDに基づいて履歴を取得
-        current_history = thread_histories[thread_id]
+        stores = await places_executor.map(search, zip(search_points, indexed))
+    finally:
+        # 締め切りなどで打ち切られた場合は、残っている詳細取得も取り消す
+        for task in details_tasks.values():
+            task.cancel()
+
+    seen_place_ids = set()
+    for store_group in stores:
+        unique_stores = []
+        for store in store_group["stores"]:
+            if store["place_id"] in seen_place_ids:
+                continue
+            seen_place_ids.add(store["place_id"])
+            unique_stores.append(store)
+        store_group["stores"] = unique_stores
+    return stores
+
+
+def classify_stores_with_llm(store_names):
+    """
+    店名のリストを生成AIでカテゴリ分類し、同じ順番のカテゴリ番号のリストを返す
+    """
+    with external_call("openai"):
+        response = client.chat.completions.create(
+            model="gpt-4o-mini",
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": CATEGORY_PROMPT},
+                {"role": "user", "content": str(store_names)},
+            ],
+        )
+    return json.loads(response.choices[0].message.content)["result"]
 
-        # 現在の履歴に新しいユーザープロンプトを追加
-        messages = [
-            {
-                "role": "system",
-                "content": """
+
+# place_idごとのカテゴリ分類 (結果はplaces_cacheに保存)
+store_categorizer = StoreCategorizer(
+    places_cache, classify_stores_with_llm, flight=singleflight
+)
+
+# /metrics の出力時にキャッシュのヒット率などを集計する
+# (ベンチマークなどでキャッシュを差し替えた場合も、その時点のキャッシュを集計する)
+observe_cache("places", lambda: places_cache)
+observe_cache("directions", lambda: directions_cache.cache)
+observe_prompt_cache(lambda: prompt_cache)
+observe_singleflight(singleflight)
+observe_scheduler(places_executor, rate_limiter)
+
+
+def route_label(request):
+    """
+    メトリクスのラベルに使うルートのパス (例: /photo/{photo_reference})。どのルートにも合わなければ"unmatched"
+    URLをそのまま使うと、パラメーターや存在しないパスごとに系列が増え続けるため
+    """
+    partial = None
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+
+@app.middleware("http")
+async def instrument_requests(request, call_next):
+    """
+    処理中のリクエスト数・件数・所要時間を記録し、
+    要求があればステージごとの所要時間をServer-Timingヘッダーで返す
+    """
+    path = route_label(request)
+    trace = start_trace()
+    http_requests_in_flight.inc(path=path)
+    started_at = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        http_request_duration.observe(time.perf_counter() - started_at, path=path)
+        http_requests_in_flight.dec(path=path)
+        http_requests.inc(path=path, status=status)
+    if TIMING_HEADER or "x-timing" in request.headers:
+        timing = server_timing(trace)
+        if timing:
+            response.headers["Server-Timing"] = timing
+    return response
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheusのテキスト形式でメトリクスを返す
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """
+    キャッシュのヒット/ミス/追い出し件数を返す
+    """
+    return {
+        "places": places_cache.stats(),
+        "directions": directions_cache.cache.stats(),
+        "categories": store_categorizer.stats(),
+        "singleflight": singleflight.stats(),
+        "prompts": prompt_cache.stats(),
+        "poi_index": poi_index.stats() if poi_index is not None else None,
+    }
+
+
+@app.get("/photo/{photo_reference}")
+async def photo(request: Request, photo_reference: str, size: Optional[int] = None):
+    """
+    お店の写真を返す (sizeを指定した場合は、それ以上の幅の縮小版)
+    一度取得した写真はディスクに保存し、以降はGoogleに問い合わせない
+    """
+    if not PHOTO_REFERENCE_PATTERN.fullmatch(photo_reference):
+        raise HTTPException(status_code=400, detail="Invalid photo reference.")
+    try:
+        digest = await places_executor.submit(
+            PRIORITY_ENRICHMENT, fetch_photo, photo_reference
+        )
+        path, media_type, etag = await asyncio.to_thread(
+            photo_cache.variant, digest, photo_cache.choose_size(size)
+        )
+    except PhotoNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise api_error(e, "Error fetching photo")
+
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={PHOTO_MAX_AGE}, immutable",
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    # ファイルはメモリに読み込まずに送る (サーバーが対応していればzero-copyで送る)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+@app.get("/history/stats")
+async def history_stats():
+    """
+    保持している対話履歴のスレッド数・メッセージ数・サイズを返す
+    """
+    return history_store.stats()
+
+
+def annotate_detours(origin_location, landmark_stops, store_list):
+    """
+    行先候補を巡るルートに各お店を挿入したときの移動時間の増加 (秒) を
+    detour_seconds として各お店に記録する (座標が不明なお店はNone)
+    """
+    origin = coordinates(origin_location)
+    tour = [origin] + [coordinates(loc) for _, loc in landmark_stops] + [origin]
+    located = [
+        i for i, store in enumerate(store_list) if coordinates(store["location"])
+    ]
+    costs = np.full(len(store_list), np.inf)
+    costs[located] = travel_times.insertion_costs(
+        tour, [coordinates(store_list[i]["location"]) for i in located]
+    )
+    for store, cost in zip(store_list, costs):
+        store["detour_seconds"] = None if np.isinf(cost) else round(float(cost))
+
+
+# 行先候補の提案の形式 (Structured Outputsで生成AIの出力をこの形に固定する)
+# nameをresponse_messageより前に置き、名称を先に出力させる
+SUGGESTION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "travel_suggestion",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "result": {
+                    "type": "object",
+                    "properties": {
+                        "region": {"type": "string"},
+                        "name": {"type": "array", "items": {"type": "string"}},
+                        "response_message": {"type": "string"},
+                    },
+                    "required": ["region", "name", "response_message"],
+                    "additionalProperties": False,
+                },
+            },
+            "required": ["result"],
+            "additionalProperties": False,
+        },
+    },
+}
+# 提案の応答をJSONとして読めなかった場合に、生成AIを呼び出す回数の上限 (最初の1回を含む)
+SUGGESTION_MAX_ATTEMPTS = int(os.getenv("SUGGESTION_MAX_ATTEMPTS", "2"))
+
+
+def suggest_locations_with_llm(messages, on_name=None, cancelled=None):
+    """
+    生成AIに旅行先と商業施設の名称を提案させ、応答の本文を返す
+    応答はストリーミングで受け取り、名称が1つ閉じるたびに on_name(番号, 名称) を呼ぶ
+    cancelled (threading.Event) がセットされたら受信をやめる
+    """
+    parser = IncrementalJsonParser()
+    parts = []
+    with external_call("openai"):
+        stream = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            response_format=SUGGESTION_RESPONSE_FORMAT,
+            stream=True,
+        )
+        try:
+            for chunk in stream:
+                if cancelled is not None and cancelled.is_set():
+                    break
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                text = chunk.choices[0].delta.content
+                parts.append(text)
+                for path, value in parser.feed(text):
+                    if on_name is not None and path[:2] == ("result", "name"):
+                        on_name(path[2], value)
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+    return "".join(parts)
+
+
+async def generate_suggestion(run, messages, deadline):
+    """
+    生成AIに行先候補を提案させ、(応答の本文, パースした応答) を返す
+    応答の途中でも、名称が確定するたびに (試行の番号, 番号, 名称) を公開する
+    応答をJSONとして読めなかった場合は、SUGGESTION_MAX_ATTEMPTS回まで生成し直す
+    """
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+
+    def publisher(attempt):
+        def publish(index, name):
+            # 生成AIの応答を受け取るスレッドから呼ばれる
+            if not cancelled.is_set():
+                loop.call_soon_threadsafe(
+                    run.publish, "llm_suggestion", (attempt, index, name)
+                )
+
+        return publish
+
+    # GPT-4 APIを呼び出して応答を生成
+    try:
+        for attempt in range(SUGGESTION_MAX_ATTEMPTS):
+            try:
+                with stage("llm_suggestion"):
+                    gpt_reply = await deadline.run(
+                        "llm_suggestion",
+                        asyncio.to_thread(
+                            suggest_locations_with_llm,
+                            messages,
+                            publisher(attempt),
+                            cancelled,
+                        ),
+                    )
+            except DeadlineExceeded as e:
+                raise api_error(e, "Error generating suggestion")
+
+            # 応答をJSONとしてパース
+            try:
+                return gpt_reply, json.loads(gpt_reply)
+            except json.JSONDecodeError:
+                if attempt + 1 >= SUGGESTION_MAX_ATTEMPTS:
+                    raise
+                logger.warning("Suggestion is not valid JSON, retrying")
+    finally:
+        cancelled.set()
+
+
+# 旅程を生成するパイプライン (各ステージは入力に宣言した上流の結果を受け取る)
+itinerary_graph = StageGraph(inputs=("prompt", "thread_id", "deadline"))
+
+
+async def record_turn(thread_id, prompt, reply):
+    """
+    ユーザーのプロンプトと応答を対話履歴に追加する
+    (SQLiteへの書き込みでイベントループを止めないよう、スレッドで実行する)
+    """
+
+    def append():
+        history_store.append(thread_id, "user", prompt)
+        history_store.append(thread_id, "assistant", reply)
+
+    await asyncio.to_thread(append)
+
+
+@itinerary_graph.stage("llm_suggestion", inputs=("prompt", "thread_id", "deadline"))
+async def llm_suggestion_stage(run, prompt, thread_id, deadline):
+    """
+    生成AIに行先候補を提案させ、その名称のリストを返す
+    同じ履歴でほぼ同じプロンプトの提案がキャッシュにあれば、生成AIを呼ばずにそれを使う
+    """
+    # スレッドIDに基づいて、トークン数の上限に収まる直近の履歴を取得
+    current_history = await asyncio.to_thread(history_store.window, thread_id)
+
+    # 現在の履歴に新しいユーザープロンプトを追加
+    messages = [
+        {
+            "role": "system",
+            "content": """
 #設定
 あなたは旅行先を提案するアシスタントです。
 入力された雰囲気から、まず旅行先の日本の地域（都道府県）を決定し、そこの商業施設の名称を挙げてください。
@@ -290,309 +1197,699 @@ async def generate_response(prompt: str, thread_id: str = Query(default="default
 "name":["<name>","<name>","<name>",],
 "response_message":"<response_message>"}
 """,
-            }
-        ]
-        messages.extend(current_history)
-        messages.append({"role": "user", "content": prompt})
-
-        # GPT-4 APIを呼び出して応答を生成
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-        )
-
-        # 応答内容を取得
-        gpt_reply = response.choices[0].message.content
-        # print(gpt_reply)
-
-        # 対話履歴を更新
-        thread_histories[thread_id].append({"role": "user", "content": prompt})
-        thread_histories[thread_id].append({"role": "assistant", "content": gpt_reply})
+        }
+    ]
+    messages.extend(current_history)
+    messages.append({"role": "user", "content": prompt})
 
-        # 応答をJSONとしてパース
+    history = history_key(current_history)
+    gpt_reply = prompt_cache.get(prompt, history, "suggestion")
+    if gpt_reply is not None:
         suggestion = json.loads(gpt_reply)
-        location_names = suggestion["result"]["name"]
-        print(location_names)
-        # print(suggestion["result"]["response_message"])
-        response_message = suggestion["result"]["response_message"]
+        for index, name in enumerate(suggestion["result"]["name"]):
+            run.publish("llm_suggestion", (0, index, name))
+    else:
+        gpt_reply, suggestion = await generate_suggestion(run, messages, deadline)
+        if suggestion["result"]["name"]:
+            # 深掘りの質問 (候補なし) は会話の流れに依存するため保存しない
+            prompt_cache.put(prompt, history, "suggestion", gpt_reply)
+
+    # 対話履歴を更新
+    await record_turn(thread_id, prompt, gpt_reply)
+
+    location_names = suggestion["result"]["name"]
+    logger.debug("Suggested locations: %s", location_names)
+    run.emit(
+        "message",
+        {
+            "response_message": suggestion["result"]["response_message"],
+            "region": suggestion["result"].get("region"),
+            "names": location_names,
+        },
+    )
+    return location_names
+
+
+@itinerary_graph.stage("find_place", inputs=("deadline",), streams=("llm_suggestion",))
+async def find_place_stage(run, deadline):
+    """
+    各行先候補の座標を並列に取得する (結果の順番はllm_suggestionと同じ)
+    生成AIの応答が終わるのを待たず、名称が確定した候補から取得を始める
+    取得できた候補から順に (番号, 候補) を公開する (生成し直した場合は最新の試行の番号)
+    """
+    lookups = {}
+    published = set()
+    latest = None
+
+    def lookup(name):
+        if name not in lookups:
+            lookups[name] = asyncio.ensure_future(find_location(name))
+        return lookups[name]
+
+    def publish(attempt, index, task):
+        if task.cancelled() or task.exception() is not None:
+            return
+        if attempt == latest and index not in published:
+            published.add(index)
+            run.publish("find_place", (index, task.result()))
+
+    async def locate_all():
+        nonlocal latest
+        async for attempt, index, name in run.stream("llm_suggestion"):
+            if attempt != latest:
+                latest = attempt
+                published.clear()
+            lookup(name).add_done_callback(
+                lambda task, attempt=attempt, index=index: publish(attempt, index, task)
+            )
+        names = await run.wait("llm_suggestion")
+        tasks = [lookup(name) for name in names]
+        await asyncio.gather(*tasks)
+        for index, task in enumerate(tasks):
+            publish(latest, index, task)
+        return [task.result() for task in tasks]
 
-        # 各location_nameの座標を取得
-        locations = []
-        try:
-            for name in location_names:
-                # Google Places APIで場所の詳細情報を取得
-                place_results = gmaps.find_place(
-                    input=name,
-                    input_type="textquery",
-                    fields=["geometry", "formatted_address", "photos"],
-                )
-                if place_results.get("candidates"):
-                    location_data = place_results["candidates"][0]
-
-                    # 写真のリファレンスを取得
-                    photo_reference = None
-                    photos = location_data.get("photos", [])
-                    if photos:
-                        photo_reference = photos[0].get("photo_reference")
-
-                    # # 写真のURLを生成
-                    photo_url = (
-                        f"https://maps.googleapis.com/maps/api/place/photo"
-                        f"?maxwidth=400&photoreference={photo_reference}&key={GOOGLE_MAPS_API_KEY}"
-                        if photo_reference
-                        else None
-                    )
+    try:
+        with stage("find_place"):
+            locations = await deadline.run("find_place", locate_all())
+    except Exception as e:
+        raise api_error(e, "Error fetching nearby location")
+    finally:
+        # 生成し直す前の試行にしかない候補の取得などは待たない
+        for task in lookups.values():
+            task.cancel()
+    run.emit("locations", locations)
+    return locations
 
-                    # 署名付きURLを生成
-                    # photo_url = None
-                    # if photo_reference:
-                    #     # ここで署名付きURLを生成（Google Cloud Storageを利用）
-                    #     bucket_name = "your-google-cloud-bucket-name"  # バケット名
-                    #     object_name = f"photos/{photo_reference}"  # オブジェクト名
-                    #     # 署名付きURLを生成
-                    #     photo_url = generate_signed_url(bucket_name, object_name)
-
-                    # `locations`に情報を追加
-                    locations.append(
-                        {
-                            "name": name,
-                            "address": location_data.get(
-                                "formatted_address", "住所不明"
-                            ),
-                            "location": location_data.get("geometry", {}).get(
-                                "location", {}
-                            ),
-                            "photo": photo_url,
-                        }
-                    )
-                else:
-                    # 場所が見つからなかった場合のデフォルト値
-                    locations.append(
-                        {
-                            "name": name,
-                            "address": "住所不明",
-                            "location": {},
-                            "photo": None,
-                        }
-                    )
 
-            # Google Maps Directions APIを使用してルート計算
-            if len(location_names) < 2:
-                raise HTTPException(
-                    status_code=400,
-                    detail="At least two locations are required for routing.",
-                )
-            # 出発地の最寄り駅を取得
-            nearest_station = get_nearest_station(
-                locations[0]["location"]["lat"], locations[0]["location"]["lng"]
-            )
-            origin = nearest_station["name"]
-            destination = nearest_station["name"]  # ゴールも同じ駅
-            print("出発地: ", nearest_station["name"])
-
-            departure_time = datetime.now()
-            # directions_result = gmaps.directions(
-            #     origin=origin,  # 出発地
-            #     destination=destination,  # 最終目的地
-            #     waypoints=location_names,  # 経由地
-            #     mode="driving",
-            #     departure_time=departure_time,
-            #     optimize_waypoints=True,
-            # )
-
-            directions_result = get_directions_api_response(
-                api_key=GOOGLE_MAPS_API_KEY,
-                origin=origin,
-                destination=destination,
-                waypoints=location_names,
-                departure_time="now",
+@itinerary_graph.stage(
+    "get_nearest_station", inputs=("deadline",), streams=("find_place",)
+)
+async def nearest_station_stage(run, deadline):
+    """
+    出発地 (最初の行先候補) の最寄り駅を取得する
+    他の行先候補の座標や生成AIの応答の終わりを待たず、最初の行先候補の座標が分かった時点で始める
+    """
+
+    async def station_of(first_location):
+        with stage("get_nearest_station"):
+            return await deadline.run(
+                "get_nearest_station",
+                places_executor.run(
+                    get_nearest_station,
+                    first_location["location"]["lat"],
+                    first_location["location"]["lng"],
+                ),
             )
 
-            # directions_result = json.loads(
-            #     get_directions_api_response(
-            #         api_key=GOOGLE_MAPS_API_KEY,
-            #         origin=location_names[0],
-            #         destination=location_names[-1],
-            #         waypoints=location_names[1:-1],
-            #         departure_time="now",
-            #     )
-            # )
-            # print(directions_result)
-            """
-            Google Places APIを使用して、行先候補周辺のECサイトを持つお店を取得
-            """
-            lat_lng_list = extract_lat_lng(directions_result)
-            # for item in lat_lng_list:
-            #     print(item)
-        except Exception as e:
+    try:
+        first_location = nearest_station = None
+        async for index, location in run.stream("find_place"):
+            if index == 0:
+                first_location = location
+                # 出発地の最寄り駅を取得
+                nearest_station = await station_of(first_location)
+                break
+        # 座標の取得に失敗した場合は、find_placeの例外が送出される
+        locations = await run.wait("find_place")
+        # Google Maps Directions APIを使用してルート計算
+        if len(locations) < 2:
             raise HTTPException(
-                status_code=500, detail=f"Error fetching nearby location: {str(e)}"
+                status_code=400,
+                detail="At least two locations are required for routing.",
             )
-        stores = []
-        print("extract_lat_lng済")
-        try:
-            for item in lat_lng_list[::3]:
-                location = (item["lat"], item["lng"])  # location=(latitude, longitude)
-                print(f"Searching nearby stores for location: {location}")
-
-                # Google Places APIを使って周辺の店舗を検索
-                places_result = gmaps.places_nearby(
-                    location=location,
-                    radius=100,
-                    type="store",  # 店舗タイプを指定
+        if locations[0] is not first_location:
+            # 生成し直したことで出発地が変わった場合は取り直す
+            nearest_station = await station_of(locations[0])
+    except Exception as e:
+        raise api_error(e, "Error fetching nearby location")
+    logger.debug("出発地: %s", nearest_station["name"])
+    # イベントは locations → station の順に返す
+    run.emit("station", nearest_station)
+    return nearest_station
+
+
+@itinerary_graph.stage(
+    "route_optimization", inputs=("find_place", "get_nearest_station")
+)
+async def route_optimization_stage(run, find_place, get_nearest_station):
+    """
+    行先候補の訪問順をローカルで決める (座標が不明な候補がある場合はNone)
+    """
+    with stage("route_optimization"):
+        return order_waypoints(
+            get_nearest_station["location"],
+            [(loc["name"], loc["location"]) for loc in find_place],
+        )
+
+
+@itinerary_graph.stage(
+    "first_directions",
+    inputs=("llm_suggestion", "get_nearest_station", "route_optimization", "deadline"),
+)
+async def first_directions_stage(
+    run, llm_suggestion, get_nearest_station, route_optimization, deadline
+):
+    """
+    行先候補を巡るルートを取得し、(ルート, 経由地の名前のリスト) を返す
+    締め切りに間に合わない場合は、このルートをお店なしで返す
+    """
+    origin = get_nearest_station["name"]
+    destination = get_nearest_station["name"]  # ゴールも同じ駅
+    try:
+        with stage("first_directions"):
+            if route_optimization is not None:
+                landmark_names = [name for name, _ in route_optimization]
+                directions_result = await deadline.run(
+                    "first_directions",
+                    places_executor.run(
+                        get_ordered_directions,
+                        origin=origin,
+                        destination=destination,
+                        waypoints=landmark_names,
+                        departure_time="now",
+                    ),
                 )
+            else:
+                # 座標が不明な行先候補がある場合は、Directions APIに訪問順を任せる
+                landmark_names = llm_suggestion
+                directions_result = await deadline.run(
+                    "first_directions",
+                    places_executor.run(
+                        get_directions_cached,
+                        origin=origin,
+                        destination=destination,
+                        waypoints=llm_suggestion,
+                        departure_time="now",
+                    ),
+                )
+    except Exception as e:
+        raise api_error(e, "Error fetching nearby location")
+    return directions_result, landmark_names
 
-                # ECサイトを持つ店舗をフィルタリング
-                stores_with_websites = []
-                try:
-                    for place in places_result.get("results", []):
-                        place_details = gmaps.place(place_id=place["place_id"])
-                        website = place_details.get("result", {}).get("website")
-
-                        # お店の画像URLを取得
-                        photo_reference = None
-                        photos = place_details.get("result", {}).get("photos", [])
-                        if photos:
-                            photo_reference = photos[0].get("photo_reference")
-
-                        # 画像URLを構築
-                        photo_url = (
-                            f"https://maps.googleapis.com/maps/api/place/photo"
-                            f"?maxwidth=400&photoreference={photo_reference}&key={GOOGLE_MAPS_API_KEY}"
-                            if photo_reference
-                            else None
-                        )
-
-                        if website:
-                            if "convenience_store" not in place_details["result"].get(
-                                "types", "不明"
-                            ):
-
-                                stores_with_websites.append(
-                                    {
-                                        "name": place_details["result"].get(
-                                            "name", "不明な店舗"
-                                        ),
-                                        "website": website,
-                                        "address": place_details["result"].get(
-                                            "formatted_address", "住所不明"
-                                        ),
-                                        "rating": place_details["result"].get(
-                                            "rating", "評価なし"
-                                        ),
-                                        "location": place_details["result"]
-                                        .get("geometry", {})
-                                        .get("location", {}),
-                                        "photo": photo_url,
-                                        "types": place_details["result"].get(
-                                            "types", "不明"
-                                        ),
-                                    }
-                                )
-                    ###
-                    # ECサイトのカテゴライズをstructure defineで生成AIによりfood、playingなどにカテゴライズして返却する
-                    # 画像はBase64変換
-                    ##
-                except:
-                    pass
-
-                # 結果を追加
-                stores.append({"location": location, "stores": stores_with_websites})
-            # print(stores)
-        except Exception as e:
-            raise HTTPException(
-                status_code=500, detail=f"Error fetching nearby stores: {str(e)}"
-            )
 
-        try:
-            # お店の名前を抽出してリストに格納する
-            store_names = []
-            store_list = []
-            # for store_group in stores:
-            #     if "stores" in store_group:
-            #         for store in store_group["stores"]:
-            #             store_names.append(store["name"])
-            for store_group in stores:
-                print(store_group)
-                for store in store_group["stores"]:
-                    store_list.append(store)
-                    store_names.append(store["name"])
-
-            # 結果を表示
-            print(store_names)
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                response_format={"type": "json_object"},
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
-        #設定
-        入力された店名に対し、以下の法則で順番ごとにカテゴリの番号を付けてください。番号は最も適したものを一つつけてください。
-
-        Japanese sweets shop: 1
-        Food Shops: 2
-        Souvenir Shops: 3
-        Dining & Drinking: 4
-        Activity Shops: 5
-        Other Retail Shops: 6
-
-        #入力
-        [<店名>,<店名>,<店名>]
-
-        #json 出力
-        {"result":["<num>","<num>","<num>",]}
-        """,
-                    },
-                    {"role": "user", "content": str(store_names)},
-                ],
+@itinerary_graph.stage("extract_lat_lng", inputs=("first_directions",))
+async def search_points_stage(run, first_directions):
+    """
+    Google Places APIでお店を検索する地点を、ルートに沿って選ぶ
+    """
+    directions_result, _ = first_directions
+    try:
+        with stage("extract_lat_lng"):
+            # ポリラインに沿って等間隔に検索地点を選ぶ
+            search_points = sample_search_points(
+                directions_result,
+                radius=STORE_SEARCH_RADIUS,
+                spacing=STORE_SEARCH_SPACING,
+                max_overlap=STORE_SEARCH_MAX_OVERLAP,
+                max_points=STORE_SEARCH_MAX_POINTS,
             )
-            categories = json.loads(response.choices[0].message.content)
-            print(categories)
-            additional_way_point = []
-            # お店の情報をペアとして作成
-            stores = list(zip(store_names, categories["result"]))
+            if not search_points:
+                # ポリラインが含まれない場合は各stepの始点・終点を使う
+                search_points = extract_lat_lng(directions_result)[::3]
+    except Exception as e:
+        raise api_error(e, "Error fetching nearby location")
+    logger.debug("Search points: %d", len(search_points))
+    return search_points
 
-            # ピックアップ実行
-            selected_stores, store_list = pick_stores(stores, store_list)
-            print(selected_stores)
-            visit_location = location_names + selected_stores
 
-        except Exception as e:
-            raise HTTPException(
-                status_code=500, detail=f"Error fetching nearby select_stores: {str(e)}"
+@itinerary_graph.stage("store_scan", inputs=("extract_lat_lng", "deadline"))
+async def store_scan_stage(run, extract_lat_lng, deadline):
+    """
+    周辺検索→詳細取得を地点ごとのパイプラインとして並列に実行し、見つかったお店を返す
+    見つかったお店は地点ごとに (重複を除いて) すぐに公開する
+    """
+    # 分類と最終ルートの時間を残して、お店を検索できる時間
+    scan_reserve_ms = DEADLINE_CATEGORIZATION_RESERVE_MS + DEADLINE_FINAL_RESERVE_MS
+    if deadline.expired(scan_reserve_ms):
+        deadline.skip("store_scan")
+        return []
+
+    found_groups = asyncio.Queue()
+    scan = asyncio.ensure_future(
+        scan_stores(extract_lat_lng, on_store_group=found_groups.put_nowait)
+    )
+    streamed = {}
+    try:
+        with stage("store_scan"):
+            while not (scan.done() and found_groups.empty()):
+                next_group = asyncio.ensure_future(found_groups.get())
+                await asyncio.wait(
+                    {next_group, scan},
+                    timeout=deadline.remaining(scan_reserve_ms),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not next_group.done():
+                    next_group.cancel()
+                    if not scan.done() and deadline.expired(scan_reserve_ms):
+                        # 締め切りが近いため、それまでに見つかったお店で続ける
+                        deadline.skip("store_scan", "partial")
+                        return list(streamed.values())
+                    continue
+                store_group = next_group.result()
+                new_stores = [
+                    store
+                    for store in store_group["stores"]
+                    if store["place_id"] not in streamed
+                ]
+                streamed.update((store["place_id"], store) for store in new_stores)
+                if new_stores:
+                    found = {"location": store_group["location"], "stores": new_stores}
+                    run.publish(
+                        "store_scan",
+                        dict(found, categories=store_group.get("categories", {})),
+                    )
+                    run.emit("stores", found)
+            stores = scan.result()
+    except Exception as e:
+        raise api_error(e, "Error fetching nearby stores")
+    finally:
+        scan.cancel()
+
+    # 検索地点の順番に並べる (下流で公開済みのお店に書き込んだ結果を使うため、同じものを返す)
+    store_list = [
+        streamed[store["place_id"]]
+        for store_group in stores
+        for store in store_group["stores"]
+    ]
+    logger.debug("Stores found: %s", [store["name"] for store in store_list])
+    return store_list
+
+
+@itinerary_graph.stage("category_lookup", streams=("store_scan",))
+async def category_lookup_stage(run):
+    """
+    見つかったお店から順に、キャッシュ・ルールで分かるカテゴリを先に調べておく
+    (索引から見つかったお店は、索引に保存したカテゴリを使う)
+    """
+    known = {}
+    async for store_group in run.stream("store_scan"):
+        known.update(store_group["categories"])
+        unknown = [s for s in store_group["stores"] if s["place_id"] not in known]
+        known.update(await asyncio.to_thread(store_categorizer.lookup, unknown))
+    return known
+
+
+@itinerary_graph.stage(
+    "detour_costs",
+    inputs=("get_nearest_station", "route_optimization"),
+    streams=("store_scan",),
+)
+async def detour_costs_stage(run, get_nearest_station, route_optimization):
+    """
+    見つかったお店から順に、ルートからの寄り道の時間を求める
+    """
+    if route_optimization is None:
+        return
+    async for store_group in run.stream("store_scan"):
+        with stage("detour_costs"):
+            annotate_detours(
+                get_nearest_station["location"],
+                route_optimization,
+                store_group["stores"],
             )
 
-        try:
-            print(location_names + selected_stores)
-            directions_result = get_directions_api_response(
-                api_key=GOOGLE_MAPS_API_KEY,
-                origin=origin,
-                destination=destination,
-                waypoints=visit_location,
-                departure_time="now",
+
+@itinerary_graph.stage(
+    "categorization", inputs=("store_scan", "category_lookup", "deadline")
+)
+async def categorization_stage(run, store_scan, category_lookup, deadline):
+    """
+    キャッシュ・ルールで分類できないお店だけを生成AIで分類する
+    バッチ処理では、他のプロンプトのお店とまとめて生成AIに送る
+    """
+    batch = current_batch()
+    llm_classify = batch.classifier.classify if batch is not None else None
+    try:
+        with stage("categorization"):
+            try:
+                categories = await deadline.run(
+                    "categorization",
+                    asyncio.to_thread(
+                        store_categorizer.categorize,
+                        store_scan,
+                        known=category_lookup,
+                        llm_classify=llm_classify,
+                    ),
+                    reserve_ms=DEADLINE_FINAL_RESERVE_MS,
+                )
+            except DeadlineExceeded:
+                # 生成AIの分類を待たず、キャッシュ・ルールで分類できたものだけを使う
+                # 打ち切ったスレッドの生成AIの呼び出しは止めずに最後まで実行させる
+                # (結果はplace_idごとにキャッシュされ、同じお店を含む次のリクエストで使われる)
+                categories = await asyncio.to_thread(
+                    store_categorizer.categorize,
+                    store_scan,
+                    use_llm=False,
+                    known=category_lookup,
+                )
+                if store_scan:
+                    deadline.skip("categorization", "partial")
+    except Exception as e:
+        raise api_error(e, "Error fetching nearby select_stores")
+    logger.debug("Store categories: %s", categories)
+    return categories
+
+
+@itinerary_graph.stage(
+    "select_stores", inputs=("store_scan", "categorization", "detour_costs")
+)
+async def select_stores_stage(run, store_scan, categorization, detour_costs):
+    """
+    評価・レビュー数・寄り道の少なさ・カテゴリの多様さから立ち寄るお店を選ぶ
+    """
+    try:
+        with stage("select_stores"):
+            selected_stores, store_list = select_stores(
+                store_scan, categorization, seed=STORE_SELECTION_SEED
             )
-            print(directions_result)
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error fetching nearby final_directions_result: {str(e)}",
+    except Exception as e:
+        raise api_error(e, "Error fetching nearby select_stores")
+    logger.debug("Selected stores: %s", selected_stores)
+    return store_list
+
+
+@itinerary_graph.stage(
+    "visit_order",
+    inputs=("llm_suggestion", "find_place", "get_nearest_station", "select_stores"),
+)
+async def visit_order_stage(
+    run, llm_suggestion, find_place, get_nearest_station, select_stores
+):
+    """
+    行先候補と選んだお店の訪問順をローカルで決め、(順番を決めたか, 経由地の名前のリスト) を返す
+    """
+    with stage("route_optimization"):
+        visit_stops = order_waypoints(
+            get_nearest_station["location"],
+            [(loc["name"], loc["location"]) for loc in find_place]
+            + [(store["name"], store["location"]) for store in select_stores],
+        )
+    if visit_stops is None:
+        return False, llm_suggestion + [store["name"] for store in select_stores]
+    return True, [name for name, _ in visit_stops]
+
+
+@itinerary_graph.stage(
+    "final_directions",
+    inputs=(
+        "get_nearest_station",
+        "first_directions",
+        "select_stores",
+        "visit_order",
+        "deadline",
+    ),
+)
+async def final_directions_stage(
+    run, get_nearest_station, first_directions, select_stores, visit_order, deadline
+):
+    """
+    行先候補と選んだお店を巡るルートを取得する
+    """
+    ordered, visit_location = visit_order
+    store_list = select_stores
+    try:
+        with stage("final_directions"):
+            directions_result = await deadline.run(
+                "final_directions",
+                places_executor.run(
+                    get_ordered_directions if ordered else get_directions_cached,
+                    origin=get_nearest_station["name"],
+                    destination=get_nearest_station["name"],
+                    waypoints=visit_location,
+                    departure_time="now",
+                ),
             )
+        logger.debug("Final directions: %s", directions_result)
+    except DeadlineExceeded:
+        # 締め切りに間に合わない場合は、行先候補だけのルートを返す
+        logger.info("Final directions skipped by deadline")
+        deadline.skip("final_directions")
+        directions_result, visit_location = first_directions
+        store_list = []
+    except Exception as e:
+        raise api_error(e, "Error fetching nearby final_directions_result")
 
-        return {
-            "response_message": response_message,
+    run.emit(
+        "route",
+        {
             "route": directions_result,
-            "location_names": locations,
             "stores": store_list,
             "waypoints": visit_location,
-            "station": nearest_station,
-        }
+            "skipped": deadline.skipped,
+        },
+    )
+
+
+async def itinerary_events(prompt, thread_id, deadline=None):
+    """
+    旅程を生成するパイプラインを実行し、各ステージが終わるたびに (イベント名, データ) を返す
+    イベントは message → locations → station → stores (複数回) → route の順
+    deadline: 締め切り。時間が足りない場合はお店の検索・分類・最終ルートを省略し、
+              省略したステージをrouteイベントのskippedで返す
+    """
+    if deadline is None:
+        deadline = Deadline()
+    run = itinerary_graph.run(
+        {"prompt": prompt, "thread_id": thread_id, "deadline": deadline}
+    )
+    try:
+        async for event in run.events():
+            yield event
+    finally:
+        # 所要時間を決めたステージの経路を記録する
+        path = run.critical_path()
+        for name in path:
+            critical_path_stages.inc(stage=name)
+        trace = current_trace()
+        if trace is not None:
+            trace.critical_path = path
+        logger.debug("Critical path: %s", " -> ".join(path))
+
+
+def suggestion_reply(message):
+    """
+    messageイベントのデータから、生成AIの応答と同じ形のJSONを作る (対話履歴に使う)
+    """
+    return json.dumps(
+        {
+            "result": {
+                "region": message["region"],
+                "name": message["names"],
+                "response_message": message["response_message"],
+            }
+        },
+        ensure_ascii=False,
+    )
+
+
+def compact_event(event, data):
+    """
+    イベントのデータを、フロントエンドが使う項目だけに絞る
+    """
+    if event == "route":
+        return dict(
+            data,
+            route=compact_route(data["route"]),
+            stores=compact_stores(data["stores"]),
+        )
+    if event == "stores":
+        return dict(data, stores=compact_stores(data["stores"]))
+    return data
+
+
+def json_response(request, data):
+    """
+    dataを高速なJSONエンコーダーで変換し、クライアントが対応していれば圧縮して返す
+    """
+    body, encoding = encode_body(dumps(data), request.headers.get("accept-encoding"))
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+
+async def itinerary_response(
+    prompt, thread_id="default", deadline_ms=None, compact=False
+):
+    """
+    旅程を生成し、generate_responseのレスポンスの内容を返す
+    compact=True の場合は、ルートとお店をフロントエンドが使う項目だけに絞る
+    PROMPT_CACHE_ITINERARY=1 の場合は、ほぼ同じプロンプトの旅程をキャッシュから返す
+    """
+    deadline = Deadline(deadline_ms)
+    try:
+        cached = history = None
+        if PROMPT_CACHE_ITINERARY:
+            history = history_key(
+                await asyncio.to_thread(history_store.window, thread_id)
+            )
+            cached = prompt_cache.get(prompt, history, "itinerary")
+
+        if cached is not None:
+            reply, response = cached
+            await record_turn(thread_id, prompt, reply)
+        else:
+            events = {}
+            async for event, data in itinerary_events(prompt, thread_id, deadline):
+                if event != "stores":
+                    events[event] = data
+
+            response = {
+                "response_message": events["message"]["response_message"],
+                "route": events["route"]["route"],
+                "location_names": events["locations"],
+                "stores": events["route"]["stores"],
+                "waypoints": events["route"]["waypoints"],
+                "station": events["station"],
+                "skipped": events["route"]["skipped"],
+            }
+            if PROMPT_CACHE_ITINERARY and not response["skipped"]:
+                # 締め切りで省略したステージがある旅程は保存しない
+                prompt_cache.put(
+                    prompt,
+                    history,
+                    "itinerary",
+                    (suggestion_reply(events["message"]), response),
+                    ttl=PROMPT_CACHE_ITINERARY_TTL,
+                )
+
+        if compact:
+            response = dict(
+                response,
+                route=compact_route(response["route"]),
+                stores=compact_stores(response["stores"]),
+            )
+        return response
 
     except json.JSONDecodeError:
         raise HTTPException(
             status_code=400, detail="Invalid JSON format in GPT response."
         )
     except Exception as e:
+        if isinstance(e, HTTPException) and e.status_code in (503, 504):
+            # 過負荷・締め切り超過の場合はそのまま返し、クライアントに再試行させる
+            raise
         raise HTTPException(
             status_code=500, detail=f"Error processing request: {str(e)}"
         )
+
+
+@app.post("/generate_response")
+async def generate_response(
+    request: Request,
+    prompt: str,
+    thread_id: str = Query(default="default"),
+    deadline_ms: Optional[int] = None,
+    compact: bool = False,
+):
+    """
+    ユーザーからのプロンプトに対して、GPT-4を用いて回答を生成し、過去の対話履歴を保持
+    deadline_ms: 応答までの締め切り (ミリ秒)。間に合わないステージは省略し、skippedで返す
+    compact: ルート (stepsを除く) とお店をフロントエンドが使う項目だけに絞って返す
+    """
+    return json_response(
+        request, await itinerary_response(prompt, thread_id, deadline_ms, compact)
+    )
+
+
+def new_batch_context(concurrency=BATCH_CONCURRENCY):
+    """
+    バッチ内で共有する分類のまとめ役と検索済みの範囲を作る
+    """
+    return BatchContext(
+        classify_stores_with_llm,
+        coverage=SearchCoverage(STORE_SEARCH_RADIUS, STORE_SEARCH_MAX_OVERLAP),
+        concurrency=concurrency,
+    )
+
+
+async def batch_item_response(item, deadline_ms=None, compact=False):
+    return await itinerary_response(
+        item["prompt"], item["thread_id"], deadline_ms=deadline_ms, compact=compact
+    )
+
+
+@app.post("/generate_response/batch")
+async def generate_response_batch(request: BatchRequest):
+    """
+    複数のプロンプトの旅程をまとめて生成し、終わった順にNDJSONで返す
+    各行は {"index", "thread_id", "result"} (失敗した場合は "error")
+    キャッシュ・周辺検索の結果・生成AIによるお店の分類はバッチ全体で共有する
+    """
+    items = [{"prompt": prompt, "thread_id": None} for prompt in request.prompts]
+    items += [
+        {"prompt": item.prompt, "thread_id": item.thread_id} for item in request.items
+    ]
+    if not items:
+        raise HTTPException(status_code=400, detail="No prompts in batch.")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many prompts in batch (max {BATCH_MAX_ITEMS}).",
+        )
+    concurrency = min(request.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY)
+    context = new_batch_context(concurrency)
+
+    async def lines():
+        async for record in run_batch(
+            items,
+            lambda item: batch_item_response(
+                item, request.deadline_ms, request.compact
+            ),
+            context,
+            concurrency,
+        ):
+            yield to_ndjson(record)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def format_sse(event, data):
+    """
+    Server-Sent Events 形式の1イベント分の文字列を作る
+    """
+    return f"event: {event}\ndata: {dumps(data).decode('utf-8')}\n\n"
+
+
+@app.api_route("/generate_response/stream", methods=["GET", "POST"])
+async def generate_response_stream(
+    prompt: str,
+    thread_id: str = Query(default="default"),
+    deadline_ms: Optional[int] = None,
+    compact: bool = False,
+):
+    """
+    generate_responseのストリーミング版
+    各ステージの結果が揃い次第、Server-Sent Eventsとして送信する
+    """
+    deadline = Deadline(deadline_ms)
+
+    async def event_stream():
+        try:
+            async for event, data in itinerary_events(prompt, thread_id, deadline):
+                yield format_sse(event, compact_event(event, data) if compact else data)
+        except json.JSONDecodeError:
+            yield format_sse(
+                "error",
+                {"status_code": 400, "detail": "Invalid JSON format in GPT response."},
+            )
+            return
+        except HTTPException as e:
+            yield format_sse(
+                "error", {"status_code": e.status_code, "detail": e.detail}
+            )
+            return
+        except Exception as e:
+            yield format_sse(
+                "error",
+                {"status_code": 500, "detail": f"Error processing request: {str(e)}"},
+            )
+            return
+        yield format_sse("done", {})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# backendディレクトリ (tool パッケージと decide_visit_sight) を読み込めるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# decide_visit_sight は外部APIの代わりに合成データを使い、キャッシュは一時ディレクトリに置く
+os.environ.setdefault("EXTERNAL_API_MODE", "synthetic")
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp(prefix="itinerary-tests-"))
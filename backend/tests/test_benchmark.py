@@ -0,0 +1,45 @@
+import pytest
+
+from tool import benchmark
+
+
+@pytest.fixture
+def app():
+    return benchmark.load_app()
+
+
+def test_reset_caches_drops_prompts_and_similar_matching(app):
+    app.prompt_cache.put("ベンチマーク timing 0 0", 0, "suggestion", "cached")
+    benchmark.reset_caches(app)
+
+    assert app.prompt_cache.get("ベンチマーク timing 0 0", 0, "suggestion") is None
+    app.prompt_cache.put("ベンチマーク timing 0 0", 0, "suggestion", "cached")
+    assert app.prompt_cache.get("ベンチマーク timing 0 1", 0, "suggestion") is None
+
+
+def test_scenarios_do_not_share_history(app):
+    benchmark.reset_caches(app)
+    scenario = {"landmarks": 2, "spread": 1000, "stores": 3, "users": 1}
+    for stores in (3, 4):
+        benchmark.run_scenario(
+            app, dict(scenario, stores=stores), 1, latency_ms=0, cold=False
+        )
+
+    # 各スレッドは1往復 (ユーザーとアシスタントの2件) だけを持つ
+    threads = app.history_store._threads
+    assert len(threads) == 4
+    assert all(len(app.history_store.messages(t)) == 2 for t in list(threads))
+
+
+def test_reset_caches_rebinds_every_user_of_the_places_cache(app):
+    from tool.metrics import cache_misses, registry
+
+    benchmark.reset_caches(app)
+
+    assert app.travel_times.cache is app.places_cache
+    assert app.store_categorizer.cache is app.places_cache
+    # /metrics は差し替えた後のキャッシュを集計する
+    for i in range(3):
+        app.places_cache.get("benchmark-test", str(i))
+    registry.render()
+    assert cache_misses._values[("places",)] == app.places_cache.stats()["misses"] == 3
@@ -0,0 +1,20 @@
+import pytest
+
+from tool.categorizer import classify_locally
+
+
+@pytest.mark.parametrize(
+    "store, category",
+    [
+        ({"name": "喫茶ひだまり", "types": ["cafe", "food"]}, "4"),
+        ({"name": "和菓子処 末富", "types": ["cafe", "food"]}, "1"),
+        ({"name": "抹茶スイーツ 祇園", "types": ["cafe", "food"]}, None),
+        ({"name": "茶寮 都路里", "types": ["cafe", "food"]}, None),
+        ({"name": "Sweets Lab", "types": ["cafe"]}, None),
+        ({"name": "ベーカリーカフェ", "types": ["cafe", "bakery", "food"]}, None),
+        ({"name": "パン工房", "types": ["bakery", "food"]}, "2"),
+        ({"name": "抹茶スイーツ 祇園", "types": ["restaurant", "food"]}, "4"),
+    ],
+)
+def test_sweets_looking_cafes_are_left_to_the_llm(store, category):
+    assert classify_locally(store) == category
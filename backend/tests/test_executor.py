@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from tool.executor import BlockingExecutor
+
+
+async def wait_for_idle(semaphore, capacity, timeout=10):
+    """
+    スレッドの処理が全て終わり、枠が戻るまで待つ
+    """
+    deadline = time.monotonic() + timeout
+    while semaphore._value < capacity and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+
+def test_slots_survive_cancelled_submits():
+    executor = BlockingExecutor(concurrency=2)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        calls = [
+            asyncio.wait_for(
+                executor.submit(i % 2, time.sleep, 0.005), timeout=0.001 * (i % 7)
+            )
+            for i in range(200)
+        ]
+        await asyncio.gather(*calls, return_exceptions=True)
+        semaphore = executor._semaphore(loop)
+        await wait_for_idle(semaphore, executor.concurrency)
+        # 枠が全て戻っていれば、次の呼び出しはすぐに実行される
+        assert await asyncio.wait_for(executor.run(lambda: "ok"), timeout=1) == "ok"
+        return semaphore
+
+    semaphore = asyncio.run(scenario())
+    executor.shutdown()
+    assert semaphore._value == executor.concurrency
+    assert semaphore.waiting() == 0
+
+
+def test_slots_survive_deadline_cancelled_requests(monkeypatch):
+    app = pytest.importorskip("decide_visit_sight")
+    monkeypatch.setenv("REPLAY_LATENCY_MS_FIND_PLACE", "20")
+    monkeypatch.setenv("REPLAY_LATENCY_MS_PLACES_NEARBY", "20")
+    monkeypatch.setenv("REPLAY_LATENCY_MS_PLACE", "10")
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        requests = [
+            app.itinerary_response(
+                f"締め切りテスト {i}",
+                thread_id=f"deadline-{i}",
+                deadline_ms=30 + 15 * i,
+            )
+            for i in range(40)
+        ]
+        results = await asyncio.gather(*requests, return_exceptions=True)
+        semaphore = app.places_executor._semaphore(loop)
+        await wait_for_idle(semaphore, app.places_executor.concurrency)
+        return semaphore, results
+
+    semaphore, results = asyncio.run(scenario())
+    # 締め切りで打ち切られた (504) リクエストがあること
+    assert any(getattr(r, "status_code", None) == 504 for r in results)
+    assert semaphore._value == app.places_executor.concurrency
+    assert semaphore.waiting() == 0
+
+
+def test_categorization_fallback_runs_off_the_event_loop(monkeypatch):
+    app = pytest.importorskip("decide_visit_sight")
+    from tool.deadline import Deadline
+
+    categorize = app.store_categorizer.categorize
+    fallback_threads = []
+
+    def recording_categorize(stores, use_llm=True, **kwargs):
+        if use_llm:
+            # 締め切りまでに終わらない生成AIの分類
+            time.sleep(0.2)
+        else:
+            fallback_threads.append(threading.current_thread())
+        return categorize(stores, use_llm=False, **kwargs)
+
+    monkeypatch.setattr(app.store_categorizer, "categorize", recording_categorize)
+    stores = [{"place_id": "fallback-1", "name": "合成店舗", "types": ["cafe"]}]
+
+    async def scenario():
+        return await app.categorization_stage(
+            None, stores, {}, Deadline(app.DEADLINE_FINAL_RESERVE_MS + 20)
+        )
+
+    assert asyncio.run(scenario()) == ["4"]
+    assert fallback_threads and fallback_threads[0] is not threading.main_thread()
@@ -0,0 +1,46 @@
+import time
+
+import pytest
+
+from tool.history_store import HistoryStore, InMemoryHistoryStore, SQLiteHistoryStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryHistoryStore(idle_ttl=0.2)
+    return SQLiteHistoryStore(path=str(tmp_path / "history.sqlite3"), idle_ttl=0.2)
+
+
+def test_expired_thread_does_not_come_back(store):
+    store.append("thread", "user", "古い質問")
+    store.append("thread", "assistant", "古い回答")
+    time.sleep(0.3)
+
+    # 期限切れのスレッドへの追記は、古い発言を含まない新しいスレッドになる
+    store.append("thread", "user", "新しい質問")
+    assert [m["content"] for m in store.messages("thread")] == ["新しい質問"]
+    assert store.stats()["evicted_threads"] == 1
+
+
+def test_expired_thread_is_deleted_on_read(store):
+    store.append("thread", "user", "質問")
+    time.sleep(0.3)
+
+    assert store.messages("thread") == []
+    assert store.stats()["messages"] == 0
+
+
+def test_incomplete_backend_fails_at_construction():
+    class NoStats(HistoryStore):
+        def messages(self, thread_id):
+            return []
+
+        def append(self, thread_id, role, content):
+            pass
+
+        def clear(self, thread_id):
+            pass
+
+    with pytest.raises(TypeError):
+        NoStats()
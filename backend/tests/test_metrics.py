@@ -0,0 +1,50 @@
+import pytest
+from starlette.requests import Request
+
+
+def make_request(app, method, path):
+    return Request(
+        {
+            "type": "http",
+            "app": app,
+            "method": method,
+            "path": path,
+            "root_path": "",
+            "query_string": b"",
+            "headers": [],
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    "method, path, label",
+    [
+        ("GET", "/photo/abc123", "/photo/{photo_reference}"),
+        ("GET", "/photo/def456", "/photo/{photo_reference}"),
+        ("POST", "/generate_response", "/generate_response"),
+        ("GET", "/generate_response", "/generate_response"),
+        ("GET", "/no/such/path", "unmatched"),
+    ],
+)
+def test_route_label(method, path, label):
+    app = pytest.importorskip("decide_visit_sight")
+    assert app.route_label(make_request(app.app, method, path)) == label
+
+
+def test_requests_are_counted_by_route_template():
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+
+    app = pytest.importorskip("decide_visit_sight")
+    client = TestClient(app.app)
+
+    photo = client.get("/photo/metrics-test-ref")
+    client.get("/no/such/path")
+    metrics = client.get("/metrics")
+
+    assert metrics.status_code == 200
+    assert photo.status_code == 200
+    paths = {path for path, _ in app.http_requests._values}
+    assert {"/photo/{photo_reference}", "/metrics", "unmatched"} <= paths
+    assert not any("metrics-test-ref" in path for path in paths)
+    assert 'path="/photo/{photo_reference}"' in metrics.text
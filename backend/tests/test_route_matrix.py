@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+
+def test_pipeline_uses_distance_matrix_in_synthetic_mode(monkeypatch):
+    app = pytest.importorskip("decide_visit_sight")
+    # ROUTE_MATRIX_SOURCE=distance_matrix で起動した場合と同じ設定にする
+    monkeypatch.setattr(app, "ROUTE_MATRIX_SOURCE", "distance_matrix")
+    monkeypatch.setattr(app.travel_times, "fetch", app.fetch_travel_times)
+    before = app.gmaps.calls["distance_matrix"]
+
+    result = asyncio.run(
+        app.itinerary_response("移動時間の行列のテスト", thread_id="route-matrix")
+    )
+
+    assert app.gmaps.calls["distance_matrix"] > before
+    assert result["route"]
+
+
+def test_synthetic_distance_matrix_shape():
+    from tool.replay import SyntheticGmaps
+
+    gmaps = SyntheticGmaps(latency_ms=0)
+    result = gmaps.distance_matrix(
+        origins=[(35.0, 135.7), "清水寺"], destinations=[(35.01, 135.7)]
+    )
+
+    assert [len(row["elements"]) for row in result["rows"]] == [1, 1]
+    element = result["rows"][0]["elements"][0]
+    assert element["status"] == "OK"
+    assert 1000 < element["distance"]["value"] < 1200
+    assert element["duration"]["value"] == element["distance"]["value"] // 8
@@ -0,0 +1,88 @@
+import asyncio
+import random
+
+from tool.scheduler import PrioritySemaphore, RateLimiter
+
+
+def test_release_skips_waiter_cancelled_before_grant():
+    async def scenario():
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire(0)
+        waiter = asyncio.ensure_future(semaphore.acquire(0))
+        await asyncio.sleep(0)
+        # 待ち手のタスクが再開する前にキャンセルし、すぐに許可を返す
+        waiter.cancel()
+        semaphore.release()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return semaphore
+
+    semaphore = asyncio.run(scenario())
+    assert semaphore._value == 1
+    assert semaphore.waiting() == 0
+
+
+def test_permit_granted_then_cancelled_is_passed_on():
+    async def scenario():
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire(0)
+        first = asyncio.ensure_future(semaphore.acquire(0))
+        second = asyncio.ensure_future(semaphore.acquire(0))
+        await asyncio.sleep(0)
+        # firstに許可を渡した後、firstが再開する前にキャンセルする
+        semaphore.release()
+        first.cancel()
+        results = await asyncio.gather(first, second, return_exceptions=True)
+        return semaphore, results
+
+    semaphore, results = asyncio.run(scenario())
+    assert isinstance(results[0], asyncio.CancelledError)
+    assert results[1] is None
+    # secondが許可を持っているため、返せば元の数に戻る
+    semaphore.release()
+    assert semaphore._value == 1
+    assert semaphore.waiting() == 0
+
+
+def test_no_permits_lost_when_cancelling_during_release():
+    async def scenario(seed):
+        rng = random.Random(seed)
+        capacity = 3
+        semaphore = PrioritySemaphore(capacity)
+
+        async def worker(priority):
+            await semaphore.acquire(priority)
+            try:
+                await asyncio.sleep(0)
+            finally:
+                semaphore.release()
+
+        for _ in range(capacity):
+            await semaphore.acquire(0)
+        workers = [asyncio.ensure_future(worker(rng.choice([0, 1]))) for _ in range(30)]
+        await asyncio.sleep(0)
+        held = capacity
+        for _ in range(40):
+            rng.choice(workers).cancel()
+            if held and rng.random() < 0.5:
+                # 許可を返すのと同じタイミングで待ち手がキャンセルされる
+                semaphore.release()
+                held -= 1
+            if rng.random() < 0.5:
+                await asyncio.sleep(0)
+        for _ in range(held):
+            semaphore.release()
+        await asyncio.gather(*workers, return_exceptions=True)
+        return semaphore, capacity
+
+    for seed in range(50):
+        semaphore, capacity = asyncio.run(scenario(seed))
+        assert semaphore._value == capacity
+        assert semaphore.waiting() == 0
+
+
+def test_rate_limiter_without_rate_never_waits():
+    limiter = RateLimiter(rate=None, burst=1, max_wait=0)
+    limiter.over_query_limit("places_nearby")
+
+    assert all(limiter.acquire("places_nearby") == 0.0 for _ in range(100))
+    assert limiter.stats() == {}
@@ -0,0 +1,83 @@
+import threading
+import time
+
+import pytest
+
+from tool import singleflight
+from tool.singleflight import FileLock, SingleFlight
+
+requires_flock = pytest.mark.skipif(
+    singleflight.fcntl is None, reason="ワーカー間のロックはfcntlが必要"
+)
+
+
+def run_in_threads(*funcs):
+    results = [None] * len(funcs)
+
+    def target(i):
+        results[i] = funcs[i]()
+
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(len(funcs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+@requires_flock
+def test_workers_share_one_call_without_holding_the_lock(tmp_path):
+    # 同じロックディレクトリを使う2つのインスタンスを、別々のワーカーとみなす
+    workers = [SingleFlight(lock_dir=str(tmp_path), timeout=5) for _ in range(2)]
+    cache = {}
+    calls = []
+    lock_free_during_call = []
+
+    def load():
+        calls.append(1)
+        path = workers[0]._lock_path("key")
+        with FileLock(path, timeout=0) as locked:
+            lock_free_during_call.append(locked)
+        time.sleep(0.2)
+        cache["key"] = "value"
+        return "value"
+
+    def recheck():
+        return "key" in cache, cache.get("key")
+
+    results = run_in_threads(
+        *(lambda w=w: w.do("key", load, recheck=recheck) for w in workers)
+    )
+
+    assert results == ["value", "value"]
+    assert len(calls) == 1
+    assert lock_free_during_call == [True]
+    assert sum(w.stats()["recheck_hit"] for w in workers) == 1
+    assert list(tmp_path.iterdir()) == []
+
+
+@requires_flock
+def test_keys_use_separate_lock_files(tmp_path):
+    flight = SingleFlight(lock_dir=str(tmp_path))
+    assert flight._lock_path(("a", 1)) != flight._lock_path(("a", 2))
+
+
+def test_follower_stops_waiting_after_timeout():
+    flight = SingleFlight(lock_dir="", timeout=0.1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "leader"
+
+    leader = threading.Thread(target=flight.do, args=("key", slow))
+    leader.start()
+    started.wait(5)
+    try:
+        assert flight.do("key", lambda: "follower") == "follower"
+        assert flight.stats()["wait_timeout"] == 1
+    finally:
+        release.set()
+        leader.join(5)
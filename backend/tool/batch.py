@@ -0,0 +1,185 @@
+"""
+多数のプロンプトから旅程をまとめて生成するバッチ処理
+同時実行数を制限して並行に実行し、結果を終わった順にNDJSON (1行1オブジェクト) で返す
+
+使い方 (backendディレクトリで実行):
+    python -m tool.batch prompts.txt --concurrency 8 --output results.ndjson
+    (入力は1行1プロンプト、または {"prompt": ..., "thread_id": ...} のJSON Lines)
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import sys
+import time
+import uuid
+
+from tool.categorizer import BatchClassifier
+from tool.compact import dumps
+
+# バッチ内で同時に生成する旅程の数
+# (Google APIの呼び出しはGOOGLE_API_CONCURRENCYで制限されるため、それを埋められる程度でよい。
+#  大きくしすぎるとお店の詳細取得が待ち行列の上限を超えて省略される)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+# 1回のバッチで受け付けるプロンプトの数の上限
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
+
+_current_batch = contextvars.ContextVar("itinerary_batch", default=None)
+
+
+class BatchContext:
+    """
+    1回のバッチの中で共有するもの
+    classifier: 各プロンプトのお店の分類をまとめて生成AIに送るBatchClassifier
+    coverage: 周辺検索の結果をプロンプトをまたいで使い回すSearchCoverage
+    """
+
+    def __init__(self, llm_classify, coverage=None, concurrency=BATCH_CONCURRENCY):
+        self.id = uuid.uuid4().hex[:12]
+        self.classifier = BatchClassifier(llm_classify, max_requests=concurrency)
+        self.coverage = coverage
+
+    def stats(self):
+        return {"categorization": self.classifier.stats()}
+
+
+def current_batch():
+    """
+    現在のリクエストが属するバッチ。バッチ処理でなければNone
+    """
+    return _current_batch.get()
+
+
+def parse_items(lines):
+    """
+    入力の各行を {"prompt": ..., "thread_id": ...} に変換する (空行は除く)
+    """
+    items = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("{"):
+            item = json.loads(line)
+            items.append({"prompt": item["prompt"], "thread_id": item.get("thread_id")})
+        else:
+            items.append({"prompt": line, "thread_id": None})
+    return items
+
+
+async def run_batch(items, handler, context, concurrency=BATCH_CONCURRENCY):
+    """
+    各itemについてhandler(item) を最大concurrency個ずつ並行に実行し、
+    終わった順に {"index", "thread_id", "result" または "error"} を返す
+    handlerの中では current_batch() でcontextを参照できる
+    thread_idのないitemには、対話履歴が混ざらないようバッチ内で一意のthread_idを付ける
+    """
+    results = asyncio.Queue()
+    pending = iter(enumerate(items))
+
+    async def worker():
+        # ワーカーのタスクごとのコンテキストに設定するため、呼び出し元には影響しない
+        _current_batch.set(context)
+        for index, item in pending:
+            thread_id = item.get("thread_id") or f"batch-{context.id}-{index}"
+            item = dict(item, thread_id=thread_id)
+            record = {"index": index, "thread_id": thread_id}
+            try:
+                record["result"] = await handler(item)
+            except Exception as e:
+                record["error"] = {
+                    "status_code": getattr(e, "status_code", 500),
+                    "detail": getattr(e, "detail", str(e)),
+                }
+            results.put_nowait(record)
+
+    workers = [
+        asyncio.ensure_future(worker())
+        for _ in range(max(1, min(concurrency, len(items))))
+    ]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+def to_ndjson(record):
+    return dumps(record).decode("utf-8") + "\n"
+
+
+async def run_cli(app, items, concurrency, deadline_ms, output, compact=False):
+    context = app.new_batch_context(concurrency)
+    started_at = time.perf_counter()
+    errors = 0
+    async for record in run_batch(
+        items,
+        lambda item: app.batch_item_response(item, deadline_ms, compact),
+        context,
+        concurrency,
+    ):
+        errors += "error" in record
+        output.write(to_ndjson(record))
+        output.flush()
+    elapsed = time.perf_counter() - started_at
+    print(
+        f"{len(items)} prompts, {errors} errors, {elapsed:.1f}s "
+        f"({len(items) / elapsed if elapsed else 0.0:.2f}/s), "
+        f"{json.dumps(context.stats())}",
+        file=sys.stderr,
+    )
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("input", help="プロンプトのファイル (- で標準入力)")
+    parser.add_argument("--output", help="結果を書き込むファイル (既定は標準出力)")
+    parser.add_argument(
+        "--concurrency", type=int, default=BATCH_CONCURRENCY, help="同時に生成する数"
+    )
+    parser.add_argument(
+        "--deadline-ms", type=int, default=None, help="プロンプトごとの締め切り"
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="ルートとお店をフロントエンドが使う項目だけに絞る",
+    )
+    args = parser.parse_args(argv)
+
+    if args.input == "-":
+        items = parse_items(sys.stdin)
+    else:
+        with open(args.input, encoding="utf-8") as f:
+            items = parse_items(f)
+
+    import decide_visit_sight
+
+    # python -m で実行した場合、このモジュールは __main__ として読み込まれるため、
+    # decide_visit_sight と同じ tool.batch (current_batch) を使う
+    from tool.batch import run_cli
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        errors = asyncio.run(
+            run_cli(
+                decide_visit_sight,
+                items,
+                args.concurrency,
+                args.deadline_ms,
+                output,
+                args.compact,
+            )
+        )
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
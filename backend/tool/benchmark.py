@@ -0,0 +1,355 @@
+"""
+generate_response のエンドツーエンドのベンチマーク
+合成データ (EXTERNAL_API_MODE=synthetic) に対して、規模を変えながらパイプラインを実行し、
+ステージごとの所要時間・外部API呼び出し回数・メモリ使用量を測定する
+
+使い方 (backendディレクトリで実行):
+    python -m tool.benchmark --landmarks 3 6 --spread 2000 8000 --stores 5 20 --users 1 8
+    python -m tool.benchmark --save-baseline benchmark_baseline.json
+    python -m tool.benchmark --compare benchmark_baseline.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+STAGES = [
+    "llm_suggestion",
+    "find_place",
+    "get_nearest_station",
+    "route_optimization",
+    "first_directions",
+    "extract_lat_lng",
+    "store_scan",
+    "categorization",
+    "detour_costs",
+    "select_stores",
+    "final_directions",
+]
+
+
+def load_app():
+    """
+    外部APIを合成データに置き換えた状態で decide_visit_sight を読み込む
+    キャッシュは一時ディレクトリに作る
+    """
+    os.environ.setdefault("EXTERNAL_API_MODE", "synthetic")
+    os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp(prefix="benchmark-cache-"))
+    os.environ.setdefault("HISTORY_BACKEND", "memory")
+    import decide_visit_sight
+
+    return decide_visit_sight
+
+
+def percentile(values, q):
+    """
+    線形補間によるパーセンタイル
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+
+def reset_caches(app):
+    """
+    計測ごとに空のメモリキャッシュへ差し替える (コールドスタートを計測するため)
+    """
+    from tool.cache import TieredCache
+    from tool.categorizer import StoreCategorizer
+    from tool.directions_cache import DirectionsCache
+    from tool.history_store import InMemoryHistoryStore
+    from tool.prompt_cache import PromptCache
+    from tool.route_optimizer import TravelTimeMatrix
+
+    app.places_cache = TieredCache(
+        None, ttls=app.places_cache.ttls, flight=app.singleflight
+    )
+    app.directions_cache = DirectionsCache(TieredCache(None))
+    # 移動時間の行列も新しいplaces_cacheを使うように作り直す
+    app.travel_times = TravelTimeMatrix(app.places_cache, fetch=app.travel_times.fetch)
+    app.store_categorizer = StoreCategorizer(
+        app.places_cache, app.classify_stores_with_llm, flight=app.singleflight
+    )
+    # ベンチマークのプロンプトは番号だけが違うため、似たプロンプトとして使い回さない
+    app.prompt_cache = PromptCache(threshold=1.0)
+    # 前のシナリオの対話履歴が次のシナリオのプロンプトに加わらないようにする
+    app.history_store = InMemoryHistoryStore()
+
+
+def install_clients(app, scenario, latency_ms):
+    from tool.replay import create_offline_clients
+
+    app.client, app.gmaps, app.http_client = create_offline_clients(
+        "synthetic",
+        latency_ms=latency_ms,
+        landmarks=scenario["landmarks"],
+        stores_per_search=scenario["stores"],
+        spread_m=scenario["spread"],
+    )
+
+
+def call_counts(app):
+    counts = {}
+    for stand_in in (app.client, app.gmaps, app.http_client):
+        counts.update(stand_in.calls)
+    return counts
+
+
+async def run_requests(app, users, iterations, run_id, thread_prefix="bench"):
+    """
+    users人が同時に iterations 回ずつリクエストを送り、各リクエストの記録を返す
+    thread_prefix: スレッドIDの先頭 (シナリオごとに変え、対話履歴を共有しないようにする)
+    """
+    from tool.tracing import start_trace
+
+    async def one_request(user, i):
+        trace = start_trace()
+        started_at = time.perf_counter()
+        error = None
+        try:
+            await app.itinerary_response(
+                f"ベンチマーク {run_id} {user} {i}",
+                thread_id=f"{thread_prefix}-{run_id}-{user}-{i}",
+            )
+        except Exception as e:
+            error = str(e)
+        return {
+            "total": time.perf_counter() - started_at,
+            "stages": trace.durations(),
+            "critical_path": trace.critical_path,
+            "error": error,
+        }
+
+    async def one_user(user):
+        return [await one_request(user, i) for i in range(iterations)]
+
+    results = await asyncio.gather(*(one_user(user) for user in range(users)))
+    return list(itertools.chain.from_iterable(results))
+
+
+def run_scenario(app, scenario, iterations, latency_ms, cold):
+    """
+    1つのシナリオを計測する
+    """
+    key = scenario_key(scenario)
+    install_clients(app, scenario, latency_ms)
+    if cold:
+        reset_caches(app)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        started_at = time.perf_counter()
+        records = asyncio.run(
+            run_requests(
+                app, scenario["users"], iterations, run_id="timing", thread_prefix=key
+            )
+        )
+        wall_time = time.perf_counter() - started_at
+    calls = call_counts(app)
+
+    # メモリはtracemallocの影響が計測時間に出ないよう、別に1回だけ実行して測る
+    install_clients(app, scenario, latency_ms=0)
+    if cold:
+        reset_caches(app)
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(
+            run_requests(app, scenario["users"], 1, run_id="memory", thread_prefix=key)
+        )
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    request_count = len(records)
+    stages = {
+        name: summarize([r["stages"][name] for r in records if name in r["stages"]])
+        for name in STAGES
+    }
+    return {
+        "scenario": scenario,
+        "requests": request_count,
+        "errors": sum(1 for r in records if r["error"]),
+        "wall_time": wall_time,
+        "throughput": request_count / wall_time if wall_time else 0.0,
+        "latency": summarize([r["total"] for r in records]),
+        "stages": stages,
+        "calls_per_request": {k: v / request_count for k, v in sorted(calls.items())},
+        "critical_paths": critical_paths(records),
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def critical_paths(records):
+    """
+    クリティカルパス (所要時間を決めたステージの経路) ごとの件数を多い順に返す
+    """
+    counts = {}
+    for record in records:
+        path = " -> ".join(record["critical_path"])
+        if path:
+            counts[path] = counts.get(path, 0) + 1
+    return dict(sorted(counts.items(), key=lambda item: -item[1]))
+
+
+def scenario_key(scenario):
+    return ",".join(f"{k}={scenario[k]}" for k in sorted(scenario))
+
+
+def compare(results, baseline, threshold):
+    """
+    ベースラインと比較し、p95が threshold (割合) 以上悪化した項目を返す
+    """
+    baseline_by_key = {scenario_key(r["scenario"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        key = scenario_key(result["scenario"])
+        base = baseline_by_key.get(key)
+        if base is None:
+            continue
+        pairs = [("total", result["latency"], base["latency"])]
+        pairs += [
+            (name, result["stages"][name], base["stages"].get(name, {}))
+            for name in STAGES
+        ]
+        for name, current, previous in pairs:
+            if not previous or not previous.get("p95"):
+                continue
+            change = current["p95"] / previous["p95"] - 1
+            print(
+                f"{key} {name}: p95 {previous['p95'] * 1000:.1f}ms -> {current['p95'] * 1000:.1f}ms ({change:+.0%})"
+            )
+            if change > threshold:
+                regressions.append((key, name, change))
+    return regressions
+
+
+def print_result(result):
+    print(f"\n== {scenario_key(result['scenario'])}")
+    latency = result["latency"]
+    print(
+        f"requests={result['requests']} errors={result['errors']} "
+        f"throughput={result['throughput']:.2f}/s "
+        f"p50={latency['p50'] * 1000:.1f}ms p95={latency['p95'] * 1000:.1f}ms "
+        f"p99={latency['p99'] * 1000:.1f}ms "
+        f"peak_memory={result['peak_memory_bytes'] / 1024 / 1024:.1f}MiB"
+    )
+    for name in STAGES:
+        s = result["stages"][name]
+        if s["count"]:
+            print(
+                f"  {name:<20} p50={s['p50'] * 1000:8.1f}ms "
+                f"p95={s['p95'] * 1000:8.1f}ms p99={s['p99'] * 1000:8.1f}ms"
+            )
+    print(
+        "  calls/request: "
+        + ", ".join(f"{k}={v:.1f}" for k, v in result["calls_per_request"].items())
+    )
+    for path, count in list(result["critical_paths"].items())[:3]:
+        print(f"  critical path ({count}/{result['requests']}): {path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--landmarks", type=int, nargs="+", default=[3], help="提案する観光地の数"
+    )
+    parser.add_argument(
+        "--spread",
+        type=int,
+        nargs="+",
+        default=[3000],
+        help="観光地を配置する範囲 (m)。ルートの長さに相当",
+    )
+    parser.add_argument(
+        "--stores",
+        type=int,
+        nargs="+",
+        default=[20],
+        help="周辺検索1回あたりのお店の数",
+    )
+    parser.add_argument(
+        "--users", type=int, nargs="+", default=[1], help="同時に送るユーザー数"
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=5, help="ユーザーごとのリクエスト数"
+    )
+    parser.add_argument(
+        "--latency-ms", type=float, default=20.0, help="外部API呼び出し1回あたりの遅延"
+    )
+    parser.add_argument(
+        "--warm", action="store_true", help="キャッシュをシナリオ間で引き継ぐ"
+    )
+    parser.add_argument("--output", help="結果をJSONで保存するファイル")
+    parser.add_argument(
+        "--save-baseline", help="結果をベースラインとして保存するファイル"
+    )
+    parser.add_argument("--compare", help="比較するベースラインのファイル")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="悪化とみなすp95の増加率"
+    )
+    args = parser.parse_args(argv)
+
+    app = load_app()
+    results = []
+    for landmarks, spread, stores, users in itertools.product(
+        args.landmarks, args.spread, args.stores, args.users
+    ):
+        scenario = {
+            "landmarks": landmarks,
+            "spread": spread,
+            "stores": stores,
+            "users": users,
+        }
+        result = run_scenario(
+            app, scenario, args.iterations, args.latency_ms, cold=not args.warm
+        )
+        print_result(result)
+        results.append(result)
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {
+            "iterations": args.iterations,
+            "latency_ms": args.latency_ms,
+            "warm": args.warm,
+        },
+        "results": results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
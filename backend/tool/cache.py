@@ -0,0 +1,169 @@
+"""
+外部APIの結果を保持する2層キャッシュ (プロセス内LRU + SQLite)
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# キャッシュファイルを置くディレクトリ
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+
+
+def normalize_text(text):
+    """
+    キャッシュキー用に文字列を正規化する (全角/半角、大文字/小文字、空白の揺れを吸収)
+    """
+    text = unicodedata.normalize("NFKC", str(text))
+    return " ".join(text.lower().split())
+
+
+class TieredCache:
+    """
+    メモリ上のLRUと、ディスク上のSQLiteの2層で構成されるTTL付きキャッシュ
+    namespace (エンドポイント名) ごとにTTLを設定できる
+    flightを指定すると、get_or_loadで同じキーの読み込みを1回にまとめる
+    """
+
+    def __init__(
+        self, path, max_entries=2048, ttls=None, default_ttl=3600, flight=None
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.flight = flight
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """)
+            self._db.commit()
+
+    def ttl_for(self, namespace):
+        return self.ttls.get(namespace, self.default_ttl)
+
+    def get(self, namespace, key, count_miss=True):
+        """
+        (ヒットしたか, 値) を返す
+        count_miss=False の場合、見つからなくてもミスとして数えない (確認し直す場合)
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get((namespace, key))
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._memory.move_to_end((namespace, key))
+                    self._stats["memory_hits"] += 1
+                    return True, value
+                del self._memory[(namespace, key)]
+                self._stats["expirations"] += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                    (namespace, key),
+                ).fetchone()
+                if row is not None:
+                    if row[1] > now:
+                        value = json.loads(row[0])
+                        self._remember(namespace, key, value, row[1])
+                        self._stats["disk_hits"] += 1
+                        return True, value
+                    self._db.execute(
+                        "DELETE FROM cache WHERE namespace = ? AND key = ?",
+                        (namespace, key),
+                    )
+                    self._db.commit()
+                    self._stats["expirations"] += 1
+
+            if count_miss:
+                self._stats["misses"] += 1
+            return False, None
+
+    def set(self, namespace, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl_for(namespace) if ttl is None else ttl)
+        with self._lock:
+            self._remember(namespace, key, value, expires_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                    (namespace, key, json.dumps(value, ensure_ascii=False), expires_at),
+                )
+                self._db.commit()
+
+    def get_or_load(self, namespace, key, loader):
+        """
+        キャッシュにあればその値を、なければloader()の結果を保存して返す
+        """
+        hit, value = self.get(namespace, key)
+        if hit:
+            return value
+
+        def load():
+            value = loader()
+            self.set(namespace, key, value)
+            return value
+
+        if self.flight is None:
+            return load()
+        return self.flight.do(
+            (self.path, namespace, key),
+            load,
+            recheck=lambda: self.get(namespace, key, count_miss=False),
+        )
+
+    def _remember(self, namespace, key, value, expires_at):
+        # ロックを保持した状態で呼び出すこと
+        self._memory[(namespace, key)] = (value, expires_at)
+        self._memory.move_to_end((namespace, key))
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def purge_expired(self):
+        """
+        ディスク上の期限切れエントリを削除する
+        """
+        if self._db is None:
+            return 0
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM cache WHERE expires_at <= ?", (time.time(),)
+            )
+            self._db.commit()
+            self._stats["expirations"] += cursor.rowcount
+            return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        total = hits + stats["misses"]
+        stats["hit_ratio"] = hits / total if total else 0.0
+        return stats
@@ -0,0 +1,363 @@
+"""
+お店のカテゴリ分類
+キャッシュ → ルールによる分類 → 生成AI の順に問い合わせ、生成AIには未知の店名だけをまとめて送る
+
+カテゴリ番号
+    Japanese sweets shop: 1
+    Food Shops: 2
+    Souvenir Shops: 3
+    Dining & Drinking: 4
+    Activity Shops: 5
+    Other Retail Shops: 6
+"""
+
+import os
+import threading
+
+# 分類できなかった場合のカテゴリ (Other Retail Shops)
+DEFAULT_CATEGORY = "6"
+# 生成AIによる分類結果を保持する時間 (秒)
+CATEGORY_CACHE_TTL = int(os.getenv("CATEGORY_CACHE_TTL", str(30 * 24 * 3600)))
+# バッチ処理で、他のリクエストの分類をまとめるために待つ最大時間 (ミリ秒)
+# (バッチ処理では1件ごとの待ち時間よりも全体の処理量を優先する)
+CATEGORY_BATCH_WINDOW_MS = int(os.getenv("CATEGORY_BATCH_WINDOW_MS", "3000"))
+# 生成AIに1回で送る店名の数の上限
+CATEGORY_BATCH_MAX_NAMES = int(os.getenv("CATEGORY_BATCH_MAX_NAMES", "200"))
+
+CATEGORY_PROMPT = """
+        #設定
+        入力された店名に対し、以下の法則で順番ごとにカテゴリの番号を付けてください。番号は最も適したものを一つつけてください。
+
+        Japanese sweets shop: 1
+        Food Shops: 2
+        Souvenir Shops: 3
+        Dining & Drinking: 4
+        Activity Shops: 5
+        Other Retail Shops: 6
+
+        #入力
+        [<店名>,<店名>,<店名>]
+
+        #json 出力
+        {"result":["<num>","<num>","<num>",]}
+        """
+
+# 店名に含まれていればカテゴリが確定するキーワード (上から順に判定)
+NAME_KEYWORDS = [
+    (
+        "1",
+        [
+            "和菓子",
+            "菓子舗",
+            "饅頭",
+            "まんじゅう",
+            "羊羹",
+            "ようかん",
+            "団子",
+            "だんご",
+            "甘味",
+            "最中",
+            "煎餅",
+            "せんべい",
+            "大福",
+        ],
+    ),
+    ("3", ["土産", "みやげ", "物産", "souvenir"]),
+]
+
+# typesがcafeでも和菓子屋 (1) のことがあるため、typesだけでは判定しないお店の手がかり
+# (店名に含まれるか、cafeと同時に付いているtypes。該当する場合は生成AIに任せる)
+SWEETS_NAME_HINTS = [
+    "スイーツ",
+    "sweets",
+    "茶寮",
+    "茶房",
+    "抹茶",
+    "パフェ",
+    "ぜんざい",
+    "あんみつ",
+    "わらび",
+    "かき氷",
+    "餅",
+    "菓",
+]
+SWEETS_TYPES = {"bakery"}
+
+# Places APIのtypesから判定するカテゴリ (上から順に判定)
+TYPE_CATEGORIES = [
+    (
+        "4",
+        {"restaurant", "cafe", "bar", "meal_takeaway", "meal_delivery", "night_club"},
+    ),
+    ("2", {"bakery", "supermarket", "grocery_or_supermarket", "liquor_store"}),
+    (
+        "5",
+        {
+            "amusement_park",
+            "aquarium",
+            "art_gallery",
+            "bowling_alley",
+            "gym",
+            "movie_theater",
+            "museum",
+            "spa",
+            "zoo",
+        },
+    ),
+    (
+        "6",
+        {
+            "bicycle_store",
+            "book_store",
+            "clothing_store",
+            "department_store",
+            "drugstore",
+            "electronics_store",
+            "furniture_store",
+            "hardware_store",
+            "home_goods_store",
+            "jewelry_store",
+            "pet_store",
+            "pharmacy",
+            "shoe_store",
+            "shopping_mall",
+        },
+    ),
+]
+
+
+def classify_locally(store):
+    """
+    店名とtypesから確実に判定できる場合はカテゴリ番号を、できなければNoneを返す
+    """
+    name = str(store.get("name", "")).lower()
+    for category, keywords in NAME_KEYWORDS:
+        if any(keyword in name for keyword in keywords):
+            return category
+
+    types = store.get("types")
+    if not isinstance(types, list):
+        return None
+    types = set(types)
+    if "cafe" in types and (
+        types & SWEETS_TYPES or any(hint in name for hint in SWEETS_NAME_HINTS)
+    ):
+        return None
+    for category, category_types in TYPE_CATEGORIES:
+        if types & category_types:
+            return category
+    return None
+
+
+class StoreCategorizer:
+    """
+    place_idをキーにお店のカテゴリを決める
+    llm_classify: 店名のリストを受け取り、同じ順番のカテゴリ番号のリストを返す関数
+    flight: 同じお店の組み合わせの分類が実行中であれば、その結果を待つためのSingleFlight
+    """
+
+    namespace = "category"
+
+    def __init__(self, cache, llm_classify, flight=None):
+        self.cache = cache
+        self.llm_classify = llm_classify
+        self.flight = flight
+        self.cache.ttls.setdefault(self.namespace, CATEGORY_CACHE_TTL)
+        self._lock = threading.Lock()
+        self._stats = {"cache": 0, "rule": 0, "llm": 0, "llm_calls": 0}
+
+    def _lookup(self, store):
+        """
+        キャッシュ・ルールでカテゴリを決める。決められなければNone
+        """
+        place_id = store.get("place_id")
+        if place_id:
+            hit, category = self.cache.get(self.namespace, place_id)
+            if hit:
+                self._count("cache")
+                return category
+        category = classify_locally(store)
+        if category is not None:
+            self._count("rule")
+        return category
+
+    def lookup(self, stores):
+        """
+        生成AIに問い合わせずに分かるカテゴリを {place_id: カテゴリ番号またはNone} で返す
+        (お店が見つかった時点で先に調べておき、categorizeのknownに渡す)
+        """
+        return {
+            store["place_id"]: self._lookup(store)
+            for store in stores
+            if store.get("place_id")
+        }
+
+    def categorize(self, stores, use_llm=True, known=None, llm_classify=None):
+        """
+        storesと同じ順番でカテゴリ番号 ("1"〜"6") のリストを返す
+        use_llm=False の場合は生成AIに問い合わせず、キャッシュ・ルールで分類できない
+        お店をDEFAULT_CATEGORYとする (締め切りに間に合わない場合など)
+        known: lookupで調べ済みの結果。含まれるお店はキャッシュ・ルールを調べ直さない
+        llm_classify: 生成AIの呼び出しを置き換える関数 (バッチ処理でBatchClassifierを使う場合など)
+        """
+        known = known or {}
+        categories = [None] * len(stores)
+        unknown = []
+        for i, store in enumerate(stores):
+            place_id = store.get("place_id")
+            if place_id in known:
+                category = known[place_id]
+            else:
+                category = self._lookup(store)
+            if category is not None:
+                categories[i] = category
+            else:
+                unknown.append(i)
+
+        if unknown and not use_llm:
+            for i in unknown:
+                categories[i] = DEFAULT_CATEGORY
+        elif unknown:
+            results = self._classify(
+                [stores[i] for i in unknown], llm_classify or self.llm_classify
+            )
+            for position, i in enumerate(unknown):
+                # 生成AIの結果が足りない場合はDEFAULT_CATEGORYとし、キャッシュしない
+                result = results[position] if position < len(results) else None
+                category = str(result) if result is not None else DEFAULT_CATEGORY
+                categories[i] = category
+                self._count("llm")
+                place_id = stores[i].get("place_id")
+                if place_id and result is not None:
+                    self.cache.set(self.namespace, place_id, category)
+
+        return categories
+
+    def _classify(self, stores, llm_classify):
+        """
+        生成AIで分類する。同じお店の組み合わせを分類中の呼び出しがあればその結果を使う
+        """
+        names = [store["name"] for store in stores]
+
+        def classify():
+            self._count("llm_calls")
+            return llm_classify(names)
+
+        if self.flight is None:
+            return classify()
+
+        def recheck():
+            # 他のワーカーが分類してキャッシュに保存した結果があれば使う
+            categories = []
+            for store in stores:
+                place_id = store.get("place_id")
+                if not place_id:
+                    return False, None
+                hit, category = self.cache.get(
+                    self.namespace, place_id, count_miss=False
+                )
+                if not hit:
+                    return False, None
+                categories.append(category)
+            return True, categories
+
+        key = (
+            self.namespace,
+            "\x1f".join(store.get("place_id") or store["name"] for store in stores),
+        )
+        return self.flight.do(key, classify, recheck=recheck)
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class _Batch:
+    def __init__(self):
+        self.names = {}
+        self.requests = 0
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        self.results = {}
+        self.error = None
+
+
+class BatchClassifier:
+    """
+    複数のリクエストから同時に呼ばれた生成AIの分類を、まとめて少ない回数で呼び出す
+    最初の呼び出しからwindow_ms待つ間 (店名がmax_namesに達するか、
+    呼び出しがmax_requestsに達するまで) に来た店名を、重複を除いて1回 (max_namesごと) で分類する
+    llm_classify: 店名のリストを受け取り、同じ順番のカテゴリ番号のリストを返す関数
+    max_requests: 同時に実行するリクエストの数 (全員が待っている場合は待たずに送る)
+    """
+
+    def __init__(
+        self,
+        llm_classify,
+        window_ms=CATEGORY_BATCH_WINDOW_MS,
+        max_names=CATEGORY_BATCH_MAX_NAMES,
+        max_requests=None,
+    ):
+        self.llm_classify = llm_classify
+        self.window = window_ms / 1000
+        self.max_names = max_names
+        self.max_requests = max_requests
+        self._pending = None
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "names": 0, "llm_calls": 0}
+
+    def classify(self, names):
+        """
+        namesと同じ順番でカテゴリ番号 (分類できなかった店名はNone) のリストを返す
+        """
+        with self._lock:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = _Batch()
+            for name in names:
+                batch.names.setdefault(name, None)
+            batch.requests += 1
+            self._stats["requests"] += 1
+            if len(batch.names) >= self.max_names or (
+                self.max_requests and batch.requests >= self.max_requests
+            ):
+                # 上限に達したので、待たずに送る
+                self._pending = None
+                batch.ready.set()
+
+        if leader:
+            batch.ready.wait(self.window)
+            with self._lock:
+                if self._pending is batch:
+                    self._pending = None
+            self._run(batch)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return [batch.results.get(name) for name in names]
+
+    def _run(self, batch):
+        names = list(batch.names)
+        try:
+            for start in range(0, len(names), self.max_names):
+                chunk = names[start : start + self.max_names]
+                with self._lock:
+                    self._stats["names"] += len(chunk)
+                    self._stats["llm_calls"] += 1
+                results = self.llm_classify(chunk)
+                batch.results.update(zip(chunk, results))
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,117 @@
+"""
+旅程のレスポンスを小さくするためのモジュール
+フロントエンドが使う項目だけに絞った形への変換、高速なJSONエンコード、gzip/brotliによる圧縮を行う
+"""
+
+import gzip
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # orjsonがなければ標準のjsonを使う
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # brotliがなければgzipだけに対応する
+    brotli = None
+
+# この大きさ (バイト) 以上のレスポンスを圧縮する
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", "1024"))
+# 圧縮のレベル (CPUの負荷と圧縮率のバランス)
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+# 簡易表示で返すお店の項目
+STORE_FIELDS = ("place_id", "name", "address", "rating", "website", "photo", "location")
+
+
+def dumps(data):
+    """
+    dataをUTF-8のJSON (bytes) にする
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def compact_route(directions_result):
+    """
+    Directions APIの結果から、ルートの描画と所要時間の表示に使う項目だけを残す
+    (stepsとその案内文・ポリラインは除く)
+    """
+    if not directions_result:
+        return directions_result
+    routes = []
+    for route in directions_result.get("routes", []):
+        routes.append(
+            {
+                "overview_polyline": route.get("overview_polyline"),
+                "bounds": route.get("bounds"),
+                "waypoint_order": route.get("waypoint_order", []),
+                "legs": [
+                    {
+                        "start_address": leg.get("start_address"),
+                        "end_address": leg.get("end_address"),
+                        "start_location": leg.get("start_location"),
+                        "end_location": leg.get("end_location"),
+                        "distance": leg.get("distance"),
+                        "duration": leg.get("duration"),
+                    }
+                    for leg in route.get("legs", [])
+                ],
+            }
+        )
+    return {"status": directions_result.get("status"), "routes": routes}
+
+
+def compact_store(store):
+    return {field: store.get(field) for field in STORE_FIELDS}
+
+
+def compact_stores(stores):
+    return [compact_store(store) for store in stores]
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Accept-Encodingヘッダーから使う圧縮方式 ("br" / "gzip") を選ぶ。圧縮しない場合はNone
+    """
+    qualities = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding] = quality
+
+    supported = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best, best_quality = None, 0.0
+    for coding in supported:
+        quality = qualities.get(coding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def encode_body(body, accept_encoding):
+    """
+    bodyを圧縮し、(圧縮後のbody, Content-Encoding) を返す
+    小さい場合やクライアントが対応していない場合は (body, None) を返す
+    """
+    if len(body) < RESPONSE_COMPRESS_MIN_BYTES:
+        return body, None
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY), encoding
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0), encoding
+    return body, None
@@ -0,0 +1,73 @@
+"""
+リクエストごとの締め切り (デッドライン)
+残り時間を各ステージに渡し、時間が足りない場合は省略できるステージを打ち切る
+"""
+
+import asyncio
+import inspect
+import os
+import time
+
+# 既定の締め切り (ミリ秒)。0の場合は締め切りを設けない (?deadline_ms= で個別に指定できる)
+REQUEST_DEADLINE_MS = int(os.getenv("REQUEST_DEADLINE_MS", "0"))
+# お店を選んだ後のルート取得のために残しておく時間 (ミリ秒)
+DEADLINE_FINAL_RESERVE_MS = int(os.getenv("DEADLINE_FINAL_RESERVE_MS", "1500"))
+# お店のカテゴリ分類のために残しておく時間 (ミリ秒)
+DEADLINE_CATEGORIZATION_RESERVE_MS = int(
+    os.getenv("DEADLINE_CATEGORIZATION_RESERVE_MS", "1500")
+)
+
+
+class DeadlineExceeded(Exception):
+    """
+    締め切りまでにステージが終わらなかった
+    """
+
+
+class Deadline:
+    """
+    リクエストの開始時刻からbudget_msミリ秒後を締め切りとする
+    skipped: 締め切りのために省略 ("skipped") または途中で打ち切った ("partial") ステージ
+    """
+
+    def __init__(self, budget_ms=None):
+        if budget_ms is None:
+            budget_ms = REQUEST_DEADLINE_MS
+        self.budget = budget_ms / 1000 if budget_ms and budget_ms > 0 else None
+        self.started_at = time.monotonic()
+        self.skipped = {}
+
+    def remaining(self, reserve_ms=0):
+        """
+        reserve_msミリ秒を残した場合に使える時間 (秒)。締め切りがなければNone
+        """
+        if self.budget is None:
+            return None
+        elapsed = time.monotonic() - self.started_at
+        return max(0.0, self.budget - elapsed - reserve_ms / 1000)
+
+    def expired(self, reserve_ms=0):
+        remaining = self.remaining(reserve_ms)
+        return remaining is not None and remaining <= 0
+
+    def skip(self, name, how="skipped"):
+        self.skipped[name] = how
+
+    async def run(self, name, awaitable, reserve_ms=0):
+        """
+        reserve_msミリ秒を残した時刻までにawaitableを実行する
+        間に合わない場合は打ち切ってDeadlineExceededを送出する
+        """
+        timeout = self.remaining(reserve_ms)
+        if timeout is None:
+            return await awaitable
+        if timeout <= 0:
+            if inspect.iscoroutine(awaitable):
+                awaitable.close()
+            elif asyncio.isfuture(awaitable):
+                awaitable.cancel()
+            raise DeadlineExceeded(f"Deadline exceeded before {name}")
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(f"Deadline exceeded during {name}") from None
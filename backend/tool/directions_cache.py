@@ -0,0 +1,151 @@
+"""
+Directions APIの結果キャッシュ
+optimizeWaypoints=true で呼び出す場合は経由地の順番は結果に影響しないため、
+出発地・目的地・移動手段・経由地の集合をキーにする
+訪問順を指定して呼び出す場合は、経由地の並びをそのままキーにする
+"""
+
+import os
+import time
+
+from tool.cache import normalize_text
+
+# 「今すぐ出発」のルートを使い回す時間 (秒)
+DIRECTIONS_CACHE_TTL = int(os.getenv("DIRECTIONS_CACHE_TTL", "300"))
+# 出発時刻を丸める幅 (秒)。0の場合は丸めない
+DIRECTIONS_DEPARTURE_BUCKET = int(os.getenv("DIRECTIONS_DEPARTURE_BUCKET", "0"))
+
+
+def departure_bucket(departure_time, bucket_seconds):
+    """
+    出発時刻をキャッシュキー用のバケットに変換する
+    """
+    if not bucket_seconds:
+        return str(departure_time)
+    if departure_time == "now":
+        return f"now:{int(time.time() // bucket_seconds)}"
+    return f"at:{int(float(departure_time) // bucket_seconds)}"
+
+
+def directions_cache_key(
+    origin,
+    destination,
+    waypoints,
+    mode="driving",
+    departure_time="now",
+    bucket_seconds=0,
+    optimize=True,
+):
+    """
+    正規化済みのキャッシュキーを作る (optimize=True の場合は経由地をソートする)
+    """
+    normalized_waypoints = [normalize_text(w) for w in waypoints or []]
+    if optimize:
+        normalized_waypoints.sort()
+    return "|".join(
+        [
+            normalize_text(origin),
+            normalize_text(destination),
+            mode if optimize else f"{mode}:ordered",
+            departure_bucket(departure_time, bucket_seconds),
+            "\x1f".join(normalized_waypoints),
+        ]
+    )
+
+
+def remap_waypoints(result, cached_waypoints, waypoints):
+    """
+    キャッシュ時と今回とで経由地の並びが異なる場合、
+    waypoint_order と geocoded_waypoints を今回の並びに合わせて書き換える
+    """
+    if list(cached_waypoints) == list(waypoints):
+        return result
+
+    # 正規化した名前ごとに、今回のインデックスを出現順に割り当てる
+    positions = {}
+    for index, name in enumerate(waypoints):
+        positions.setdefault(normalize_text(name), []).append(index)
+    index_map = {}
+    for cached_index, name in enumerate(cached_waypoints):
+        index_map[cached_index] = positions[normalize_text(name)].pop(0)
+
+    remapped = dict(result)
+    remapped["routes"] = []
+    for route in result.get("routes", []):
+        route = dict(route)
+        route["waypoint_order"] = [
+            index_map[i] for i in route.get("waypoint_order", [])
+        ]
+        remapped["routes"].append(route)
+
+    geocoded = result.get("geocoded_waypoints")
+    if geocoded and len(geocoded) == len(waypoints) + 2:
+        middle = [None] * len(waypoints)
+        for cached_index, new_index in index_map.items():
+            middle[new_index] = geocoded[cached_index + 1]
+        remapped["geocoded_waypoints"] = [geocoded[0], *middle, geocoded[-1]]
+
+    return remapped
+
+
+class DirectionsCache:
+    """
+    TieredCacheの "directions" 名前空間を使うDirections結果のキャッシュ
+    """
+
+    namespace = "directions"
+
+    def __init__(self, cache, bucket_seconds=DIRECTIONS_DEPARTURE_BUCKET):
+        self.cache = cache
+        self.bucket_seconds = bucket_seconds
+        self.cache.ttls.setdefault(self.namespace, DIRECTIONS_CACHE_TTL)
+
+    def key(self, origin, destination, waypoints, mode, departure_time, optimize):
+        return directions_cache_key(
+            origin,
+            destination,
+            waypoints,
+            mode,
+            departure_time,
+            self.bucket_seconds,
+            optimize,
+        )
+
+    def get(
+        self,
+        origin,
+        destination,
+        waypoints,
+        mode="driving",
+        departure_time="now",
+        optimize=True,
+    ):
+        """
+        経由地の集合が一致するキャッシュがあれば、今回の並びに合わせた結果を返す
+        """
+        hit, entry = self.cache.get(
+            self.namespace,
+            self.key(origin, destination, waypoints, mode, departure_time, optimize),
+        )
+        if not hit:
+            return None
+        return remap_waypoints(entry["result"], entry["waypoints"], waypoints or [])
+
+    def set(
+        self,
+        origin,
+        destination,
+        waypoints,
+        result,
+        mode="driving",
+        departure_time="now",
+        optimize=True,
+    ):
+        # エラー応答はキャッシュしない
+        if result.get("status") != "OK":
+            return
+        self.cache.set(
+            self.namespace,
+            self.key(origin, destination, waypoints, mode, departure_time, optimize),
+            {"waypoints": list(waypoints or []), "result": result},
+        )
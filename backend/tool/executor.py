@@ -0,0 +1,92 @@
+"""
+Google Maps API などのブロッキング呼び出しを、イベントループを止めずに実行するためのモジュール
+"""
+
+import asyncio
+import functools
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from tool.scheduler import PRIORITY_ROUTE, SCHEDULER_MAX_QUEUE, PrioritySemaphore
+
+# 外部APIを同時に呼び出す数の上限 (環境変数で変更可能)
+DEFAULT_CONCURRENCY = int(os.getenv("GOOGLE_API_CONCURRENCY", "8"))
+
+
+class BlockingExecutor:
+    """
+    同期APIをスレッドプール上で実行し、同時実行数をセマフォで制限する
+    空きを待つ呼び出しは優先度の高いものから実行し、待ち行列が上限を超えた場合は受け付けない
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, max_queue=SCHEDULER_MAX_QUEUE):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="blocking-api"
+        )
+        # セマフォはイベントループに紐づくため、ループごとに作成する
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._rejected = {}
+
+    def _semaphore(self, loop):
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = PrioritySemaphore(
+                self.concurrency, self.max_queue, rejected=self._rejected
+            )
+            self._semaphores[loop] = semaphore
+        return semaphore
+
+    async def run(self, func, *args, **kwargs):
+        """
+        funcを別スレッドで実行し、結果を返す
+        """
+        return await self.submit(PRIORITY_ROUTE, func, *args, **kwargs)
+
+    async def submit(self, priority, func, *args, **kwargs):
+        """
+        funcを優先度priorityで別スレッドで実行し、結果を返す
+        セマフォは呼び出し中のみ保持するため、入れ子のfan-outでもデッドロックしない
+        キャンセルされた場合も、セマフォはスレッドの処理が終わってから返す
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphore(loop)
+        await semaphore.acquire(priority)
+        try:
+            future = loop.run_in_executor(
+                self._pool, functools.partial(func, *args, **kwargs)
+            )
+        except BaseException:
+            semaphore.release()
+            raise
+        # 締め切りなどで待つ側がキャンセルされてもスレッドの処理は止まらないため、
+        # 処理が終わるまで枠を返さない
+        future.add_done_callback(lambda _: semaphore.release())
+        return await asyncio.shield(future)
+
+    async def map(self, func, items):
+        """
+        itemsの各要素にfuncを並列に適用し、入力と同じ順番で結果を返す
+        """
+        return await asyncio.gather(*(func(item) for item in items))
+
+    def queue_depth(self):
+        """
+        優先度ごとの、実行を待っている呼び出しの数
+        """
+        depth = {}
+        for semaphore in list(self._semaphores.values()):
+            for priority, count in semaphore.waiting_by_priority().items():
+                depth[priority] = depth.get(priority, 0) + count
+        return depth
+
+    def rejected(self):
+        """
+        優先度ごとの、待ち行列の上限により受け付けなかった呼び出しの数
+        """
+        return dict(self._rejected)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,359 @@
+"""
+スレッドごとの対話履歴を、件数・時間・トークン数の上限付きで保持するモジュール
+"""
+
+import json
+import os
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# 保持するスレッド数の上限
+HISTORY_MAX_THREADS = int(os.getenv("HISTORY_MAX_THREADS", "10000"))
+# 1スレッドあたりに保持するメッセージ数の上限
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "40"))
+# 最後のアクセスからこの秒数が経過したスレッドは破棄する
+HISTORY_IDLE_TTL = int(os.getenv("HISTORY_IDLE_TTL", str(6 * 3600)))
+# モデルに送る履歴のトークン数の上限
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+# 履歴の保存先 ("memory" または "sqlite")
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "memory")
+# HISTORY_BACKEND=sqlite の場合のデータベースファイル
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", os.path.join(".data", "history.sqlite3"))
+
+
+def estimate_tokens(text):
+    """
+    トークン数の概算 (英数字は約4文字で1トークン、日本語などは1文字1トークン)
+    """
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars) + 4
+
+
+def compact_content(content):
+    """
+    JSON形式の応答は空白を取り除いて保存し、再送時のトークン数を減らす
+    """
+    try:
+        return json.dumps(
+            json.loads(content), ensure_ascii=False, separators=(",", ":")
+        )
+    except (TypeError, ValueError):
+        return content
+
+
+def fit_token_budget(messages, token_budget):
+    """
+    新しいメッセージから順に、トークン数の上限に収まる分だけを返す
+    user/assistantの組が途中で切れないよう、先頭のassistantは取り除く
+    最新の発言は上限を超えていても必ず残す
+    """
+    window = []
+    used = 0
+    for message in reversed(messages):
+        tokens = message.get("tokens") or estimate_tokens(message["content"])
+        if window and used + tokens > token_budget:
+            break
+        window.append(message)
+        used += tokens
+    window.reverse()
+    while len(window) > 1 and window[0]["role"] == "assistant":
+        window.pop(0)
+    return [{"role": m["role"], "content": m["content"]} for m in window]
+
+
+class HistoryStore(ABC):
+    """
+    対話履歴ストアの共通部分
+    サブクラスは messages / append / clear / stats を実装する
+    """
+
+    def __init__(
+        self,
+        max_threads=HISTORY_MAX_THREADS,
+        max_messages=HISTORY_MAX_MESSAGES,
+        idle_ttl=HISTORY_IDLE_TTL,
+        token_budget=HISTORY_TOKEN_BUDGET,
+    ):
+        self.max_threads = max_threads
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self.token_budget = token_budget
+
+    def window(self, thread_id, token_budget=None):
+        """
+        モデルに送る直近の履歴を返す
+        """
+        return fit_token_budget(
+            self.messages(thread_id),
+            self.token_budget if token_budget is None else token_budget,
+        )
+
+    @abstractmethod
+    def messages(self, thread_id):
+        """
+        スレッドの履歴を古い順に返す (要素は role / content / tokens を持つ辞書)
+        """
+
+    @abstractmethod
+    def append(self, thread_id, role, content):
+        """
+        メッセージを1件追加する
+        """
+
+    @abstractmethod
+    def clear(self, thread_id):
+        """
+        スレッドの履歴を削除する
+        """
+
+    @abstractmethod
+    def stats(self):
+        """
+        保持しているスレッド数・メッセージ数などを返す
+        """
+
+
+class InMemoryHistoryStore(HistoryStore):
+    """
+    対話履歴をプロセスのメモリ上に保持する
+    - スレッド数が上限を超えたら、最も長く使われていないスレッドから破棄 (LRU)
+    - 一定時間アクセスのないスレッドは破棄
+    - 1スレッドのメッセージ数が上限を超えたら、古いものから破棄
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._threads = OrderedDict()
+        self._lock = threading.Lock()
+        self._evicted_threads = 0
+        self._trimmed_messages = 0
+
+    def messages(self, thread_id):
+        with self._lock:
+            self._expire_idle()
+            thread = self._threads.get(thread_id)
+            if thread is None:
+                return []
+            thread["last_access"] = time.time()
+            self._threads.move_to_end(thread_id)
+            return list(thread["messages"])
+
+    def append(self, thread_id, role, content):
+        content = compact_content(content)
+        message = {"role": role, "content": content, "tokens": estimate_tokens(content)}
+        with self._lock:
+            # 期限切れのスレッドに追記した場合に古い発言が残らないよう、先に破棄する
+            self._expire_idle()
+            thread = self._threads.get(thread_id)
+            if thread is None:
+                thread = {"messages": [], "last_access": 0.0}
+                self._threads[thread_id] = thread
+            thread["messages"].append(message)
+            thread["last_access"] = time.time()
+            self._threads.move_to_end(thread_id)
+
+            overflow = len(thread["messages"]) - self.max_messages
+            if overflow > 0:
+                del thread["messages"][:overflow]
+                self._trimmed_messages += overflow
+
+            while len(self._threads) > self.max_threads:
+                self._threads.popitem(last=False)
+                self._evicted_threads += 1
+
+    def clear(self, thread_id):
+        with self._lock:
+            self._threads.pop(thread_id, None)
+
+    def _expire_idle(self):
+        # ロックを保持した状態で呼び出すこと
+        # OrderedDictは最終アクセス順に並んでいるため、先頭から調べればよい
+        deadline = time.time() - self.idle_ttl
+        while self._threads:
+            thread_id, thread = next(iter(self._threads.items()))
+            if thread["last_access"] > deadline:
+                break
+            del self._threads[thread_id]
+            self._evicted_threads += 1
+
+    def stats(self):
+        with self._lock:
+            message_count = sum(len(t["messages"]) for t in self._threads.values())
+            content_bytes = sum(
+                len(m["content"].encode("utf-8"))
+                for t in self._threads.values()
+                for m in t["messages"]
+            )
+            return {
+                "backend": "memory",
+                "threads": len(self._threads),
+                "messages": message_count,
+                "content_bytes": content_bytes,
+                "evicted_threads": self._evicted_threads,
+                "trimmed_messages": self._trimmed_messages,
+            }
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    対話履歴をSQLiteに保持する (同じホスト上の複数ワーカーで共有できる)
+    書き込みは追記のみで、古いメッセージや期限切れのスレッドは定期的にまとめて削除する
+    追記はコミットしてから返すため、同じスレッドの次のリクエストは必ず直前の発言を読める
+    """
+
+    # この回数の追記ごとに古いデータを削除する
+    cleanup_interval = 200
+
+    def __init__(self, path=HISTORY_DB_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._appends = 0
+        self._evicted_threads = 0
+        self._trimmed_messages = 0
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    thread_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    tokens INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS messages_thread ON messages (thread_id, id);
+                CREATE TABLE IF NOT EXISTS threads (
+                    thread_id TEXT PRIMARY KEY,
+                    last_access REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS threads_last_access ON threads (last_access);
+                """)
+            self._db.commit()
+
+    def _expire_thread(self, thread_id):
+        # ロックを保持した状態で呼び出すこと
+        # 期限切れのスレッドは、次の追記で古い発言が復活しないようここで削除する
+        # スレッドが (期限内に) 存在すればTrueを返す
+        row = self._db.execute(
+            "SELECT last_access FROM threads WHERE thread_id = ?", (thread_id,)
+        ).fetchone()
+        if row is None:
+            return False
+        if row[0] > time.time() - self.idle_ttl:
+            return True
+        self._db.execute("DELETE FROM messages WHERE thread_id = ?", (thread_id,))
+        self._db.execute("DELETE FROM threads WHERE thread_id = ?", (thread_id,))
+        self._db.commit()
+        self._evicted_threads += 1
+        return False
+
+    def messages(self, thread_id):
+        with self._lock:
+            if not self._expire_thread(thread_id):
+                return []
+            rows = self._db.execute(
+                """
+                SELECT role, content, tokens FROM messages
+                WHERE thread_id = ? ORDER BY id DESC LIMIT ?
+                """,
+                (thread_id, self.max_messages),
+            ).fetchall()
+            self._db.execute(
+                "UPDATE threads SET last_access = ? WHERE thread_id = ?",
+                (time.time(), thread_id),
+            )
+            self._db.commit()
+        return [
+            {"role": role, "content": content, "tokens": tokens}
+            for role, content, tokens in reversed(rows)
+        ]
+
+    def append(self, thread_id, role, content):
+        content = compact_content(content)
+        with self._lock:
+            self._expire_thread(thread_id)
+            self._db.execute(
+                "INSERT INTO messages (thread_id, role, content, tokens) VALUES (?, ?, ?, ?)",
+                (thread_id, role, content, estimate_tokens(content)),
+            )
+            self._db.execute(
+                """
+                INSERT INTO threads (thread_id, last_access) VALUES (?, ?)
+                ON CONFLICT (thread_id) DO UPDATE SET last_access = excluded.last_access
+                """,
+                (thread_id, time.time()),
+            )
+            self._db.commit()
+            self._appends += 1
+            if self._appends % self.cleanup_interval == 0:
+                self._cleanup()
+
+    def _cleanup(self):
+        # ロックを保持した状態で呼び出すこと
+        deadline = time.time() - self.idle_ttl
+        expired = self._db.execute(
+            "DELETE FROM threads WHERE last_access <= ?", (deadline,)
+        ).rowcount
+        overflow = self._db.execute(
+            """
+            DELETE FROM threads WHERE thread_id IN (
+                SELECT thread_id FROM threads ORDER BY last_access DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_threads,),
+        ).rowcount
+        self._evicted_threads += expired + overflow
+        self._db.execute(
+            "DELETE FROM messages WHERE thread_id NOT IN (SELECT thread_id FROM threads)"
+        )
+        self._trimmed_messages += self._db.execute(
+            """
+            DELETE FROM messages WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (
+                        PARTITION BY thread_id ORDER BY id DESC
+                    ) AS position FROM messages
+                ) WHERE position > ?
+            )
+            """,
+            (self.max_messages,),
+        ).rowcount
+        self._db.commit()
+
+    def clear(self, thread_id):
+        with self._lock:
+            self._db.execute("DELETE FROM messages WHERE thread_id = ?", (thread_id,))
+            self._db.execute("DELETE FROM threads WHERE thread_id = ?", (thread_id,))
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            threads = self._db.execute("SELECT COUNT(*) FROM threads").fetchone()[0]
+            messages, content_bytes = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0) FROM messages"
+            ).fetchone()
+        return {
+            "backend": "sqlite",
+            "threads": threads,
+            "messages": messages,
+            "content_bytes": content_bytes,
+            "evicted_threads": self._evicted_threads,
+            "trimmed_messages": self._trimmed_messages,
+        }
+
+
+def create_history_store(backend=HISTORY_BACKEND, **kwargs):
+    """
+    HISTORY_BACKEND に応じた履歴ストアを作成する
+    """
+    if backend == "memory":
+        return InMemoryHistoryStore(**kwargs)
+    if backend == "sqlite":
+        return SQLiteHistoryStore(**kwargs)
+    raise ValueError(f"Unknown history backend: {backend}")
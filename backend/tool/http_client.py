@@ -0,0 +1,126 @@
+"""
+Google APIへのHTTPリクエストを送る共有クライアント
+接続プールを使い回し、タイムアウトと再試行 (ジッター付きの指数バックオフ) を行う
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tool.executor import DEFAULT_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# 接続プールの大きさ (同時に外部APIを呼び出す数に合わせる)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(max(DEFAULT_CONCURRENCY, 10))))
+# 接続・読み込みのタイムアウト (秒)
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+# 再試行の回数と、バックオフの基準・上限 (秒)
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.25"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "4"))
+# googlemaps.Client が再試行を続ける最大時間 (秒)
+GOOGLE_RETRY_TIMEOUT = float(os.getenv("GOOGLE_RETRY_TIMEOUT", "20"))
+
+
+def is_retryable(response):
+    """
+    5xx、429、またはGoogle APIがOVER_QUERY_LIMITを返した場合に再試行する
+    """
+    if response.status_code >= 500 or response.status_code == 429:
+        return True
+    # 応答全体をパースする前に、文字列として含まれるかを確認する
+    if b"OVER_QUERY_LIMIT" not in response.content:
+        return False
+    try:
+        return response.json().get("status") == "OVER_QUERY_LIMIT"
+    except ValueError:
+        return False
+
+
+def backoff_delay(attempt, base=HTTP_BACKOFF_BASE, cap=HTTP_BACKOFF_MAX):
+    """
+    attempt回目の再試行までの待ち時間 (Full Jitter)
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class PooledHttpClient:
+    """
+    接続プールを持つrequests.Sessionを包み、タイムアウトと再試行を付けたGETを提供する
+    同期版の get と、イベントループを止めない get_async の両方を持つ
+    """
+
+    def __init__(
+        self,
+        pool_size=HTTP_POOL_SIZE,
+        timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+        max_retries=HTTP_MAX_RETRIES,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        # 再試行はこのクラスで行うため、urllib3の再試行は無効にする
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, params=None, timeout=None, **kwargs):
+        """
+        GETリクエストを送り、再試行しても失敗した場合は最後の応答を返す
+        接続エラー・タイムアウトが続いた場合は最後の例外を送出する
+        """
+        timeout = self.timeout if timeout is None else timeout
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                response = self.session.get(
+                    url, params=params, timeout=timeout, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+                logger.info("HTTP request failed, retrying (%d)", attempt + 1)
+            else:
+                if last_attempt or not is_retryable(response):
+                    return response
+                logger.info(
+                    "HTTP request returned %d, retrying (%d)",
+                    response.status_code,
+                    attempt + 1,
+                )
+            time.sleep(backoff_delay(attempt))
+
+    async def get_async(self, url, params=None, timeout=None, **kwargs):
+        """
+        getを別スレッドで実行する
+        """
+        return await asyncio.to_thread(
+            self.get, url, params=params, timeout=timeout, **kwargs
+        )
+
+    def close(self):
+        self.session.close()
+
+    def google_maps_options(self):
+        """
+        googlemaps.Client に同じ接続プールとタイムアウトを使わせるための引数
+        (googlemaps.Client は5xxをジッター付きで再試行する。
+        OVER_QUERY_LIMITはレート制限と合わせて呼び出し側で扱うため再試行しない)
+        """
+        connect_timeout, read_timeout = self.timeout
+        return {
+            "requests_session": self.session,
+            "connect_timeout": connect_timeout,
+            "read_timeout": read_timeout,
+            "retry_timeout": GOOGLE_RETRY_TIMEOUT,
+            "retry_over_query_limit": False,
+        }
@@ -0,0 +1,66 @@
+"""
+生成AIがストリーミングで返すJSONを、届いた分だけ読み進めるためのモジュール
+応答が終わるのを待たず、値の文字列が閉じた時点でその値を取り出せる
+"""
+
+import json
+
+
+class IncrementalJsonParser:
+    """
+    JSONの文字列を少しずつ受け取り、完成した文字列の値を (パス, 値) として返す
+    パスはキーと配列の番号のタプル (例: {"result":{"name":["a"]}} の "a" は ("result", "name", 0))
+    構文の検証はしない (最後に全体をjson.loadsで読み直すこと)
+    """
+
+    def __init__(self):
+        # 開いているオブジェクト・配列。[種類, 現在のキーまたは番号, キーを待っているか]
+        self._stack = []
+        self._string = None
+        self._escape = False
+
+    def _path(self):
+        return tuple(frame[1] for frame in self._stack)
+
+    def _close_string(self):
+        value = json.loads(f'"{"".join(self._string)}"')
+        self._string = None
+        if self._stack and self._stack[-1][0] == "object" and self._stack[-1][2]:
+            # オブジェクトのキー
+            self._stack[-1][1] = value
+            self._stack[-1][2] = False
+            return None
+        return self._path(), value
+
+    def feed(self, text):
+        """
+        textを読み進め、その中で閉じた文字列の値を (パス, 値) のリストで返す
+        """
+        completed = []
+        for char in text:
+            if self._string is not None:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    value = self._close_string()
+                    if value is not None:
+                        completed.append(value)
+                    continue
+                self._string.append(char)
+            elif char == '"':
+                self._string = []
+            elif char == "{":
+                self._stack.append(["object", None, True])
+            elif char == "[":
+                self._stack.append(["array", 0, False])
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+            elif char == "," and self._stack:
+                if self._stack[-1][0] == "object":
+                    self._stack[-1][2] = True
+                else:
+                    self._stack[-1][1] += 1
+        return completed
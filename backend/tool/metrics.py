@@ -0,0 +1,323 @@
+"""
+Prometheusのテキスト形式で公開するメトリクス (カウンタ・ゲージ・ヒストグラム)
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# 既定のヒストグラムのバケット (秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = (
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+        ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """
+        他の場所で集計済みの累計値をそのまま反映する (collector用)
+        """
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                self._values[key] = state
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def _render_sample(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state["counts"]):
+            cumulative += count
+            labels = _format_labels(
+                self.labelnames + ("le",), key + (_format_value(bound),)
+            )
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state['sum'])}")
+        lines.append(f"{self.name}_count{labels} {state['count']}")
+        return lines
+
+
+class Registry:
+    """
+    メトリクスと、出力時に値を集める関数 (collector) をまとめて管理する
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, *args, **kwargs):
+        return self._register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self._register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self._register(Histogram(*args, **kwargs))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        collector: /metrics の出力直前に呼ばれ、ゲージなどを最新の値に更新する関数
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_duration = registry.histogram(
+    "itinerary_stage_duration_seconds",
+    "Duration of each generate_response pipeline stage.",
+    ["stage"],
+)
+critical_path_stages = registry.counter(
+    "itinerary_critical_path_total",
+    "Number of requests whose critical path went through each pipeline stage.",
+    ["stage"],
+)
+external_api_duration = registry.histogram(
+    "external_api_request_duration_seconds",
+    "Latency of outbound API calls.",
+    ["api"],
+)
+external_api_requests = registry.counter(
+    "external_api_requests_total", "Outbound API calls.", ["api"]
+)
+external_api_errors = registry.counter(
+    "external_api_errors_total", "Outbound API calls that raised an error.", ["api"]
+)
+http_requests_in_flight = registry.gauge(
+    "http_requests_in_flight", "Requests currently being processed.", ["path"]
+)
+http_requests = registry.counter(
+    "http_requests_total", "Handled HTTP requests.", ["path", "status"]
+)
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time to produce the response headers.", ["path"]
+)
+cache_hits = registry.counter("cache_hits_total", "Cache hits.", ["cache", "tier"])
+cache_misses = registry.counter("cache_misses_total", "Cache misses.", ["cache"])
+cache_evictions = registry.counter(
+    "cache_evictions_total", "In-memory LRU evictions.", ["cache"]
+)
+cache_hit_ratio = registry.gauge(
+    "cache_hit_ratio", "Cache hits / lookups since process start.", ["cache"]
+)
+
+
+def observe_cache(name, get_cache):
+    """
+    TieredCacheの統計値を出力時に反映するcollectorを登録する
+    get_cache: 集計するキャッシュを返す関数 (キャッシュが差し替えられても現在のものを集計する)
+    """
+
+    def collect():
+        stats = get_cache().stats()
+        cache_hits.set(stats["memory_hits"], cache=name, tier="memory")
+        cache_hits.set(stats["disk_hits"], cache=name, tier="disk")
+        cache_misses.set(stats["misses"], cache=name)
+        cache_evictions.set(stats["evictions"], cache=name)
+        cache_hit_ratio.set(stats["hit_ratio"], cache=name)
+
+    registry.add_collector(collect)
+
+
+def observe_prompt_cache(get_cache):
+    """
+    PromptCacheの統計値を出力時に反映するcollectorを登録する (tierは exact / similar)
+    get_cache: 集計するPromptCacheを返す関数
+    """
+
+    def collect():
+        stats = get_cache().stats()
+        cache_hits.set(stats["exact_hits"], cache="prompts", tier="exact")
+        cache_hits.set(stats["similar_hits"], cache="prompts", tier="similar")
+        cache_misses.set(stats["misses"], cache="prompts")
+        cache_hit_ratio.set(stats["hit_ratio"], cache="prompts")
+
+    registry.add_collector(collect)
+
+
+singleflight_calls = registry.counter(
+    "singleflight_calls_total",
+    "Keyed external calls by outcome (leader, coalesced, recheck_hit, wait_timeout).",
+    ["result"],
+)
+singleflight_in_flight = registry.gauge(
+    "singleflight_in_flight", "Keyed external calls currently running."
+)
+
+
+def observe_singleflight(flight):
+    """
+    SingleFlightの統計値を出力時に反映するcollectorを登録する
+    """
+
+    def collect():
+        stats = flight.stats()
+        for result in ("leader", "coalesced", "recheck_hit", "wait_timeout"):
+            singleflight_calls.set(stats[result], result=result)
+        singleflight_in_flight.set(stats["in_flight"])
+
+    registry.add_collector(collect)
+
+
+scheduler_queue_depth = registry.gauge(
+    "scheduler_queue_depth", "API calls waiting for an executor slot.", ["priority"]
+)
+scheduler_rejected = registry.counter(
+    "scheduler_rejected_total",
+    "API calls rejected because the queue was full.",
+    ["priority"],
+)
+rate_limit_wait = registry.counter(
+    "rate_limit_wait_seconds_total", "Time spent waiting for API tokens.", ["api"]
+)
+rate_limited = registry.counter(
+    "rate_limited_total", "API calls rejected by the rate limiter.", ["api"]
+)
+
+
+def observe_scheduler(executor, limiter):
+    """
+    エグゼキュータの待ち行列とレート制限の統計値を出力時に反映するcollectorを登録する
+    """
+    from tool.scheduler import PRIORITY_NAMES
+
+    def collect():
+        depth = executor.queue_depth()
+        rejected = executor.rejected()
+        for priority, name in PRIORITY_NAMES.items():
+            scheduler_queue_depth.set(depth.get(priority, 0), priority=name)
+            scheduler_rejected.set(rejected.get(priority, 0), priority=name)
+        for api, stats in limiter.stats().items():
+            rate_limit_wait.set(stats["waited_seconds"], api=api)
+            rate_limited.set(stats["limited"], api=api)
+
+    registry.add_collector(collect)
+
+
+@contextmanager
+def external_call(api):
+    """
+    外部API呼び出しの回数・エラー数・所要時間を記録する
+    """
+    external_api_requests.inc(api=api)
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        external_api_errors.inc(api=api)
+        raise
+    finally:
+        external_api_duration.observe(time.perf_counter() - started_at, api=api)
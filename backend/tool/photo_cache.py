@@ -0,0 +1,169 @@
+"""
+Place Photoの画像をディスクにキャッシュし、縮小した画像を配信するためのモジュール
+画像は内容のハッシュをファイル名として保存し (同じ画像は1つだけ保存する)、
+photo_referenceからハッシュへの対応は別のファイルに保存する
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+
+try:
+    from PIL import Image
+except ImportError:  # Pillowがなければ縮小せず、取得した画像をそのまま配信する
+    Image = None
+
+from tool.cache import CACHE_DIR
+
+# 画像を保存するディレクトリ
+PHOTO_CACHE_DIR = os.getenv("PHOTO_CACHE_DIR", os.path.join(CACHE_DIR, "photos"))
+# 配信する画像の幅 (px)。最大の幅でGoogleから取得し、それより小さいものは縮小して作る
+PHOTO_SIZES = tuple(
+    sorted({int(size) for size in os.getenv("PHOTO_SIZES", "400,120").split(",")})
+)
+# 縮小した画像 (WebP) の品質
+PHOTO_QUALITY = int(os.getenv("PHOTO_QUALITY", "80"))
+# ブラウザ・CDNに画像を保持させる時間 (秒)
+PHOTO_MAX_AGE = int(os.getenv("PHOTO_MAX_AGE", str(30 * 24 * 3600)))
+
+# 画像の先頭のバイト列と形式
+MAGIC_NUMBERS = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+]
+
+
+class PhotoNotFound(LookupError):
+    """
+    画像を取得できなかった (photo_referenceが無効など)
+    """
+
+
+def sniff_media_type(data):
+    """
+    画像のバイト列から形式を判定する。画像でなければNone
+    """
+    for magic, media_type in MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return media_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def etag_matches(if_none_match, etag):
+    """
+    If-None-Matchヘッダーにetagが含まれるか (弱いETagも同じものとみなす)
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def _write_atomic(path, data):
+    # 書き込み途中のファイルを他のワーカーが読まないよう、一時ファイルから置き換える
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class PhotoCache:
+    """
+    photo_referenceごとの画像と、その縮小版をディスクに保存する
+    """
+
+    def __init__(self, directory=PHOTO_CACHE_DIR, sizes=PHOTO_SIZES):
+        self.directory = directory
+        self.sizes = tuple(sorted(sizes))
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def fetch_width(self):
+        """
+        Googleから取得する画像の幅
+        """
+        return self.sizes[-1]
+
+    def choose_size(self, size=None):
+        """
+        要求された幅以上の最小の幅を返す (指定がなければ最大の幅)
+        """
+        if size is None:
+            return self.sizes[-1]
+        for candidate in self.sizes:
+            if candidate >= size:
+                return candidate
+        return self.sizes[-1]
+
+    def _ref_path(self, reference):
+        digest = hashlib.sha256(reference.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "refs", digest[:2], digest)
+
+    def _object_path(self, digest, name):
+        return os.path.join(self.directory, "objects", digest[:2], f"{digest}{name}")
+
+    def lookup(self, reference):
+        """
+        保存済みの画像のハッシュを返す。なければNone
+        """
+        try:
+            with open(self._ref_path(reference), encoding="ascii") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def store(self, reference, data):
+        """
+        取得した画像と縮小版を保存し、画像のハッシュを返す
+        """
+        if sniff_media_type(data) is None:
+            raise PhotoNotFound("Response is not an image")
+        digest = hashlib.sha256(data).hexdigest()
+        original = self._object_path(digest, ".orig")
+        if not os.path.exists(original):
+            _write_atomic(original, data)
+        for size in self.sizes:
+            self.variant(digest, size)
+        _write_atomic(self._ref_path(reference), digest.encode("ascii"))
+        return digest
+
+    def variant(self, digest, size):
+        """
+        幅sizeの画像の (ファイルのパス, 形式, ETag) を返す。縮小版がなければ作る
+        Pillowがない場合や縮小できない画像の場合は、元の画像を返す
+        """
+        original = self._object_path(digest, ".orig")
+        if Image is not None:
+            path = self._object_path(digest, f"-{size}.webp")
+            if os.path.exists(path) or self._resize(original, path, size):
+                return path, "image/webp", f'"{digest[:32]}-{size}"'
+        with open(original, "rb") as f:
+            media_type = sniff_media_type(f.read(16))
+        return original, media_type, f'"{digest[:32]}"'
+
+    def _resize(self, source, path, size):
+        try:
+            with Image.open(source) as image:
+                if image.width > size:
+                    height = max(1, round(image.height * size / image.width))
+                    image = image.resize((size, height), Image.LANCZOS)
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+                buffer = io.BytesIO()
+                image.save(buffer, "WEBP", quality=PHOTO_QUALITY)
+        except (OSError, ValueError):
+            return False
+        _write_atomic(path, buffer.getvalue())
+        return True
@@ -0,0 +1,545 @@
+"""
+オフラインで収集したお店 (POI) の索引
+お店の項目を列ごとのファイルに保存し、メモリマップで開いて (ワーカー間でページを共有する)
+グリッドで分けた範囲をNumPyでまとめて検索する
+収集した範囲 (検索した円) も保存し、その外の地点はこれまで通りPlaces APIで検索する
+
+使い方 (backendディレクトリで実行):
+    python -m tool.poi_index crawl 34.985,135.755,35.005,135.775
+        (南西の緯度,経度,北東の緯度,経度 の範囲をPlaces APIで検索して索引に加える)
+    python -m tool.poi_index fixtures fixtures/external_api
+        (EXTERNAL_API_MODE=record で保存したフィクスチャから索引を作る)
+    python -m tool.poi_index stats
+索引を作り直した後は、サーバーを再起動すると読み込まれる
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from tool.cache import CACHE_DIR
+from tool.route_sampling import EARTH_RADIUS
+
+# 索引を保存するディレクトリ
+POI_INDEX_DIR = os.getenv("POI_INDEX_DIR", os.path.join(CACHE_DIR, "poi_index"))
+# お店を分けるグリッドの大きさ (m)。検索する半径以上にする
+POI_INDEX_CELL_SIZE = float(os.getenv("POI_INDEX_CELL_SIZE", "200"))
+# 収集時に検索する地点の間隔と半径 (m)
+# 半径が (アプリの検索半径 + 間隔/√2) 以上あれば、範囲内のどの地点の検索円も収集した円に含まれる
+POI_CRAWL_SPACING = float(os.getenv("POI_CRAWL_SPACING", "150"))
+POI_CRAWL_RADIUS = float(os.getenv("POI_CRAWL_RADIUS", "250"))
+# 収集時に並列に実行する検索・詳細取得の数
+POI_CRAWL_CONCURRENCY = int(os.getenv("POI_CRAWL_CONCURRENCY", "8"))
+# 1地点で取得する検索結果のページ数の上限 (1ページ20件。残りがある円は収集済みとしない)
+POI_CRAWL_MAX_PAGES = int(os.getenv("POI_CRAWL_MAX_PAGES", "3"))
+
+# 文字列の列 (UTF-8のバイト列と、各行の開始位置で保存する)
+STRING_COLUMNS = (
+    "place_id",
+    "name",
+    "website",
+    "address",
+    "photo_reference",
+    "types",
+    "category",
+)
+FORMAT_VERSION = 1
+
+
+def cell_keys(lat, lng, cell_size):
+    """
+    各地点のグリッドのセル番号 (int64) を返す (spatial_index.GridIndex と同じ区切り方)
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    y = np.radians(lat) * EARTH_RADIUS
+    x = np.radians(lng) * EARTH_RADIUS * np.cos(np.radians(lat))
+    return _combine(np.floor(y / cell_size), np.floor(x / cell_size))
+
+
+def _combine(row, column):
+    return (row.astype(np.int64) << 32) + (column.astype(np.int64) + (1 << 31))
+
+
+def distances(lat1, lng1, lat2, lng2):
+    """
+    2点間の距離 (m) を要素ごとに返す (spatial_index.distance のNumPy版)
+    """
+    mean_lat = np.radians((lat1 + lat2) / 2)
+    dx = np.radians(lng2 - lng1) * np.cos(mean_lat)
+    dy = np.radians(lat2 - lat1)
+    return EARTH_RADIUS * np.hypot(dx, dy)
+
+
+class _Grid:
+    """
+    セル番号順に並べた地点の列と、セルごとの範囲
+    """
+
+    def __init__(self, lat, lng, cells, offsets, cell_size):
+        self.lat = lat
+        self.lng = lng
+        self.cells = cells
+        self.offsets = offsets
+        self.cell_size = cell_size
+
+    def candidates(self, lat, lng):
+        """
+        各クエリ地点の周囲3x3セルにある行を (クエリの番号, 行番号) の配列で返す
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        y = np.floor(np.radians(lat) * EARTH_RADIUS / self.cell_size)
+        x = np.floor(
+            np.radians(lng) * EARTH_RADIUS * np.cos(np.radians(lat)) / self.cell_size
+        )
+        shifts = np.array([-1, 0, 1])
+        rows = (y[:, None, None] + shifts[None, :, None]).repeat(3, axis=2)
+        columns = (x[:, None, None] + shifts[None, None, :]).repeat(3, axis=1)
+        keys = _combine(rows, columns).reshape(len(lat), 9)
+
+        position = np.searchsorted(self.cells, keys)
+        found = position < len(self.cells)
+        found[found] = self.cells[position[found]] == keys[found]
+        queries = np.nonzero(found)[0]
+        position = position[found]
+        starts = self.offsets[position]
+        lengths = self.offsets[position + 1] - starts
+        total = int(lengths.sum())
+        if not total:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # 各セルの範囲 [start, start + length) をつなげた行番号
+        first = np.cumsum(lengths) - lengths
+        rows = np.repeat(starts - first, lengths) + np.arange(total)
+        return np.repeat(queries, lengths), rows
+
+
+def _grid_order(lat, lng, cell_size):
+    keys = cell_keys(lat, lng, cell_size)
+    order = np.argsort(keys, kind="stable")
+    cells, starts = np.unique(keys[order], return_index=True)
+    offsets = np.append(starts, len(order)).astype(np.int64)
+    return order, cells, offsets
+
+
+class PoiIndex:
+    """
+    保存済みの索引。open() で開き、search() で検索する
+    """
+
+    def __init__(self, directory, meta, columns):
+        self.directory = directory
+        self.meta = meta
+        self._columns = columns
+        self.stores = _Grid(
+            columns["lat"],
+            columns["lng"],
+            columns["cells"],
+            columns["offsets"],
+            meta["cell_size"],
+        )
+        self.coverage = _Grid(
+            columns["coverage_lat"],
+            columns["coverage_lng"],
+            columns["coverage_cells"],
+            columns["coverage_offsets"],
+            meta["coverage_cell_size"],
+        )
+        self.coverage_radius = columns["coverage_radius"]
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    @classmethod
+    def open(cls, directory=POI_INDEX_DIR):
+        """
+        索引を開く。索引がなければNone
+        """
+        meta_path = os.path.join(directory, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            return None
+        columns = {}
+        for name in meta["arrays"]:
+            columns[name] = np.load(
+                os.path.join(directory, f"{name}.npy"), mmap_mode="r"
+            )
+        for name in STRING_COLUMNS:
+            path = os.path.join(directory, f"{name}.bin")
+            # 空のファイルはメモリマップできない
+            columns[name] = (
+                np.memmap(path, dtype=np.uint8, mode="r")
+                if os.path.getsize(path)
+                else np.zeros(0, dtype=np.uint8)
+            )
+        return cls(directory, meta, columns)
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def _string(self, name, row):
+        offsets = self._columns[f"{name}_offsets"]
+        start, end = int(offsets[row]), int(offsets[row + 1])
+        return self._columns[name][start:end].tobytes().decode("utf-8")
+
+    def record(self, row):
+        """
+        行rowの項目を辞書で返す
+        """
+        rating = float(self._columns["rating"][row])
+        types = self._string("types", row)
+        return {
+            "place_id": self._string("place_id", row),
+            "name": self._string("name", row),
+            "website": self._string("website", row),
+            "address": self._string("address", row),
+            "rating": None if math.isnan(rating) else rating,
+            "user_ratings_total": int(self._columns["user_ratings_total"][row]),
+            "location": {
+                "lat": float(self._columns["lat"][row]),
+                "lng": float(self._columns["lng"][row]),
+            },
+            "photo_reference": self._string("photo_reference", row) or None,
+            "types": types.split(",") if types else [],
+            "category": self._string("category", row) or None,
+        }
+
+    def covered(self, points, radius):
+        """
+        各地点を中心とする半径radiusの円が、収集した円のどれかに含まれるかを返す
+        """
+        lat = np.array([point[0] for point in points], dtype=np.float64)
+        lng = np.array([point[1] for point in points], dtype=np.float64)
+        result = np.zeros(len(points), dtype=bool)
+        queries, rows = self.coverage.candidates(lat, lng)
+        if len(rows):
+            d = distances(
+                lat[queries],
+                lng[queries],
+                self.coverage.lat[rows],
+                self.coverage.lng[rows],
+            )
+            inside = d + radius <= self.coverage_radius[rows]
+            result[queries[inside]] = True
+        return result
+
+    def search(self, points, radius):
+        """
+        各地点から半径radius以内のお店の行番号を、近い順の配列で返す
+        収集した範囲の外の地点はNone (Places APIで検索する)
+        """
+        lat = np.array([point[0] for point in points], dtype=np.float64)
+        lng = np.array([point[1] for point in points], dtype=np.float64)
+        covered = self.covered(points, radius)
+        results = [np.zeros(0, dtype=np.int64) if c else None for c in covered]
+
+        queries, rows = self.stores.candidates(lat, lng)
+        keep = covered[queries]
+        queries, rows = queries[keep], rows[keep]
+        if len(rows):
+            d = distances(
+                lat[queries], lng[queries], self.stores.lat[rows], self.stores.lng[rows]
+            )
+            inside = d <= radius
+            queries, rows, d = queries[inside], rows[inside], d[inside]
+            order = np.lexsort((d, queries))
+            queries, rows = queries[order], rows[order]
+            bounds = np.searchsorted(queries, np.arange(len(points) + 1))
+            for i in np.nonzero(covered)[0]:
+                results[i] = rows[bounds[i] : bounds[i + 1]]
+
+        with self._lock:
+            self._stats["hits"] += int(covered.sum())
+            self._stats["misses"] += int(len(points) - covered.sum())
+        return results
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(
+            stores=self.meta["count"],
+            coverage_circles=self.meta["coverage_count"],
+            built_at=self.meta["built_at"],
+        )
+        return stats
+
+
+def write_index(directory, records, circles, cell_size=POI_INDEX_CELL_SIZE):
+    """
+    お店のリスト (recordの形の辞書) と収集した円 (lat, lng, radius) のリストから索引を作る
+    作り終えてからディレクトリを置き換えるため、開いている索引はそのまま使える
+    """
+    records = list(records)
+    circles = list(circles)
+    lat = np.array([r["location"]["lat"] for r in records], dtype=np.float64)
+    lng = np.array([r["location"]["lng"] for r in records], dtype=np.float64)
+    order, cells, offsets = _grid_order(lat, lng, cell_size)
+    records = [records[i] for i in order]
+
+    coverage_radius = np.array([c[2] for c in circles], dtype=np.float64)
+    coverage_cell_size = float(max(coverage_radius.max(initial=0), cell_size))
+    coverage_lat = np.array([c[0] for c in circles], dtype=np.float64)
+    coverage_lng = np.array([c[1] for c in circles], dtype=np.float64)
+    coverage_order, coverage_cells, coverage_offsets = _grid_order(
+        coverage_lat, coverage_lng, coverage_cell_size
+    )
+
+    arrays = {
+        "lat": lat[order],
+        "lng": lng[order],
+        "cells": cells,
+        "offsets": offsets,
+        "rating": np.array(
+            [
+                r["rating"] if isinstance(r.get("rating"), (int, float)) else np.nan
+                for r in records
+            ],
+            dtype=np.float64,
+        ),
+        "user_ratings_total": np.array(
+            [r.get("user_ratings_total") or 0 for r in records], dtype=np.int32
+        ),
+        "coverage_lat": coverage_lat[coverage_order],
+        "coverage_lng": coverage_lng[coverage_order],
+        "coverage_radius": coverage_radius[coverage_order].astype(np.float32),
+        "coverage_cells": coverage_cells,
+        "coverage_offsets": coverage_offsets,
+    }
+
+    staging = f"{directory}.tmp-{os.getpid()}"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    for name in STRING_COLUMNS:
+        values = []
+        for r in records:
+            value = r.get(name)
+            if name == "types" and isinstance(value, list):
+                value = ",".join(value)
+            values.append(str(value or "").encode("utf-8"))
+        arrays[f"{name}_offsets"] = np.cumsum([0] + [len(v) for v in values])
+        with open(os.path.join(staging, f"{name}.bin"), "wb") as f:
+            f.write(b"".join(values))
+    for name, array in arrays.items():
+        np.save(os.path.join(staging, f"{name}.npy"), array)
+    meta = {
+        "version": FORMAT_VERSION,
+        "count": len(records),
+        "coverage_count": len(circles),
+        "cell_size": cell_size,
+        "coverage_cell_size": coverage_cell_size,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "arrays": sorted(arrays),
+    }
+    with open(os.path.join(staging, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+    previous = f"{directory}.old-{os.getpid()}"
+    if os.path.exists(directory):
+        os.replace(directory, previous)
+    os.replace(staging, directory)
+    shutil.rmtree(previous, ignore_errors=True)
+    return meta
+
+
+def existing_entries(directory):
+    """
+    保存済みの索引の (お店のリスト, 収集した円のリスト)。索引がなければ空
+    """
+    index = PoiIndex.open(directory)
+    if index is None:
+        return [], []
+    records = [index.record(row) for row in range(len(index))]
+    circles = list(
+        zip(
+            index.coverage.lat.tolist(),
+            index.coverage.lng.tolist(),
+            index.coverage_radius.tolist(),
+        )
+    )
+    return records, circles
+
+
+# ---------------------------------------------------------------- 収集
+
+
+def store_record(app, place_details):
+    """
+    Place Detailsの結果を索引のrecordにする。アプリがお店として扱わない場合はNone
+    """
+    store = app.build_store(place_details)
+    if store is None or not store["location"]:
+        return None
+    photos = place_details.get("result", {}).get("photos") or [{}]
+    types = store["types"] if isinstance(store["types"], list) else []
+    return dict(
+        store,
+        rating=store["rating"] if isinstance(store["rating"], (int, float)) else None,
+        photo_reference=photos[0].get("photo_reference"),
+        types=types,
+    )
+
+
+def add_categories(app, records, classify=False):
+    """
+    キャッシュ・ルールで分かるカテゴリを付ける (classify=Trueなら残りを生成AIで分類する)
+    """
+    if classify:
+        categories = app.store_categorizer.categorize(records)
+        for record, category in zip(records, categories):
+            record["category"] = category
+        return
+    known = app.store_categorizer.lookup(records)
+    for record in records:
+        record["category"] = known.get(record["place_id"])
+
+
+def crawl_points(south, west, north, east, spacing=POI_CRAWL_SPACING):
+    """
+    範囲を間隔spacing (m) の格子で埋める検索地点
+    """
+    lat_step = math.degrees(spacing / EARTH_RADIUS)
+    points = []
+    lat = south
+    while lat <= north + lat_step / 2:
+        lng_step = lat_step / math.cos(math.radians(lat))
+        lng = west
+        while lng <= east + lng_step / 2:
+            points.append((lat, lng))
+            lng += lng_step
+        lat += lat_step
+    return points
+
+
+def crawl(app, bbox, spacing=POI_CRAWL_SPACING, radius=POI_CRAWL_RADIUS):
+    """
+    範囲内の各地点をPlaces APIで検索し、(お店のリスト, 収集した円のリスト) を返す
+    """
+
+    def search(point):
+        response = app.call_google(
+            "places_nearby",
+            app.gmaps.places_nearby,
+            location=point,
+            radius=radius,
+            type="store",
+        )
+        results = list(response.get("results", []))
+        for _ in range(POI_CRAWL_MAX_PAGES - 1):
+            token = response.get("next_page_token")
+            if not token:
+                break
+            # 次のページのトークンは発行から少し待たないと使えない
+            time.sleep(2)
+            response = app.call_google(
+                "places_nearby", app.gmaps.places_nearby, page_token=token
+            )
+            results.extend(response.get("results", []))
+        complete = not response.get("next_page_token")
+        return point, [place["place_id"] for place in results], complete
+
+    points = crawl_points(*bbox, spacing=spacing)
+    with ThreadPoolExecutor(POI_CRAWL_CONCURRENCY) as pool:
+        searched = list(pool.map(search, points))
+        place_ids = sorted({pid for _, ids, _ in searched for pid in ids})
+        details = list(pool.map(app.place_details_cached, place_ids))
+
+    records = [store_record(app, place_details) for place_details in details]
+    circles = [(lat, lng, radius) for (lat, lng), _, ok in searched if ok]
+    return [r for r in records if r is not None], circles
+
+
+def from_fixtures(app, fixture_dir):
+    """
+    記録したフィクスチャ (places_nearby / place) から (お店のリスト, 収集した円のリスト) を作る
+    """
+    circles = []
+    for request, response in _fixtures(fixture_dir, "places_nearby"):
+        if request.get("type") != "store" or "location" not in request:
+            continue
+        if not response.get("next_page_token"):
+            lat, lng = request["location"]
+            circles.append((float(lat), float(lng), float(request["radius"])))
+    records = [
+        store_record(app, response) for _, response in _fixtures(fixture_dir, "place")
+    ]
+    return [r for r in records if r is not None], circles
+
+
+def _fixtures(fixture_dir, endpoint):
+    directory = os.path.join(fixture_dir, endpoint)
+    if not os.path.isdir(directory):
+        return
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), encoding="utf-8") as f:
+            fixture = json.load(f)
+        yield fixture["request"], fixture["response"]
+
+
+def merge(old_records, old_circles, records, circles):
+    """
+    保存済みの索引に新しく収集したものを加える (同じplace_idは新しいものを使う)
+    """
+    merged = {r["place_id"]: r for r in old_records}
+    merged.update((r["place_id"], r) for r in records)
+    return list(merged.values()), list(dict.fromkeys(old_circles + circles))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--directory", default=POI_INDEX_DIR, help="索引のディレクトリ")
+    commands = parser.add_subparsers(dest="command", required=True)
+    crawl_parser = commands.add_parser("crawl", help="Places APIで範囲を収集する")
+    crawl_parser.add_argument("bbox", help="南西の緯度,経度,北東の緯度,経度")
+    crawl_parser.add_argument("--spacing", type=float, default=POI_CRAWL_SPACING)
+    crawl_parser.add_argument("--radius", type=float, default=POI_CRAWL_RADIUS)
+    fixtures_parser = commands.add_parser("fixtures", help="フィクスチャから作る")
+    fixtures_parser.add_argument("fixture_dir")
+    for command in (crawl_parser, fixtures_parser):
+        command.add_argument(
+            "--replace", action="store_true", help="保存済みの索引を捨てて作り直す"
+        )
+        command.add_argument(
+            "--classify",
+            action="store_true",
+            help="キャッシュにないお店のカテゴリを生成AIで分類する",
+        )
+    commands.add_parser("stats", help="索引の件数を表示する")
+    args = parser.parse_args(argv)
+
+    if args.command == "stats":
+        index = PoiIndex.open(args.directory)
+        print(json.dumps(index.stats() if index else None, ensure_ascii=False))
+        return 0 if index else 1
+
+    import decide_visit_sight as app
+
+    started_at = time.perf_counter()
+    if args.command == "crawl":
+        bbox = [float(value) for value in args.bbox.split(",")]
+        records, circles = crawl(app, bbox, args.spacing, args.radius)
+    else:
+        records, circles = from_fixtures(app, args.fixture_dir)
+    add_categories(app, records, args.classify)
+    if not args.replace:
+        records, circles = merge(*existing_entries(args.directory), records, circles)
+    meta = write_index(args.directory, records, circles)
+    print(
+        f"{meta['count']} stores, {meta['coverage_count']} circles "
+        f"({time.perf_counter() - started_at:.1f}s) -> {args.directory}",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
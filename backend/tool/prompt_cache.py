@@ -0,0 +1,155 @@
+"""
+プロンプトごとの提案 (と生成した旅程) を保持し、ほぼ同じプロンプトにも使い回すためのキャッシュ
+「京都で抹茶スイーツを食べ歩き」と「京都で抹茶スイーツ食べ歩き」のような表記の揺れを、
+文字n-gramのTF-IDFベクトルのコサイン類似度で同じものとみなす (外部のAPIは使わない)
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from tool.cache import normalize_text
+
+# 同じプロンプトとみなすコサイン類似度の下限 (1.0で完全一致のみ)
+# 語順を入れ替えた言い換えは0.5前後になるが、地名だけが違うプロンプトも同程度になるため高めにする
+PROMPT_CACHE_THRESHOLD = float(os.getenv("PROMPT_CACHE_THRESHOLD", "0.8"))
+# 保持するプロンプトの数 (超えた場合は古いものから捨てる)
+PROMPT_CACHE_MAX_ENTRIES = int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "2048"))
+# n-gramを割り当てるベクトルの次元数 (ハッシュで割り当てるため語彙を持たない)
+PROMPT_CACHE_DIM = int(os.getenv("PROMPT_CACHE_DIM", "2048"))
+# 使う文字n-gramの長さ
+PROMPT_CACHE_NGRAMS = tuple(
+    int(n) for n in os.getenv("PROMPT_CACHE_NGRAMS", "2,3").split(",")
+)
+# 保持する時間 (秒)
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", str(24 * 3600)))
+
+
+def history_key(messages):
+    """
+    対話履歴のハッシュ値 (履歴がなければ0)
+    """
+    if not messages:
+        return 0
+    text = json.dumps([[m["role"], m["content"]] for m in messages], ensure_ascii=False)
+    return int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:15], 16)
+
+
+class PromptCache:
+    """
+    (正規化したプロンプト, 対話履歴のハッシュ) ごとに、fieldの名前で値を保持する
+    完全に一致するプロンプトがない場合は、同じ履歴のプロンプトのうち最も似たものを使う
+    プロセスのメモリ上に保持する (ワーカー間では共有しない)
+    """
+
+    def __init__(
+        self,
+        threshold=PROMPT_CACHE_THRESHOLD,
+        max_entries=PROMPT_CACHE_MAX_ENTRIES,
+        dim=PROMPT_CACHE_DIM,
+        ngrams=PROMPT_CACHE_NGRAMS,
+        ttl=PROMPT_CACHE_TTL,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.dim = dim
+        self.ngrams = tuple(ngrams)
+        self.ttl = ttl
+        # 各行のn-gramの出現回数 (1 + log(回数))
+        self._tf = np.zeros((max_entries, dim), dtype=np.float32)
+        # n-gramごとの、そのn-gramを含む行の数 (IDFの計算に使う)
+        self._df = np.zeros(dim, dtype=np.float32)
+        self._histories = np.zeros(max_entries, dtype=np.int64)
+        self._expires = np.zeros(max_entries)
+        self._keys = [None] * max_entries
+        self._values = [None] * max_entries
+        self._rows = {}
+        self._next = 0
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0}
+
+    def _vector(self, text):
+        padded = f" {text} "
+        indices = [
+            zlib.crc32(padded[i : i + n].encode("utf-8")) % self.dim
+            for n in self.ngrams
+            for i in range(max(1, len(padded) - n + 1))
+        ]
+        counts = np.bincount(indices, minlength=self.dim).astype(np.float32)
+        return np.where(counts > 0, 1 + np.log(np.maximum(counts, 1)), 0)
+
+    def _similar(self, text, history, now):
+        rows = np.flatnonzero((self._histories == history) & (self._expires > now))
+        if not len(rows):
+            return None, 0.0
+        count = np.count_nonzero(self._expires)
+        idf = np.log((1 + count) / (1 + self._df)) + 1
+        query = self._vector(text) * idf
+        weights = self._tf[rows] * idf
+        norms = np.linalg.norm(weights, axis=1) * np.linalg.norm(query)
+        scores = weights @ query / np.maximum(norms, 1e-12)
+        best = int(np.argmax(scores))
+        return int(rows[best]), float(scores[best])
+
+    def get(self, prompt, history, field):
+        """
+        プロンプトと履歴のハッシュhistoryに対応するfieldの値を返す。なければNone
+        """
+        text = normalize_text(prompt)
+        now = time.time()
+        with self._lock:
+            row = self._rows.get((history, text))
+            exact = row is not None and self._expires[row] > now
+            if not exact:
+                row, score = self._similar(text, history, now)
+                if score < self.threshold:
+                    row = None
+            value = None
+            if row is not None:
+                expires, data = self._values[row].get(field, (0, None))
+                value = data if expires > now else None
+            if value is None:
+                self._stats["misses"] += 1
+            else:
+                self._stats["exact_hits" if exact else "similar_hits"] += 1
+            return value
+
+    def put(self, prompt, history, field, value, ttl=None):
+        """
+        プロンプトと履歴のハッシュhistoryに対応するfieldの値を保存する
+        """
+        text = normalize_text(prompt)
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            row = self._rows.get((history, text))
+            if row is None:
+                row = self._next
+                self._next = (self._next + 1) % self.max_entries
+                if self._keys[row] is not None:
+                    # 古い行を捨てる
+                    del self._rows[self._keys[row]]
+                    self._df -= self._tf[row] > 0
+                vector = self._vector(text)
+                self._tf[row] = vector
+                self._df += vector > 0
+                self._histories[row] = history
+                self._keys[row] = (history, text)
+                self._values[row] = {}
+                self._rows[(history, text)] = row
+            self._values[row][field] = (expires, value)
+            self._expires[row] = max(
+                expires for expires, _ in self._values[row].values()
+            )
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._rows))
+        lookups = stats["exact_hits"] + stats["similar_hits"] + stats["misses"]
+        hits = stats["exact_hits"] + stats["similar_hits"]
+        stats["hit_ratio"] = hits / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,652 @@
+"""
+Google Maps / OpenAI / HTTP クライアントの記録・再生・合成用の代替実装
+ネットワークやAPIキーがない環境でも generate_response を決定的に動かすために使う
+
+EXTERNAL_API_MODE
+    live      : 実際のAPIを呼び出す (既定)
+    record    : 実際のAPIを呼び出し、応答をフィクスチャとして保存する
+    replay    : 保存済みのフィクスチャから応答を返す
+    synthetic : 任意の規模のお店・ルートを合成して返す
+"""
+
+import ast
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import googlemaps.convert
+
+EXTERNAL_API_MODE = os.getenv("EXTERNAL_API_MODE", "live")
+# フィクスチャを保存するディレクトリ
+FIXTURE_DIR = os.getenv("FIXTURE_DIR", os.path.join("fixtures", "external_api"))
+# 再生・合成時に挿入する遅延 (ミリ秒)。REPLAY_LATENCY_MS_<ENDPOINT> で個別に指定できる
+REPLAY_LATENCY_MS = float(os.getenv("REPLAY_LATENCY_MS", "0"))
+# ストリーミングの応答を分割する文字数
+REPLAY_STREAM_CHUNK_CHARS = int(os.getenv("REPLAY_STREAM_CHUNK_CHARS", "8"))
+
+
+class FixtureNotFound(LookupError):
+    pass
+
+
+def stable_hash(value):
+    """
+    実行ごとに変わらないハッシュ値 (組み込みのhashはプロセスごとに変わるため使わない)
+    """
+    text = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def strip_api_key(url):
+    """
+    URLからkeyパラメータを取り除く (フィクスチャにAPIキーを残さないため)
+    """
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k != "key"]
+    return f"{parts.scheme}://{parts.netloc}{parts.path}?{urlencode(sorted(query))}"
+
+
+def chat_response(content):
+    """
+    chat.completions.create の戻り値と同じ形のオブジェクトを作る
+    """
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+    )
+
+
+def chat_stream(content, latency=0.0, chunk_chars=REPLAY_STREAM_CHUNK_CHARS):
+    """
+    chat.completions.create(stream=True) の戻り値と同じ形のチャンクを順に返す
+    latency (秒) はチャンクの間に均等に分けて待つ (生成AIが少しずつ出力する様子を模す)
+    """
+    pieces = [
+        content[i : i + chunk_chars] for i in range(0, len(content), chunk_chars)
+    ] or [""]
+    for piece in pieces:
+        if latency > 0:
+            time.sleep(latency / len(pieces))
+        yield SimpleNamespace(
+            choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))]
+        )
+
+
+class HttpResponse:
+    """
+    requests.Response のうち、このアプリで使う部分だけを持つ応答
+    """
+
+    def __init__(self, status_code, text, content=None):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode("utf-8") if content is None else content
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FixtureStore:
+    """
+    <directory>/<endpoint>/<リクエストのハッシュ>.json に応答を保存する
+    """
+
+    def __init__(self, directory=FIXTURE_DIR):
+        self.directory = directory
+
+    def _path(self, endpoint, request):
+        return os.path.join(self.directory, endpoint, f"{stable_hash(request)}.json")
+
+    def load(self, endpoint, request):
+        path = self._path(endpoint, request)
+        if not os.path.exists(path):
+            raise FixtureNotFound(f"No fixture for {endpoint}: {request}")
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)["response"]
+
+    def save(self, endpoint, request, response):
+        path = self._path(endpoint, request)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"request": request, "response": response},
+                f,
+                ensure_ascii=False,
+                indent=2,
+                default=str,
+            )
+
+
+class StandIn:
+    """
+    代替実装の共通部分 (呼び出し回数の集計と遅延の挿入)
+    """
+
+    def __init__(self, latency_ms=None, latency_overrides=None):
+        self.latency_ms = REPLAY_LATENCY_MS if latency_ms is None else latency_ms
+        self.latency_overrides = dict(latency_overrides or {})
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _called(self, endpoint, delay=True):
+        """
+        呼び出しを数え、遅延 (秒) を返す。delay=Falseの場合は待たない (ストリーミングの場合)
+        """
+        with self._lock:
+            self.calls[endpoint] += 1
+        latency = self.latency_overrides.get(endpoint)
+        if latency is None:
+            latency = float(
+                os.getenv(f"REPLAY_LATENCY_MS_{endpoint.upper()}", self.latency_ms)
+            )
+        if delay and latency > 0:
+            time.sleep(latency / 1000)
+        return latency / 1000
+
+
+class _Chat:
+    def __init__(self, create):
+        self.completions = SimpleNamespace(create=create)
+
+
+# ---------------------------------------------------------------- 記録
+
+
+class RecordingGmaps(StandIn):
+    """
+    googlemaps.Client を包み、応答をフィクスチャとして保存する
+    """
+
+    def __init__(self, client, store):
+        super().__init__(latency_ms=0)
+        self.client = client
+        self.store = store
+
+    def _record(self, endpoint, func, **kwargs):
+        self._called(endpoint)
+        response = func(**kwargs)
+        self.store.save(endpoint, kwargs, response)
+        return response
+
+    def find_place(self, **kwargs):
+        return self._record("find_place", self.client.find_place, **kwargs)
+
+    def places_nearby(self, **kwargs):
+        return self._record("places_nearby", self.client.places_nearby, **kwargs)
+
+    def place(self, **kwargs):
+        return self._record("place", self.client.place, **kwargs)
+
+    def distance_matrix(self, **kwargs):
+        return self._record("distance_matrix", self.client.distance_matrix, **kwargs)
+
+
+class RecordingOpenAI(StandIn):
+    """
+    OpenAIクライアントを包み、chat.completions.create の応答本文を保存する
+    ストリーミングの場合は、最後のチャンクを受け取った時点で全体を保存する
+    """
+
+    def __init__(self, client, store):
+        super().__init__(latency_ms=0)
+        self.client = client
+        self.store = store
+        self.chat = _Chat(self._create)
+
+    def _create(self, **kwargs):
+        self._called("chat")
+        response = self.client.chat.completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return self._record_stream(kwargs, response)
+        self.store.save("chat", kwargs, response.choices[0].message.content)
+        return response
+
+    def _record_stream(self, kwargs, stream):
+        parts = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+            yield chunk
+        self.store.save("chat", kwargs, "".join(parts))
+
+
+class RecordingHttp(StandIn):
+    """
+    HTTPクライアントを包み、GETの応答を保存する (URLのAPIキーは保存しない)
+    画像などテキストでない応答はbase64で保存する
+    """
+
+    def __init__(self, http, store):
+        super().__init__(latency_ms=0)
+        self.http = http
+        self.store = store
+
+    def get(self, url, **kwargs):
+        self._called("http")
+        response = self.http.get(url, **kwargs)
+        if urlsplit(url).path.endswith("/place/photo"):
+            body = {"content": base64.b64encode(response.content).decode("ascii")}
+        else:
+            body = {"text": response.text}
+        self.store.save(
+            "http", strip_api_key(url), dict(body, status_code=response.status_code)
+        )
+        return response
+
+
+# ---------------------------------------------------------------- 再生
+
+
+class ReplayGmaps(StandIn):
+    """
+    保存済みのフィクスチャから googlemaps.Client と同じ応答を返す
+    """
+
+    def __init__(self, store, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+
+    def find_place(self, **kwargs):
+        self._called("find_place")
+        return self.store.load("find_place", kwargs)
+
+    def places_nearby(self, **kwargs):
+        self._called("places_nearby")
+        return self.store.load("places_nearby", kwargs)
+
+    def place(self, **kwargs):
+        self._called("place")
+        return self.store.load("place", kwargs)
+
+    def distance_matrix(self, **kwargs):
+        self._called("distance_matrix")
+        return self.store.load("distance_matrix", kwargs)
+
+
+class ReplayOpenAI(StandIn):
+    def __init__(self, store, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+        self.chat = _Chat(self._create)
+
+    def _create(self, **kwargs):
+        latency = self._called("chat", delay=not kwargs.get("stream"))
+        content = self.store.load("chat", kwargs)
+        if kwargs.get("stream"):
+            return chat_stream(content, latency)
+        return chat_response(content)
+
+
+class ReplayHttp(StandIn):
+    def __init__(self, store, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+
+    def get(self, url, **kwargs):
+        self._called("http")
+        response = self.store.load("http", strip_api_key(url))
+        if "content" in response:
+            content = base64.b64decode(response["content"])
+            return HttpResponse(response["status_code"], "", content)
+        return HttpResponse(response["status_code"], response["text"])
+
+
+# ---------------------------------------------------------------- 合成
+
+# 合成データの中心 (京都駅)
+SYNTHETIC_CENTER = (34.9858, 135.7588)
+SYNTHETIC_TYPES = [
+    ["store", "food"],
+    ["bakery", "store", "food"],
+    ["cafe", "food"],
+    ["restaurant", "food"],
+    ["clothing_store", "store"],
+    ["book_store", "store"],
+    ["home_goods_store", "store"],
+    ["convenience_store", "store"],
+]
+
+
+def synthetic_location(name, spread_m):
+    """
+    名前から決まる、中心から spread_m 以内の地点を返す
+    """
+    rng = random.Random(stable_hash(["location", name]))
+    distance = spread_m * math.sqrt(rng.random())
+    angle = rng.uniform(0, 2 * math.pi)
+    lat = SYNTHETIC_CENTER[0] + distance * math.cos(angle) / 111320
+    lng = SYNTHETIC_CENTER[1] + distance * math.sin(angle) / (
+        111320 * math.cos(math.radians(SYNTHETIC_CENTER[0]))
+    )
+    return round(lat, 6), round(lng, 6)
+
+
+def synthetic_distance(start, end):
+    """
+    2地点間の直線距離 (m) の近似値
+    """
+    return int(
+        111320
+        * math.hypot(
+            end[0] - start[0],
+            (end[1] - start[1]) * math.cos(math.radians(start[0])),
+        )
+    )
+
+
+class SyntheticGmaps(StandIn):
+    """
+    任意の規模のお店を合成して返す googlemaps.Client の代替
+    stores_per_search: places_nearby 1回あたりのお店の数
+    website_ratio: ECサイトを持つお店の割合
+    spread_m: 観光地を配置する範囲 (m)。大きいほどルートが長くなる
+    """
+
+    def __init__(
+        self, stores_per_search=20, website_ratio=0.6, spread_m=3000, **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.stores_per_search = stores_per_search
+        self.website_ratio = website_ratio
+        self.spread_m = spread_m
+
+    def find_place(self, input, input_type="textquery", fields=None, **kwargs):
+        self._called("find_place")
+        lat, lng = synthetic_location(input, self.spread_m)
+        return {
+            "status": "OK",
+            "candidates": [
+                {
+                    "formatted_address": f"京都府京都市 {input}",
+                    "geometry": {"location": {"lat": lat, "lng": lng}},
+                    "photos": [{"photo_reference": f"photo-{stable_hash(input)[:16]}"}],
+                }
+            ],
+        }
+
+    def places_nearby(self, location=None, radius=None, type=None, **kwargs):
+        self._called("places_nearby")
+        lat, lng = location
+        if type == "train_station":
+            return {
+                "status": "OK",
+                "results": [
+                    {
+                        "name": "合成駅",
+                        "geometry": {"location": {"lat": lat + 0.002, "lng": lng}},
+                    }
+                ],
+            }
+
+        # 近い地点の検索では同じお店が見つかるよう、約100mのグリッドでplace_idを決める
+        results = []
+        cell = (round(lat * 1000), round(lng * 1000))
+        for i in range(self.stores_per_search):
+            offset = (i % 3 - 1, i // 3 % 3 - 1)
+            place_cell = (cell[0] + offset[0], cell[1] + offset[1])
+            results.append(
+                {
+                    "place_id": f"synthetic-{place_cell[0]}-{place_cell[1]}-{i // 9}",
+                    "name": f"合成店舗{place_cell[0]}-{place_cell[1]}-{i // 9}",
+                }
+            )
+        return {"status": "OK", "results": results}
+
+    def place(self, place_id=None, **kwargs):
+        self._called("place")
+        rng = random.Random(stable_hash(["place", place_id]))
+        _, cell_lat, cell_lng, _ = place_id.split("-")
+        result = {
+            "place_id": place_id,
+            "name": f"合成店舗{place_id[len('synthetic-'):]}",
+            "formatted_address": f"京都府京都市 {place_id}",
+            "rating": round(rng.uniform(3.0, 5.0), 1),
+            "user_ratings_total": rng.randint(0, 2000),
+            "types": rng.choice(SYNTHETIC_TYPES),
+            "geometry": {
+                "location": {
+                    "lat": int(cell_lat) / 1000 + rng.uniform(-0.0004, 0.0004),
+                    "lng": int(cell_lng) / 1000 + rng.uniform(-0.0004, 0.0004),
+                }
+            },
+            "photos": [{"photo_reference": f"photo-{stable_hash(place_id)[:16]}"}],
+        }
+        if rng.random() < self.website_ratio:
+            result["website"] = f"https://example.com/{place_id}"
+        return {"status": "OK", "result": result}
+
+    def distance_matrix(self, origins=None, destinations=None, **kwargs):
+        self._called("distance_matrix")
+        rows = []
+        for origin in origins:
+            elements = []
+            for destination in destinations:
+                # Directions APIの合成と同じく、直線距離を秒速8mで移動するものとする
+                distance = synthetic_distance(
+                    self._point(origin), self._point(destination)
+                )
+                elements.append(
+                    {
+                        "status": "OK",
+                        "distance": {
+                            "value": distance,
+                            "text": f"{distance / 1000:.1f} km",
+                        },
+                        "duration": {
+                            "value": distance // 8,
+                            "text": f"{distance // 480} 分",
+                        },
+                    }
+                )
+            rows.append({"elements": elements})
+        return {
+            "status": "OK",
+            "origin_addresses": [str(origin) for origin in origins],
+            "destination_addresses": [str(d) for d in destinations],
+            "rows": rows,
+        }
+
+    def _point(self, location):
+        # 座標はそのまま使い、地名は合成した地点に置き換える
+        if isinstance(location, str):
+            return synthetic_location(location, self.spread_m)
+        return float(location[0]), float(location[1])
+
+
+def synthetic_png(width, height, rgb):
+    """
+    単色のPNG画像を作る (Place Photo APIの応答の代わり)
+    """
+
+    def chunk(kind, data):
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+        )
+
+    row = b"\x00" + bytes(rgb) * width
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height))
+        + chunk(b"IEND", b"")
+    )
+
+
+class SyntheticHttp(StandIn):
+    """
+    Directions API・Place Photo APIの応答を合成して返すHTTPクライアントの代替
+    steps_per_leg: 1区間あたりのstep数
+    """
+
+    def __init__(self, gmaps, steps_per_leg=8, **kwargs):
+        super().__init__(**kwargs)
+        self.gmaps = gmaps
+        self.steps_per_leg = steps_per_leg
+
+    def _location(self, name):
+        if name == "合成駅":
+            return SYNTHETIC_CENTER[0] + 0.002, SYNTHETIC_CENTER[1]
+        return synthetic_location(name, self.gmaps.spread_m)
+
+    def get(self, url, **kwargs):
+        self._called("http")
+        parts = urlsplit(url)
+        params = dict(parse_qsl(parts.query))
+        if parts.path.endswith("/place/photo"):
+            rng = random.Random(stable_hash(["photo", params.get("photoreference")]))
+            width = int(params.get("maxwidth", 400))
+            rgb = [rng.randrange(256) for _ in range(3)]
+            return HttpResponse(200, "", synthetic_png(width, width * 3 // 4, rgb))
+        waypoints = params["waypoints"].split("|") if params.get("waypoints") else []
+        stops = [params["origin"], *waypoints, params["destination"]]
+        points = [self._location(name) for name in stops]
+
+        legs = []
+        for start, end in zip(points, points[1:]):
+            steps = []
+            for k in range(self.steps_per_leg):
+                a = [
+                    start[j] + (end[j] - start[j]) * k / self.steps_per_leg
+                    for j in (0, 1)
+                ]
+                b = [
+                    start[j] + (end[j] - start[j]) * (k + 1) / self.steps_per_leg
+                    for j in (0, 1)
+                ]
+                steps.append(
+                    {
+                        "start_location": {"lat": a[0], "lng": a[1]},
+                        "end_location": {"lat": b[0], "lng": b[1]},
+                        "polyline": {
+                            "points": googlemaps.convert.encode_polyline([a, b])
+                        },
+                        "html_instructions": "直進",
+                    }
+                )
+            distance = synthetic_distance(start, end)
+            legs.append(
+                {
+                    "start_location": {"lat": start[0], "lng": start[1]},
+                    "end_location": {"lat": end[0], "lng": end[1]},
+                    "distance": {
+                        "value": distance,
+                        "text": f"{distance / 1000:.1f} km",
+                    },
+                    "duration": {
+                        "value": distance // 8,
+                        "text": f"{distance // 480} 分",
+                    },
+                    "steps": steps,
+                }
+            )
+
+        body = {
+            "status": "OK",
+            "geocoded_waypoints": [{"geocoder_status": "OK"} for _ in stops],
+            "routes": [
+                {
+                    "legs": legs,
+                    "waypoint_order": list(range(len(waypoints))),
+                    "overview_polyline": {
+                        "points": googlemaps.convert.encode_polyline(points)
+                    },
+                }
+            ],
+        }
+        return HttpResponse(200, json.dumps(body, ensure_ascii=False))
+
+
+class SyntheticOpenAI(StandIn):
+    """
+    観光地の提案とお店のカテゴリ分類を合成して返すOpenAIクライアントの代替
+    landmarks: 提案する観光地の数
+    """
+
+    def __init__(self, landmarks=3, **kwargs):
+        super().__init__(**kwargs)
+        self.landmarks = landmarks
+        self.chat = _Chat(self._create)
+
+    def _create(self, messages=None, response_format=None, stream=False, **kwargs):
+        latency = self._called("chat", delay=not stream)
+        prompt = messages[-1]["content"]
+        if response_format == {"type": "json_object"}:
+            # カテゴリ分類 (入力は店名のリストの文字列)
+            names = ast.literal_eval(prompt)
+            return chat_response(
+                json.dumps(
+                    {
+                        "result": [
+                            str(int(stable_hash(n)[:8], 16) % 6 + 1) for n in names
+                        ]
+                    },
+                    ensure_ascii=False,
+                )
+            )
+        seed = stable_hash(prompt)[:6]
+        content = json.dumps(
+            {
+                "result": {
+                    "region": "京都府",
+                    "name": [f"合成スポット{seed}-{i}" for i in range(self.landmarks)],
+                    "response_message": "合成データによる提案です。",
+                }
+            },
+            ensure_ascii=False,
+        )
+        if stream:
+            return chat_stream(content, latency)
+        return chat_response(content)
+
+
+def create_offline_clients(
+    mode,
+    fixture_dir=FIXTURE_DIR,
+    latency_ms=None,
+    landmarks=3,
+    steps_per_leg=8,
+    **gmaps_options,
+):
+    """
+    replay / synthetic モードの (OpenAIクライアント, Google Mapsクライアント, HTTPクライアント) を作る
+    gmaps_options は SyntheticGmaps に渡す (stores_per_search, website_ratio, spread_m)
+    """
+    if mode == "replay":
+        store = FixtureStore(fixture_dir)
+        return (
+            ReplayOpenAI(store, latency_ms=latency_ms),
+            ReplayGmaps(store, latency_ms=latency_ms),
+            ReplayHttp(store, latency_ms=latency_ms),
+        )
+    if mode == "synthetic":
+        gmaps = SyntheticGmaps(latency_ms=latency_ms, **gmaps_options)
+        return (
+            SyntheticOpenAI(landmarks=landmarks, latency_ms=latency_ms),
+            gmaps,
+            SyntheticHttp(gmaps, steps_per_leg=steps_per_leg, latency_ms=latency_ms),
+        )
+    raise ValueError(f"Unknown offline mode: {mode}")
+
+
+def wrap_for_recording(client, gmaps, http, fixture_dir=FIXTURE_DIR):
+    """
+    実際のクライアントを包み、応答をフィクスチャとして保存するようにする
+    """
+    store = FixtureStore(fixture_dir)
+    return (
+        RecordingOpenAI(client, store),
+        RecordingGmaps(gmaps, store),
+        RecordingHttp(http, store),
+    )
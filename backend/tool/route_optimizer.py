@@ -0,0 +1,315 @@
+"""
+経由地の訪問順をローカルで決めるモジュール
+移動時間の行列を作り、最近傍法で作った巡回路を2-opt・Or-optで改善する
+"""
+
+import os
+
+import googlemaps.convert
+import numpy as np
+
+from tool.route_sampling import EARTH_RADIUS, decode_polyline
+
+# 移動時間を見積もるための平均速度 (km/h) と、直線距離に対する道のりの倍率
+ROUTE_SPEED_KMH = float(os.getenv("ROUTE_SPEED_KMH", "25"))
+ROUTE_DETOUR_FACTOR = float(os.getenv("ROUTE_DETOUR_FACTOR", "1.3"))
+# Distance Matrix APIで取得した移動時間を保持する時間 (秒)
+TRAVEL_TIME_CACHE_TTL = int(os.getenv("TRAVEL_TIME_CACHE_TTL", str(24 * 3600)))
+# Distance Matrix APIの1リクエストあたりの上限 (出発地・目的地の数と要素数)
+DISTANCE_MATRIX_MAX_POINTS = 25
+DISTANCE_MATRIX_MAX_ELEMENTS = 100
+
+
+def haversine_matrix(a, b=None):
+    """
+    緯度経度の配列 a (n, 2) と b (m, 2) の全ての組の距離 (m) を (n, m) で返す
+    """
+    a = np.radians(np.asarray(a, dtype=float).reshape(-1, 2))
+    b = a if b is None else np.radians(np.asarray(b, dtype=float).reshape(-1, 2))
+    d_lat = b[None, :, 0] - a[:, None, 0]
+    d_lng = b[None, :, 1] - a[:, None, 1]
+    h = (
+        np.sin(d_lat / 2) ** 2
+        + np.cos(a[:, None, 0]) * np.cos(b[None, :, 0]) * np.sin(d_lng / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+def pair_key(origin, destination):
+    return f"{origin[0]:.5f},{origin[1]:.5f}>{destination[0]:.5f},{destination[1]:.5f}"
+
+
+class TravelTimeMatrix:
+    """
+    地点間の移動時間 (秒) の行列を作る
+    fetchを指定した場合は、キャッシュにない組だけをfetch (Distance Matrix API) で取得し、
+    取得できなかった組は直線距離から見積もる
+    fetch: (出発地のリスト, 目的地のリスト) を受け取り、秒数 (不明ならNone) の2次元リストを返す関数
+    """
+
+    namespace = "travel_time"
+
+    def __init__(
+        self,
+        cache=None,
+        fetch=None,
+        speed_kmh=ROUTE_SPEED_KMH,
+        detour_factor=ROUTE_DETOUR_FACTOR,
+    ):
+        self.cache = cache
+        self.fetch = fetch
+        self.speed = speed_kmh * 1000 / 3600
+        self.detour_factor = detour_factor
+        if cache is not None:
+            cache.ttls.setdefault(self.namespace, TRAVEL_TIME_CACHE_TTL)
+
+    def estimate(self, a, b=None):
+        """
+        直線距離から移動時間を見積もる
+        """
+        return haversine_matrix(a, b) * self.detour_factor / self.speed
+
+    def build(self, coords):
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        matrix = self.estimate(coords)
+        if self.fetch is None or self.cache is None:
+            return matrix
+
+        missing = []
+        for i in range(len(coords)):
+            for j in range(len(coords)):
+                if i == j:
+                    continue
+                hit, seconds = self.cache.get(
+                    self.namespace, pair_key(coords[i], coords[j])
+                )
+                if hit:
+                    matrix[i, j] = seconds
+                else:
+                    missing.append((i, j))
+        if missing:
+            origins = sorted({i for i, _ in missing})
+            destinations = sorted({j for _, j in missing})
+            self._fetch_into(matrix, coords, origins, destinations)
+        return matrix
+
+    def _fetch_into(self, matrix, coords, origins, destinations):
+        # 1リクエストの出発地・目的地・要素数の上限に収まるように分割する
+        for d_start in range(0, len(destinations), DISTANCE_MATRIX_MAX_POINTS):
+            d_chunk = destinations[d_start : d_start + DISTANCE_MATRIX_MAX_POINTS]
+            o_size = max(
+                1,
+                min(
+                    DISTANCE_MATRIX_MAX_POINTS,
+                    DISTANCE_MATRIX_MAX_ELEMENTS // len(d_chunk),
+                ),
+            )
+            for o_start in range(0, len(origins), o_size):
+                o_chunk = origins[o_start : o_start + o_size]
+                rows = self.fetch(
+                    [tuple(coords[i]) for i in o_chunk],
+                    [tuple(coords[j]) for j in d_chunk],
+                )
+                for i, row in zip(o_chunk, rows):
+                    for j, seconds in zip(d_chunk, row):
+                        if i == j or seconds is None:
+                            continue
+                        matrix[i, j] = seconds
+                        self.cache.set(
+                            self.namespace, pair_key(coords[i], coords[j]), seconds
+                        )
+
+    def insertion_costs(self, tour_coords, candidate_coords):
+        """
+        巡回路 (tour_coords の順に訪問) に各候補を1か所挿入したときの
+        移動時間の増加量の最小値 (秒) を返す (見積もりのみを使う)
+        """
+        tour_coords = np.asarray(tour_coords, dtype=float).reshape(-1, 2)
+        candidate_coords = np.asarray(candidate_coords, dtype=float).reshape(-1, 2)
+        if len(candidate_coords) == 0:
+            return np.empty(0)
+        if len(tour_coords) < 2:
+            return 2 * self.estimate(candidate_coords, tour_coords).min(axis=1)
+        to_nodes = self.estimate(candidate_coords, tour_coords)
+        edges = np.diag(self.estimate(tour_coords[:-1], tour_coords[1:]))
+        return (to_nodes[:, :-1] + to_nodes[:, 1:] - edges[None, :]).min(axis=1)
+
+
+def nearest_neighbor_tour(matrix, start=0, end=0):
+    """
+    startから最も近い未訪問の地点を順にたどり、endで終わる巡回路を作る
+    """
+    unvisited = np.ones(len(matrix), dtype=bool)
+    unvisited[[start, end]] = False
+    tour = [start]
+    current = start
+    while unvisited.any():
+        current = int(np.argmin(np.where(unvisited, matrix[current], np.inf)))
+        unvisited[current] = False
+        tour.append(current)
+    tour.append(end)
+    return np.array(tour)
+
+
+def two_opt(matrix, tour, max_iterations=1000):
+    """
+    区間の反転で移動時間が最も減るものを繰り返し適用する (始点・終点は固定)
+    非対称な行列にも対応するため、反転した区間の逆向きの移動時間も計算する
+    """
+    tour = np.array(tour)
+    n = len(tour)
+    if n < 4:
+        return tour
+    i_index, j_index = np.triu_indices(n - 1, k=1)
+    inner = i_index >= 1
+    i_index, j_index = i_index[inner], j_index[inner]
+
+    for _ in range(max_iterations):
+        forward = np.concatenate(([0.0], np.cumsum(matrix[tour[:-1], tour[1:]])))
+        backward = np.concatenate(([0.0], np.cumsum(matrix[tour[1:], tour[:-1]])))
+        before, first = tour[i_index - 1], tour[i_index]
+        last, after = tour[j_index], tour[j_index + 1]
+        old = (
+            matrix[before, first]
+            + matrix[last, after]
+            + forward[j_index]
+            - forward[i_index]
+        )
+        new = (
+            matrix[before, last]
+            + matrix[first, after]
+            + backward[j_index]
+            - backward[i_index]
+        )
+        gains = old - new
+        best = int(np.argmax(gains))
+        if gains[best] <= 1e-9:
+            break
+        i, j = i_index[best], j_index[best]
+        tour[i : j + 1] = tour[i : j + 1][::-1]
+    return tour
+
+
+def or_opt(matrix, tour, max_segment=3, max_iterations=1000):
+    """
+    連続する1〜max_segment地点を、向きを変えずに別の位置へ移す操作のうち
+    移動時間が最も減るものを繰り返し適用する (始点・終点は固定)
+    """
+    tour = np.array(tour)
+    n = len(tour)
+    for _ in range(max_iterations):
+        best_gain, best_move = 1e-9, None
+        for length in range(1, min(max_segment, n - 3) + 1):
+            # 区間 tour[i : i + length] を tour[k] と tour[k + 1] の間に移す
+            starts = np.arange(1, n - length)
+            ends = starts + length - 1
+            removal = (
+                matrix[tour[starts - 1], tour[starts]]
+                + matrix[tour[ends], tour[ends + 1]]
+                - matrix[tour[starts - 1], tour[ends + 1]]
+            )
+            positions = np.arange(n - 1)
+            a, b = tour[positions], tour[positions + 1]
+            insertion = (
+                matrix[a[None, :], tour[starts][:, None]]
+                + matrix[tour[ends][:, None], b[None, :]]
+                - matrix[a, b][None, :]
+            )
+            gains = removal[:, None] - insertion
+            # 区間の内側・両隣への移動は除く
+            overlap = (positions[None, :] >= starts[:, None] - 1) & (
+                positions[None, :] <= ends[:, None]
+            )
+            gains[overlap] = -np.inf
+            row, column = np.unravel_index(int(np.argmax(gains)), gains.shape)
+            if gains[row, column] > best_gain:
+                best_gain = gains[row, column]
+                best_move = (starts[row], length, positions[column])
+        if best_move is None:
+            break
+        i, length, k = best_move
+        segment = tour[i : i + length]
+        rest = np.concatenate((tour[:i], tour[i + length :]))
+        # 区間を取り除いた後の挿入位置
+        k = k if k < i else k - length
+        tour = np.concatenate((rest[: k + 1], segment, rest[k + 1 :]))
+    return tour
+
+
+def improve_tour(matrix, tour, max_rounds=20):
+    """
+    2-optとOr-optを、どちらも改善できなくなるまで交互に適用する
+    """
+    cost = tour_cost(matrix, tour)
+    for _ in range(max_rounds):
+        tour = or_opt(matrix, two_opt(matrix, tour))
+        new_cost = tour_cost(matrix, tour)
+        if new_cost >= cost - 1e-9:
+            break
+        cost = new_cost
+    return tour
+
+
+def tour_cost(matrix, tour):
+    tour = np.asarray(tour)
+    return float(matrix[tour[:-1], tour[1:]].sum())
+
+
+def solve_order(matrix):
+    """
+    地点0を出発・到着地とする巡回路の、経由地 (地点1以降) の訪問順を返す
+    戻り値は経由地のインデックス (地点1が0) のリスト
+    """
+    if len(matrix) <= 2:
+        return list(range(len(matrix) - 1))
+    tour = improve_tour(matrix, nearest_neighbor_tour(matrix))
+    return [int(k) - 1 for k in tour[1:-1]]
+
+
+def merge_directions(results):
+    """
+    区間ごとに分けて取得したDirections APIの結果を1つのルートにまとめる
+    """
+    for result in results:
+        if result.get("status") != "OK" or not result.get("routes"):
+            return result
+    routes = [result["routes"][0] for result in results]
+
+    legs = [leg for route in routes for leg in route.get("legs", [])]
+    # 区間の境目の地点は重複するため、2つ目以降の区間は先頭の地点を除く
+    points = np.concatenate(
+        [
+            decode_polyline(route.get("overview_polyline", {}).get("points"))[
+                (1 if k else 0) :
+            ]
+            for k, route in enumerate(routes)
+        ]
+    )
+    route = dict(routes[0])
+    route["legs"] = legs
+    route["waypoint_order"] = list(range(len(legs) - 1))
+    route["overview_polyline"] = {
+        "points": googlemaps.convert.encode_polyline(points.tolist())
+    }
+    bounds = [r["bounds"] for r in routes if r.get("bounds")]
+    if bounds:
+        route["bounds"] = {
+            "northeast": {
+                "lat": max(b["northeast"]["lat"] for b in bounds),
+                "lng": max(b["northeast"]["lng"] for b in bounds),
+            },
+            "southwest": {
+                "lat": min(b["southwest"]["lat"] for b in bounds),
+                "lng": min(b["southwest"]["lng"] for b in bounds),
+            },
+        }
+
+    # 区間の境目の地点は前の区間の終点と次の区間の始点で重複するため1つにする
+    geocoded = list(results[0].get("geocoded_waypoints", []))
+    for result in results[1:]:
+        geocoded.extend(result.get("geocoded_waypoints", [])[1:])
+
+    merged = dict(results[0])
+    merged["routes"] = [route]
+    merged["geocoded_waypoints"] = geocoded
+    return merged
@@ -0,0 +1,154 @@
+"""
+Directions APIのポリラインからお店を検索する地点を等間隔に抽出するモジュール
+"""
+
+import math
+
+import numpy as np
+
+# 地球の半径 (m)
+EARTH_RADIUS = 6371000.0
+
+
+def decode_polyline(encoded):
+    """
+    エンコード済みポリラインを (n, 2) の緯度経度配列にデコードする
+    """
+    if not encoded:
+        return np.empty((0, 2))
+
+    chars = np.frombuffer(encoded.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+    # 0x20 のビットが立っていない文字が各値の最後の文字
+    is_last = (chars & 0x20) == 0
+    value_index = np.concatenate(([0], np.cumsum(is_last)[:-1]))
+    value_starts = np.flatnonzero(np.concatenate(([True], is_last[:-1])))
+    shifts = 5 * (np.arange(len(chars)) - value_starts[value_index])
+
+    values = np.zeros(int(is_last.sum()), dtype=np.int64)
+    np.add.at(values, value_index, (chars & 0x1F) << shifts)
+    # ジグザグエンコードを戻す
+    values = np.where(values & 1, ~(values >> 1), values >> 1)
+
+    if len(values) % 2:
+        values = values[:-1]
+    return np.cumsum(values.reshape(-1, 2), axis=0) / 1e5
+
+
+def route_polyline(directions_result):
+    """
+    Directions APIの結果から、ルート全体の座標列を取り出す
+    stepごとの詳細なポリラインを優先し、なければoverview_polylineを使う
+    """
+    segments = []
+    for route in directions_result.get("routes", []):
+        for leg in route.get("legs", []):
+            for step in leg.get("steps", []):
+                points = step.get("polyline", {}).get("points")
+                if points:
+                    segments.append(decode_polyline(points))
+        if not segments:
+            points = route.get("overview_polyline", {}).get("points")
+            if points:
+                segments.append(decode_polyline(points))
+    if not segments:
+        return np.empty((0, 2))
+    return np.concatenate(segments)
+
+
+def segment_distances(points):
+    """
+    隣り合う座標間の距離 (m) を返す (短距離向けの正距円筒近似)
+    """
+    lat = np.radians(points[:, 0])
+    lng = np.radians(points[:, 1])
+    mean_lat = (lat[1:] + lat[:-1]) / 2
+    dx = (lng[1:] - lng[:-1]) * np.cos(mean_lat)
+    dy = lat[1:] - lat[:-1]
+    return EARTH_RADIUS * np.hypot(dx, dy)
+
+
+def resample(points, spacing):
+    """
+    ルートに沿って spacing (m) ごとの地点を線形補間で取り出す
+    """
+    if len(points) < 2:
+        return points
+    cumulative = np.concatenate(([0.0], np.cumsum(segment_distances(points))))
+    targets = np.arange(0.0, cumulative[-1] + 1e-9, spacing)
+    return np.column_stack(
+        (
+            np.interp(targets, cumulative, points[:, 0]),
+            np.interp(targets, cumulative, points[:, 1]),
+        )
+    )
+
+
+def overlap_ratio(distance, radius):
+    """
+    同じ半径の2つの円が distance 離れているときの重なり面積の割合
+    """
+    if distance >= 2 * radius:
+        return 0.0
+    half = distance / 2
+    lens = 2 * radius**2 * math.acos(half / radius) - 2 * half * math.sqrt(
+        radius**2 - half**2
+    )
+    return lens / (math.pi * radius**2)
+
+
+def min_separation(radius, max_overlap):
+    """
+    重なりの割合が max_overlap 以下になる最小の中心間距離を二分探索で求める
+    """
+    low, high = 0.0, 2 * radius
+    for _ in range(50):
+        middle = (low + high) / 2
+        if overlap_ratio(middle, radius) > max_overlap:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+def drop_overlapping(points, radius, max_overlap):
+    """
+    既に選んだ検索円と大きく重なる地点を取り除く
+    (往路と復路で同じ道を通る場合などの重複検索を防ぐ)
+    """
+    if len(points) == 0:
+        return points
+    threshold = min_separation(radius, max_overlap)
+    lat = np.radians(points[:, 0])
+    lng = np.radians(points[:, 1])
+
+    kept = [0]
+    for i in range(1, len(points)):
+        kept_index = np.array(kept)
+        dx = (lng[kept_index] - lng[i]) * np.cos((lat[kept_index] + lat[i]) / 2)
+        dy = lat[kept_index] - lat[i]
+        if EARTH_RADIUS * np.hypot(dx, dy).min() >= threshold:
+            kept.append(i)
+    return points[kept]
+
+
+def sample_search_points(
+    directions_result, radius=100, spacing=150, max_overlap=0.5, max_points=None
+):
+    """
+    ルートに沿って等間隔にお店の検索地点を選ぶ
+    max_pointsを超える場合は、間隔を広げて地点数を抑える
+    戻り値は extract_lat_lng と同じ形式の辞書のリスト
+    """
+    points = route_polyline(directions_result)
+    if len(points) == 0:
+        return []
+
+    if max_points and len(points) >= 2:
+        total = float(segment_distances(points).sum())
+        spacing = max(spacing, total / max_points)
+
+    sampled = drop_overlapping(resample(points, spacing), radius, max_overlap)
+    return [
+        {"type": "sampled_location", "lat": float(lat), "lng": float(lng)}
+        for lat, lng in sampled
+    ]
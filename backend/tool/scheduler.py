@@ -0,0 +1,185 @@
+"""
+Google APIの呼び出しを、優先度・待ち行列の上限・APIごとのレート制限に従って実行するためのモジュール
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+
+# 旅程の生成に必須の呼び出し (行先候補の検索・最寄り駅・ルート)
+PRIORITY_ROUTE = 0
+# 失敗しても旅程を返せる呼び出し (ルート沿いのお店の検索・詳細)
+PRIORITY_ENRICHMENT = 1
+PRIORITY_NAMES = {PRIORITY_ROUTE: "route", PRIORITY_ENRICHMENT: "enrichment"}
+
+# 実行を待つ呼び出しの上限。超えた場合は待たずにSchedulerOverloadedを送出する
+# (お店の検索などは上限を低くし、先に打ち切る)
+SCHEDULER_MAX_QUEUE = {
+    PRIORITY_ROUTE: int(os.getenv("SCHEDULER_MAX_QUEUE", "4000")),
+    PRIORITY_ENRICHMENT: int(os.getenv("SCHEDULER_MAX_ENRICHMENT_QUEUE", "2000")),
+}
+# APIごとの1秒あたりの呼び出し数の上限とバースト (GOOGLE_QPS_<API> で個別に指定できる)
+GOOGLE_QPS = float(os.getenv("GOOGLE_QPS", "50"))
+GOOGLE_BURST = float(os.getenv("GOOGLE_BURST", "20"))
+# トークンを待つ最大時間 (秒)。超える場合は待たずにRateLimitedを送出する
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "5"))
+# OVER_QUERY_LIMITが返された場合に、そのAPIの呼び出しを止める時間 (秒)
+OVER_QUERY_LIMIT_COOLDOWN = float(os.getenv("OVER_QUERY_LIMIT_COOLDOWN", "1"))
+
+
+class SchedulerOverloaded(Exception):
+    """
+    待ち行列が上限に達したため、呼び出しを受け付けなかった
+    """
+
+
+class RateLimited(SchedulerOverloaded):
+    """
+    レート制限 (またはGoogleのOVER_QUERY_LIMIT) のため、呼び出しを受け付けなかった
+    """
+
+
+class PrioritySemaphore:
+    """
+    優先度の高い (値の小さい) 待ち手から順に許可を与えるセマフォ
+    待ち手が上限に達している場合は待たずにSchedulerOverloadedを送出する
+    rejected: 優先度ごとの受け付けなかった数を記録する辞書 (複数のセマフォで共有できる)
+    """
+
+    def __init__(self, value, max_waiting=None, rejected=None):
+        self._value = value
+        self.max_waiting = dict(max_waiting or {})
+        self._waiters = []
+        self._counter = itertools.count()
+        self.rejected = {} if rejected is None else rejected
+
+    def waiting(self):
+        return len(self._waiters)
+
+    def waiting_by_priority(self):
+        counts = {}
+        for priority, _, _ in self._waiters:
+            counts[priority] = counts.get(priority, 0) + 1
+        return counts
+
+    async def acquire(self, priority):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        limit = self.max_waiting.get(priority)
+        if limit is not None and self.waiting() >= limit:
+            self.rejected[priority] = self.rejected.get(priority, 0) + 1
+            raise SchedulerOverloaded(
+                f"Too many queued API calls ({PRIORITY_NAMES.get(priority, priority)})"
+            )
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._counter), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            elif future.done() and not future.cancelled():
+                # 許可を受け取った直後にキャンセルされた場合は次の待ち手に渡す
+                self.release()
+            raise
+
+    def release(self):
+        # キャンセル済みの待ち手は飛ばし、待っている待ち手がいなければ許可を戻す
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+
+class TokenBucket:
+    """
+    rate (回/秒) で補充され、最大burst個まで貯まるトークンバケット
+    スレッドから呼び出し、トークンを予約してから必要な時間だけ待つ (到着順に公平)
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited = 0.0
+        self.limited = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, max_wait=RATE_LIMIT_MAX_WAIT):
+        """
+        トークンを1つ取得する。max_wait秒以内に取得できない場合はRateLimitedを送出する
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if wait > max_wait:
+                self.limited += 1
+                raise RateLimited(f"Rate limit wait {wait:.1f}s exceeds {max_wait}s")
+            self._tokens -= 1
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def cooldown(self, seconds):
+        """
+        seconds秒の間、トークンが補充されないようにする (OVER_QUERY_LIMITを受けた場合)
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class RateLimiter:
+    """
+    APIごとのトークンバケットを管理する
+    rate=Noneの場合は制限しない (外部APIを合成データ・フィクスチャで置き換えている場合)
+    """
+
+    def __init__(
+        self, rate=GOOGLE_QPS, burst=GOOGLE_BURST, max_wait=RATE_LIMIT_MAX_WAIT
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, api):
+        with self._lock:
+            bucket = self._buckets.get(api)
+            if bucket is None:
+                rate = float(os.getenv(f"GOOGLE_QPS_{api.upper()}", self.rate))
+                bucket = TokenBucket(rate, max(1.0, min(self.burst, rate)))
+                self._buckets[api] = bucket
+            return bucket
+
+    def acquire(self, api):
+        if self.rate is None:
+            return 0.0
+        return self.bucket(api).acquire(self.max_wait)
+
+    def over_query_limit(self, api, cooldown=OVER_QUERY_LIMIT_COOLDOWN):
+        if self.rate is not None:
+            self.bucket(api).cooldown(cooldown)
+
+    def stats(self):
+        with self._lock:
+            buckets = dict(self._buckets)
+        return {
+            api: {"waited_seconds": bucket.waited, "limited": bucket.limited}
+            for api, bucket in buckets.items()
+        }
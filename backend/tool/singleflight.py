@@ -0,0 +1,207 @@
+"""
+同じキーの外部API呼び出しをまとめる (singleflight)
+実行中の呼び出しと同じキーで呼ばれた場合は、新たに呼び出さずにその結果を待つ
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windowsではワーカー間のロックを使わない
+    fcntl = None
+
+from tool.cache import CACHE_DIR
+
+# ワーカー間のロックに使うファイルを置くディレクトリ (空文字の場合はワーカー間で共有しない)
+SINGLEFLIGHT_LOCK_DIR = os.getenv(
+    "SINGLEFLIGHT_LOCK_DIR", os.path.join(CACHE_DIR, "locks")
+)
+# ワーカー間のロック・他のワーカーの呼び出しを待つ最大時間 (秒)。超えた場合は自分で呼び出す
+SINGLEFLIGHT_LOCK_TIMEOUT = float(os.getenv("SINGLEFLIGHT_LOCK_TIMEOUT", "30"))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class FileLock:
+    """
+    同じホストの他のワーカーとの排他に使う、fcntl.flockによるロック
+    ロックを保持している間は、ファイルに呼び出し中のワーカーの記録 (リース) を読み書きできる
+    """
+
+    def __init__(self, path, timeout=SINGLEFLIGHT_LOCK_TIMEOUT, poll_interval=0.01):
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._file = None
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            self._file = open(self.path, "a+")
+            while True:
+                try:
+                    fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        # 他のワーカーが止まっている場合に備え、ロックなしで続ける
+                        return False
+                    time.sleep(self.poll_interval)
+            # ロックを待つ間にファイルが削除された場合は、作り直されたファイルで取り直す
+            try:
+                current = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current == os.fstat(self._file.fileno()).st_ino:
+                return True
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+
+    def __exit__(self, *exc_info):
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+
+    def read(self):
+        self._file.seek(0)
+        return self._file.read()
+
+    def write(self, text):
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(text)
+        self._file.flush()
+
+    def remove(self):
+        # ロックを保持した状態で呼び出すこと (待っているワーカーは新しいファイルで取り直す)
+        os.unlink(self.path)
+
+
+class SingleFlight:
+    """
+    キーごとに実行中の呼び出しを1つに絞る
+    スレッド間ではEventで結果を共有し、lock_dirを指定した場合はワーカー間でも
+    キーごとのファイルで呼び出し中であることを共有する
+    ファイルロックはrecheck (共有キャッシュの確認) とリースの読み書きの間だけ保持し、
+    外部APIの呼び出し中は保持しない
+    """
+
+    def __init__(
+        self,
+        lock_dir=SINGLEFLIGHT_LOCK_DIR,
+        timeout=SINGLEFLIGHT_LOCK_TIMEOUT,
+        poll_interval=0.01,
+    ):
+        self.lock_dir = lock_dir if lock_dir and fcntl is not None else None
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {"leader": 0, "coalesced": 0, "recheck_hit": 0, "wait_timeout": 0}
+
+    def _lock_path(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.lock_dir, f"{digest}.lock")
+
+    def do(self, key, func, recheck=None):
+        """
+        func() の結果を返す。同じキーの呼び出しが実行中であればその結果を待って返す
+        recheck: ワーカー間のロック取得後に呼ばれ、(見つかったか, 値) を返す関数
+                 結果を共有する場所 (キャッシュ) がない場合はNoneとし、ワーカー間ではロックしない
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            self._stats["leader" if leader else "coalesced"] += 1
+
+        if not leader:
+            if not call.done.wait(self.timeout):
+                # 先に呼び出したスレッドが戻らない場合は、待たずに自分で呼び出す
+                with self._lock:
+                    self._stats["wait_timeout"] += 1
+                return func()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = self._run(key, func, recheck)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value
+
+    def _run(self, key, func, recheck):
+        if self.lock_dir is None or recheck is None:
+            return func()
+        lock = FileLock(self._lock_path(key), self.timeout, self.poll_interval)
+        lease = f"{os.getpid()} {threading.get_ident()} {time.time()}"
+        deadline = time.monotonic() + self.timeout
+        leased = False
+        while True:
+            with lock as locked:
+                # 他のワーカーが取得した結果があれば使う
+                hit, value = recheck()
+                if hit:
+                    with self._lock:
+                        self._stats["recheck_hit"] += 1
+                    if locked and not self._leased(lock.read()):
+                        # 呼び出し中のワーカーがいなければファイルを残さない
+                        lock.remove()
+                    return value
+                if not locked:
+                    break
+                if not self._leased(lock.read()) or time.monotonic() >= deadline:
+                    # 呼び出し中のワーカーがいない (または待ちきれない) 場合は自分が呼び出す
+                    lock.write(lease)
+                    leased = True
+                    break
+            # 他のワーカーの呼び出しが終わるのを、ロックを放して待つ
+            time.sleep(self.poll_interval)
+
+        try:
+            return func()
+        finally:
+            if leased:
+                self._release(lock, lease)
+
+    def _release(self, lock, lease):
+        # 呼び出しが終わったらリースを消す (期限切れで他のワーカーに代わっていれば残す)
+        with lock as locked:
+            if locked and lock.read() == lease:
+                lock.remove()
+
+    def _leased(self, text):
+        """
+        ファイルの記録から、他のワーカーが呼び出し中 (期限内) かどうかを返す
+        """
+        try:
+            started_at = float(text.split()[2])
+        except (IndexError, ValueError):
+            return False
+        return time.time() - started_at < self.timeout
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._calls)
+        return stats
@@ -0,0 +1,122 @@
+"""
+検索済みの範囲を管理するグリッド型の空間インデックス
+"""
+
+import math
+import threading
+import time
+
+from tool.route_sampling import EARTH_RADIUS, min_separation
+
+
+class GridIndex:
+    """
+    緯度経度を cell_size (m) 四方のグリッドに分けて、エントリを保持する
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self._cells = {}
+        self._count = 0
+
+    def _cell(self, lat, lng):
+        y = math.radians(lat) * EARTH_RADIUS
+        x = math.radians(lng) * EARTH_RADIUS * math.cos(math.radians(lat))
+        return int(y // self.cell_size), int(x // self.cell_size)
+
+    def add(self, lat, lng, entry):
+        self._cells.setdefault(self._cell(lat, lng), []).append(entry)
+        self._count += 1
+
+    def nearby(self, lat, lng):
+        """
+        周囲3x3セルのエントリを返す (cell_size 以内のエントリは必ず含まれる)
+        """
+        row, column = self._cell(lat, lng)
+        for d_row in (-1, 0, 1):
+            for d_column in (-1, 0, 1):
+                yield from self._cells.get((row + d_row, column + d_column), [])
+
+    def remove_if(self, predicate):
+        removed = 0
+        for key in list(self._cells):
+            entries = [entry for entry in self._cells[key] if not predicate(entry)]
+            removed += len(self._cells[key]) - len(entries)
+            if entries:
+                self._cells[key] = entries
+            else:
+                del self._cells[key]
+        self._count -= removed
+        return removed
+
+    def __len__(self):
+        return self._count
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """
+    2点間の距離 (m) を返す (短距離向けの正距円筒近似)
+    """
+    mean_lat = math.radians((lat1 + lat2) / 2)
+    dx = math.radians(lng2 - lng1) * math.cos(mean_lat)
+    dy = math.radians(lat2 - lat1)
+    return EARTH_RADIUS * math.hypot(dx, dy)
+
+
+class SearchCoverage:
+    """
+    places_nearbyで検索済みの円を管理し、大きく重なる検索を見つける
+    ttlを指定するとリクエストをまたいで共有でき、検索結果のplace_idも再利用できる
+    """
+
+    def __init__(self, radius, max_overlap=0.5, ttl=None, max_entries=50000):
+        self.radius = radius
+        self.threshold = min_separation(radius, max_overlap)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._index = GridIndex(cell_size=2 * radius)
+        self._lock = threading.Lock()
+
+    def covering(self, lat, lng):
+        """
+        (lat, lng) を中心とする検索円を覆っている検索済みの円を返す。なければNone
+        """
+        now = time.time()
+        with self._lock:
+            best = None
+            best_distance = self.threshold
+            for entry in self._index.nearby(lat, lng):
+                if entry["expires_at"] is not None and entry["expires_at"] <= now:
+                    continue
+                d = distance(lat, lng, entry["lat"], entry["lng"])
+                if d < best_distance:
+                    best, best_distance = entry, d
+            return best
+
+    def add(self, lat, lng, place_ids=None):
+        """
+        検索済みの円を登録する
+        """
+        entry = {
+            "lat": lat,
+            "lng": lng,
+            "place_ids": list(place_ids) if place_ids is not None else None,
+            "expires_at": time.time() + self.ttl if self.ttl else None,
+        }
+        with self._lock:
+            if len(self._index) >= self.max_entries:
+                self._purge_expired()
+            self._index.add(lat, lng, entry)
+        return entry
+
+    def _purge_expired(self):
+        now = time.time()
+        removed = self._index.remove_if(
+            lambda entry: entry["expires_at"] is not None and entry["expires_at"] <= now
+        )
+        if not removed:
+            # 期限切れがなければ全て破棄して上限を守る
+            self._index = GridIndex(cell_size=self._index.cell_size)
+
+    def __len__(self):
+        return len(self._index)
@@ -0,0 +1,191 @@
+"""
+パイプラインを、入力を宣言したステージのグラフ (DAG) として実行するモジュール
+入力が揃ったステージから並行に実行し、上流が途中の結果を流す場合は、それを受け取りながら下流を進める
+"""
+
+import asyncio
+import time
+
+
+class Stage:
+    """
+    name: ステージ名 (結果はこの名前のキーワード引数で下流に渡す)
+    func: async def func(run, **inputs)
+    inputs: 完了を待つ上流のステージ (または初期値) の名前
+    streams: 完了を待たずに、run.stream(name) で途中の結果を受け取る上流のステージの名前
+    """
+
+    def __init__(self, name, func, inputs=(), streams=()):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.streams = tuple(streams)
+
+
+class StageGraph:
+    """
+    ステージのグラフ。ステージの入力には初期値の名前か、先に登録したステージの名前だけを指定できる
+    (そのため登録の順番が実行可能な順番になり、循環はできない)
+    """
+
+    def __init__(self, inputs=()):
+        self.inputs = tuple(inputs)
+        self.stages = {}
+
+    def stage(self, name, inputs=(), streams=()):
+        """
+        @graph.stage("find_place", inputs=("llm_suggestion",)) のように関数をステージとして登録する
+        """
+
+        def register(func):
+            if name in self.stages or name in self.inputs:
+                raise ValueError(f"Duplicate stage: {name}")
+            for upstream in (*inputs, *streams):
+                if upstream not in self.stages and upstream not in self.inputs:
+                    raise ValueError(f"Unknown input of {name}: {upstream}")
+            for upstream in streams:
+                if upstream not in self.stages:
+                    raise ValueError(f"Only stages can be streamed: {upstream}")
+            self.stages[name] = Stage(name, func, inputs, streams)
+            return func
+
+        return register
+
+    def run(self, values):
+        """
+        初期値 values (名前→値) でグラフを実行するGraphRunを作る
+        """
+        missing = [name for name in self.inputs if name not in values]
+        if missing:
+            raise ValueError(f"Missing inputs: {missing}")
+        return GraphRun(self, values)
+
+
+class _Stream:
+    """
+    ステージが途中で公開した結果。複数の下流がそれぞれ先頭から読む
+    """
+
+    def __init__(self):
+        self.items = []
+        self.closed = False
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def put(self, item):
+        self.items.append(item)
+        self._notify()
+
+    def close(self):
+        self.closed = True
+        self._notify()
+
+    async def iterate(self):
+        position = 0
+        while True:
+            while position < len(self.items):
+                yield self.items[position]
+                position += 1
+            if self.closed:
+                return
+            await self._changed.wait()
+
+
+class GraphRun:
+    """
+    グラフの1回分の実行
+    ステージはrun.emit(event, data) でイベントを、run.publish(name, item) で途中の結果を出す
+    """
+
+    def __init__(self, graph, values):
+        self.graph = graph
+        self.values = dict(values)
+        self.timings = {}
+        self.started_at = time.perf_counter()
+        self._events = asyncio.Queue()
+        self._streams = {name: _Stream() for name in graph.stages}
+        self._tasks = {}
+
+    def emit(self, event, data):
+        self._events.put_nowait((event, data))
+
+    def publish(self, name, item):
+        self._streams[name].put(item)
+
+    def stream(self, name):
+        """
+        ステージnameが公開した結果を順に返す (ステージが終わると止まる)
+        """
+        return self._streams[name].iterate()
+
+    async def wait(self, name):
+        """
+        ステージnameの結果を待つ (streamで受け取っている上流の完了を待つ場合など)
+        """
+        return await self._tasks[name]
+
+    async def _run_stage(self, stage):
+        try:
+            inputs = {}
+            for name in stage.inputs:
+                inputs[name] = (
+                    await self._tasks[name]
+                    if name in self._tasks
+                    else self.values[name]
+                )
+            started_at = time.perf_counter()
+            value = await stage.func(self, **inputs)
+            self.timings[stage.name] = (
+                started_at - self.started_at,
+                time.perf_counter() - self.started_at,
+            )
+            return value
+        finally:
+            self._streams[stage.name].close()
+
+    async def events(self):
+        """
+        全てのステージを実行し、emitされた (イベント名, データ) を順に返す
+        いずれかのステージが失敗した場合は、残りのステージを取り消してその例外を送出する
+        """
+        for stage in self.graph.stages.values():
+            self._tasks[stage.name] = asyncio.ensure_future(self._run_stage(stage))
+        finished = asyncio.gather(*self._tasks.values())
+        try:
+            while not finished.done():
+                next_event = asyncio.ensure_future(self._events.get())
+                await asyncio.wait(
+                    {next_event, finished}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if next_event.done():
+                    yield next_event.result()
+                else:
+                    next_event.cancel()
+            while not self._events.empty():
+                yield self._events.get_nowait()
+            finished.result()
+        finally:
+            for task in self._tasks.values():
+                task.cancel()
+            finished.cancel()
+
+    def critical_path(self):
+        """
+        最後に終わったステージから、入力のうち最も遅く終わったステージをたどった経路
+        (この経路上のステージの合計が、実行全体の所要時間を決める)
+        """
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda n: self.timings[n][1])
+        path = [name]
+        while True:
+            stage = self.graph.stages[name]
+            upstream = [n for n in (*stage.inputs, *stage.streams) if n in self.timings]
+            if not upstream:
+                break
+            name = max(upstream, key=lambda n: self.timings[n][1])
+            path.append(name)
+        return path[::-1]
@@ -0,0 +1,151 @@
+"""
+ルート上で立ち寄るお店の選択
+候補を配列の表にまとめてスコアを一括で計算し、カテゴリごとにスコアの高いお店を選ぶ
+"""
+
+import os
+
+import numpy as np
+
+# 立ち寄るお店の数
+STORE_PICK_COUNT = int(os.getenv("STORE_PICK_COUNT", "4"))
+# 1カテゴリから選ぶお店の数の上限 (1の場合は全て異なるカテゴリになる)
+STORE_MAX_PER_CATEGORY = int(os.getenv("STORE_MAX_PER_CATEGORY", "1"))
+# 必ず1つ選ぶカテゴリ (Japanese sweets shop)
+REQUIRED_CATEGORIES = ("1",)
+# スコアの重み (評価・レビュー数・寄り道の少なさ)
+RATING_WEIGHT = float(os.getenv("STORE_RATING_WEIGHT", "0.45"))
+REVIEWS_WEIGHT = float(os.getenv("STORE_REVIEWS_WEIGHT", "0.2"))
+DETOUR_WEIGHT = float(os.getenv("STORE_DETOUR_WEIGHT", "0.35"))
+# 同じカテゴリから2つ目以降を選ぶ場合に差し引くスコア
+DIVERSITY_PENALTY = float(os.getenv("STORE_DIVERSITY_PENALTY", "0.3"))
+# 毎回同じお店ばかりにならないよう加える乱数の大きさ
+SCORE_JITTER = float(os.getenv("STORE_SCORE_JITTER", "0.05"))
+# 評価のベイズ平均に使う事前の平均と件数 (レビューが少ないお店の評価を平均に寄せる)
+RATING_PRIOR = 3.5
+RATING_PRIOR_COUNT = 20
+# 寄り道の時間 (秒) がこの値のときに、寄り道のスコアが約0.37になる
+DETOUR_SCALE = float(os.getenv("STORE_DETOUR_SCALE", "300"))
+
+
+def _number(value, default):
+    # "評価なし" などの数値でない値は既定値にする
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return default
+    return float(value)
+
+
+class CandidateTable:
+    """
+    お店の候補を列ごとの配列にまとめた表 (place_idが重複する候補は最初の1件だけ残す)
+    """
+
+    def __init__(self, store_list, categories):
+        seen = set()
+        rows = []
+        for store, category in zip(store_list, categories):
+            place_id = store.get("place_id") or id(store)
+            if place_id in seen:
+                continue
+            seen.add(place_id)
+            rows.append((store, str(category)))
+
+        self.stores = [store for store, _ in rows]
+        self.categories = np.array([category for _, category in rows], dtype=object)
+        self.ratings = np.array(
+            [_number(store.get("rating"), np.nan) for store in self.stores]
+        )
+        self.reviews = np.array(
+            [_number(store.get("user_ratings_total"), 0.0) for store in self.stores]
+        )
+        self.detours = np.array(
+            [_number(store.get("detour_seconds"), np.inf) for store in self.stores]
+        )
+
+    def __len__(self):
+        return len(self.stores)
+
+    def scores(self, rng=None):
+        """
+        各候補のスコア (おおむね0〜1) を返す
+        """
+        if not len(self):
+            return np.empty(0)
+        rated = ~np.isnan(self.ratings)
+        ratings = np.where(rated, self.ratings, RATING_PRIOR)
+        counts = np.where(rated, self.reviews, 0.0)
+        bayesian = (ratings * counts + RATING_PRIOR * RATING_PRIOR_COUNT) / (
+            counts + RATING_PRIOR_COUNT
+        )
+        max_reviews = self.reviews.max()
+        reviews = np.log1p(self.reviews) / np.log1p(max_reviews) if max_reviews else 0
+        detours = np.exp(-np.maximum(self.detours, 0.0) / DETOUR_SCALE)
+
+        scores = (
+            RATING_WEIGHT * bayesian / 5
+            + REVIEWS_WEIGHT * reviews
+            + DETOUR_WEIGHT * detours
+        )
+        if rng is not None and SCORE_JITTER:
+            scores = scores + rng.uniform(0, SCORE_JITTER, len(scores))
+        return scores
+
+
+def select_stores(
+    store_list,
+    categories,
+    k=STORE_PICK_COUNT,
+    seed=None,
+    max_per_category=STORE_MAX_PER_CATEGORY,
+    required_categories=REQUIRED_CATEGORIES,
+):
+    """
+    立ち寄るお店を選び、(お店の名前のリスト, お店の詳細のリスト) を返す
+    required_categoriesのお店を優先し、残りはカテゴリの偏りに応じて減点したスコアの高い順に選ぶ
+    seedを指定すると同じ候補からは常に同じお店を選ぶ
+    """
+    table = CandidateTable(store_list, categories)
+    if not len(table) or k <= 0:
+        return [], []
+    scores = table.scores(np.random.default_rng(seed))
+
+    # カテゴリごとにスコアの高い順に並べる (カテゴリ→スコアの順でソート)
+    order = np.lexsort((-scores, table.categories.astype(str)))
+    sorted_categories = table.categories[order]
+    boundaries = np.flatnonzero(sorted_categories[1:] != sorted_categories[:-1]) + 1
+    groups = {
+        group[0]: order[start:end]
+        for group, start, end in zip(
+            np.split(sorted_categories, boundaries),
+            np.concatenate(([0], boundaries)),
+            np.concatenate((boundaries, [len(order)])),
+        )
+    }
+
+    picked = []
+    taken = {category: 0 for category in groups}
+
+    def take(category):
+        picked.append(int(groups[category][taken[category]]))
+        taken[category] += 1
+
+    for category in required_categories:
+        if len(picked) < k and category in groups:
+            take(category)
+
+    while len(picked) < k:
+        best, best_score = None, -np.inf
+        for category, members in groups.items():
+            if taken[category] >= min(len(members), max_per_category):
+                continue
+            score = (
+                scores[members[taken[category]]] - DIVERSITY_PENALTY * taken[category]
+            )
+            if score > best_score:
+                best, best_score = category, score
+        if best is None:
+            break
+        take(best)
+
+    stores = [table.stores[i] for i in picked]
+    return [store["name"] for store in stores], stores
@@ -0,0 +1,82 @@
+"""
+リクエスト内の各ステージの所要時間を記録するモジュール
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+from tool.metrics import stage_duration
+
+_current_trace = contextvars.ContextVar("stage_trace", default=None)
+
+
+class StageTrace:
+    """
+    1リクエスト分のステージごとの所要時間
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages = []
+        # パイプラインの所要時間を決めたステージの経路 (StageGraphの実行後に記録する)
+        self.critical_path = []
+
+    def add(self, name, started_at, duration):
+        self.stages.append(
+            {
+                "stage": name,
+                "start": started_at - self.started_at,
+                "duration": duration,
+            }
+        )
+
+    def durations(self):
+        """
+        ステージ名ごとの合計時間 (秒) を返す
+        """
+        totals = {}
+        for record in self.stages:
+            totals[record["stage"]] = (
+                totals.get(record["stage"], 0.0) + record["duration"]
+            )
+        return totals
+
+
+def start_trace():
+    """
+    現在のコンテキスト (リクエスト) で記録を開始し、そのStageTraceを返す
+    """
+    trace = StageTrace()
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def server_timing(trace):
+    """
+    StageTraceを Server-Timing ヘッダーの値に変換する
+    """
+    return ", ".join(
+        f"{name};dur={duration * 1000:.1f}"
+        for name, duration in trace.durations().items()
+    )
+
+
+@contextmanager
+def stage(name):
+    """
+    with stage("find_place"): のように囲んだ区間の所要時間を記録する
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started_at
+        stage_duration.observe(duration, stage=name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, started_at, duration)
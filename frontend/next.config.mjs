@@ -1,6 +1,15 @@
 /** @type {import('next').NextConfig} */
 const nextConfig = {
   reactStrictMode: true,
+  // お店の写真はバックエンドのキャッシュ (/photo) から配信する
+  async rewrites() {
+    return [
+      {
+        source: "/photo/:path*",
+        destination: "http://127.0.0.1:8000/photo/:path*",
+      },
+    ];
+  },
 };
 
 export default nextConfig;